@@ -0,0 +1,363 @@
+"""ASGI entry point for crApp, so upstream-bound requests don't hold a worker.
+
+/get_near_me.json is served by a coroutine: Refuge API calls go through a
+non-blocking HTTP client and database lookups run on a small thread pool,
+so one process can have hundreds of lookups waiting on Refuge at once.
+Every other route is the regular Flask app, run on a thread pool.
+
+Run with an ASGI server, ex:
+
+    uvicorn asgi:application --workers 2
+
+DATABASE_URL overrides the default postgresql:///crapp database.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import parse_qs
+
+import httpx
+
+import server
+
+from geo import geohash_center
+from payloads import JsonPayload
+from model import MIN_LOCAL_RESULTS, connect_to_db, db, find_nearby_bathrooms
+from refuge import CircuitOpen, RefugeRequestError, RefugeUnavailable, refuge_client
+from replicas import get_connect_options
+from singleflight import AsyncSingleFlight
+
+# Threads for database lookups from coroutines, keep at or below the
+# SQLAlchemy connection pool size so they never wait on each other for one
+DB_THREADS = 10
+
+# Threads running requests for the Flask app, like a threaded WSGI server
+WSGI_THREADS = 20
+
+# Most connections open to the Refuge API at once
+REFUGE_CONNECTIONS = 100
+
+
+class AsyncRefugeClient:
+    """Non-blocking Refuge API client.
+
+    Shares the circuit breaker, latency histogram and error count of a
+    RefugeClient, so sync and async calls trip the same breaker and show up
+    in the same metrics.
+    """
+
+    def __init__(self, sync_client, max_connections=REFUGE_CONNECTIONS, retries=2):
+        """Initialize an AsyncRefugeClient object.
+
+        sync_client -- RefugeClient whose base_url, timeouts, breaker and
+                       metrics are used
+        max_connections -- most connections open to the API at once
+        retries -- retries of failed connections
+
+        Returns: AsyncRefugeClient object
+        """
+
+        self.sync_client = sync_client
+        connect_timeout, read_timeout = sync_client.timeout
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+            transport=httpx.AsyncHTTPTransport(retries=retries))
+
+    async def get_json(self, path, params=None):
+        """Make GET request to a Refuge API path.
+
+        Returns parsed JSON. Raises RefugeUnavailable if the call fails,
+        RefugeRequestError if the API rejects it or CircuitOpen if upstream
+        is being skipped.
+        """
+
+        sync_client = self.sync_client
+        if not sync_client.breaker.allow():
+            raise CircuitOpen("Refuge API circuit breaker is open")
+
+        start = time.perf_counter()
+        try:
+            response = await self.client.get(sync_client.base_url + path, params=params)
+            response.raise_for_status()
+            data = response.json()
+        except httpx.HTTPStatusError as error:
+            sync_client.errors += 1
+            if error.response.status_code < 500:
+                # The API answered, so it's up (and a half open trial is over)
+                sync_client.breaker.record_success()
+                raise RefugeRequestError(str(error)) from error
+            sync_client.breaker.record_failure()
+            raise RefugeUnavailable(str(error)) from error
+        except (httpx.HTTPError, ValueError) as error:
+            sync_client.errors += 1
+            sync_client.breaker.record_failure()
+            raise RefugeUnavailable(str(error)) from error
+        finally:
+            sync_client.latency_ms.observe((time.perf_counter() - start) * 1000)
+
+        sync_client.breaker.record_success()
+        return data
+
+    async def close(self):
+        """Close kept-alive connections."""
+
+        await self.client.aclose()
+
+
+connect_to_db(server.app, os.environ.get("DATABASE_URL", "postgresql:///crapp"),
+              **get_connect_options(os.environ))
+
+async_refuge_client = AsyncRefugeClient(refuge_client)
+near_me_flight = AsyncSingleFlight()
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="crapp-db")
+wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="crapp-wsgi")
+
+##################################################################
+# Async near me
+
+
+def call_with_app_context(function, args):
+    """Call function inside a Flask app context, releasing its db session after."""
+
+    with server.app.app_context():
+        # Only reads run here (near me lookups), so they can go to a replica
+        server.replica_router.use_replica()
+        try:
+            return function(*args)
+        finally:
+            db.session.remove()
+
+
+async def run_db(function, *args):
+    """Run a blocking database function on the database thread pool.
+
+    Returns function's return value.
+    """
+
+    loop = asyncio.get_event_loop()
+
+    return await loop.run_in_executor(db_executor, call_with_app_context, function, args)
+
+
+async def fetch_bathrooms_near_tile(tile):
+    """Async version of model.get_bathrooms_near_tile.
+
+    Returns list of bathroom dictionaries, raises RefugeUnavailable if the
+    Refuge API call fails.
+    """
+
+    tile_lat, tile_long = geohash_center(tile)
+
+    local_bathrooms = await run_db(find_nearby_bathrooms, tile_lat, tile_long)
+    if len(local_bathrooms) >= MIN_LOCAL_RESULTS:
+        return local_bathrooms
+
+    return await async_refuge_client.get_json("/restrooms/by_location",
+                                              params={"page": 1, "per_page": 30, "offset": 0,
+                                                      "lat": round(tile_lat, 7),
+                                                      "lng": round(tile_long, 7)})
+
+
+async def get_near_me(latitude, longitude):
+    """Async version of server.get_near_me, sharing its tile and payload caches.
+
+    Returns JsonPayload object.
+    """
+
+    cache = server.near_me_cache
+    tile = cache.tile_for(latitude, longitude)
+    bathrooms = cache.get(tile)
+    if bathrooms is not None:
+        return server.near_me_payloads.get_payload(tile, bathrooms)
+
+    async def fetch_and_store():
+        # Another request may have filled the tile while this one waited
+        bathrooms = cache.backend.get(tile)
+        if bathrooms is None:
+            bathrooms = await fetch_bathrooms_near_tile(tile)
+            cache.backend.set(tile, bathrooms, cache.ttl)
+        return bathrooms
+
+    try:
+        # Concurrent misses for the same tile share one fetch
+        bathrooms = await near_me_flight.do(tile, fetch_and_store)
+    except RefugeUnavailable:
+        # Refuge API is down or slow, serve what we have locally (uncached)
+        return JsonPayload(await run_db(find_nearby_bathrooms, latitude, longitude))
+
+    return server.near_me_payloads.get_payload(tile, bathrooms)
+
+
+async def serve_near_me(scope, send):
+    """Answer a /get_near_me.json request."""
+
+    start = time.perf_counter()
+    query = parse_qs(scope["query_string"].decode("latin-1"))
+    try:
+        latitude = float(query["lat"][0])
+        longitude = float(query["lng"][0])
+    except (KeyError, ValueError):
+        await send_response(send, 400, b"lat and lng are required")
+        return
+
+    payload = await get_near_me(latitude, longitude)
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+    status, response_headers, body = payload.get_response(headers.get("if-none-match"),
+                                                          headers.get("accept-encoding"))
+    await send_response(send, status, body, headers=response_headers)
+
+    server.request_metrics.record("GET /get_near_me.json",
+                                  {"wall_ms": (time.perf_counter() - start) * 1000})
+
+
+async def send_response(send, status, body, content_type="text/plain", headers=None):
+    """Send a whole response.
+
+    headers -- optional - list of (header, value) tuples, replaces content_type
+    """
+
+    if headers is None:
+        headers = [("Content-Type", content_type)]
+    headers = headers + [("Content-Length", str(len(body)))]
+
+    await send({"type": "http.response.start",
+                "status": status,
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                            for name, value in headers]})
+    await send({"type": "http.response.body", "body": body})
+
+##################################################################
+# Flask app on a thread pool
+
+
+def get_wsgi_environ(scope, body):
+    """Make a WSGI environ for an ASGI HTTP request.
+
+    Returns dictionary.
+    """
+
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {"REQUEST_METHOD": scope["method"],
+               "SCRIPT_NAME": scope.get("root_path", ""),
+               # WSGI wants the path as latin-1 decoded bytes
+               "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+               "QUERY_STRING": scope["query_string"].decode("latin-1"),
+               "SERVER_NAME": server_name,
+               "SERVER_PORT": str(server_port),
+               "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+               "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+               "wsgi.version": (1, 0),
+               "wsgi.url_scheme": scope.get("scheme", "http"),
+               "wsgi.input": BytesIO(body),
+               "wsgi.errors": sys.stderr,
+               "wsgi.multithread": True,
+               "wsgi.multiprocess": True,
+               "wsgi.run_once": False}
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+        elif f"HTTP_{name}" in environ:
+            environ[f"HTTP_{name}"] += "," + value
+        else:
+            environ[f"HTTP_{name}"] = value
+
+    return environ
+
+
+def run_wsgi_app(environ, send_from_thread):
+    """Run the Flask app for one request, sending its response as it's made.
+
+    The whole request, including iterating a streamed response, stays on
+    one thread, since Flask's request context and db sessions are per thread.
+    """
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                               for name, value in headers]
+        return lambda data: send_body(data, more_body=True)
+
+    def send_body(data, more_body):
+        if not response.get("started"):
+            send_from_thread({"type": "http.response.start",
+                              "status": response["status"],
+                              "headers": response["headers"]})
+            response["started"] = True
+        send_from_thread({"type": "http.response.body", "body": data, "more_body": more_body})
+
+    result = server.app(environ, start_response)
+    try:
+        for chunk in result:
+            if chunk:
+                send_body(chunk, more_body=True)
+        send_body(b"", more_body=False)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+
+async def serve_wsgi(scope, receive, send):
+    """Answer a request with the Flask app."""
+
+    body = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        body.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+
+    loop = asyncio.get_event_loop()
+
+    def send_from_thread(message):
+        # Wait for each send, so a slow client slows the response down
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    await loop.run_in_executor(wsgi_executor, run_wsgi_app,
+                               get_wsgi_environ(scope, b"".join(body)), send_from_thread)
+
+##################################################################
+# ASGI application
+
+
+async def serve_lifespan(receive, send):
+    """Handle server startup and shutdown."""
+
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Build the search index and map clusters now, not on the first request
+            server.search_index.start_refresh(server.app)
+            server.bathroom_clusters.start_refresh(server.app)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_refuge_client.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI application, see module docstring."""
+
+    if scope["type"] == "lifespan":
+        await serve_lifespan(receive, send)
+        return
+
+    # Only plain near me lookups are async, filtered ones rank in memory on the Flask side
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    if (scope["type"] == "http" and scope["method"] == "GET"
+            and scope["path"] == "/get_near_me.json" and set(query) <= {"lat", "lng"}):
+        await serve_near_me(scope, send)
+    else:
+        await serve_wsgi(scope, receive, send)
@@ -0,0 +1 @@
+"""Performance benchmarks for crApp, run from the project root with python -m."""
@@ -0,0 +1,85 @@
+"""Benchmark bulk add_bathrooms_to_db against the old per-bathroom loop.
+
+Run from the project root:
+
+    python -m benchmarks.bench_ingest --rows 5000
+    python -m benchmarks.bench_ingest --database postgresql:///crapp_bench
+"""
+
+import argparse
+import random
+import time
+
+from sqlalchemy import event
+
+from model import Bathroom, add_bathrooms_to_db, connect_to_db, db
+from server import app
+
+
+def make_bathrooms(count, seed):
+    """Make count Bathroom objects scattered around San Francisco.
+
+    Returns list of Bathroom objects.
+    """
+
+    rand = random.Random(seed)
+
+    return [Bathroom(name=f"Bathroom {seed}-{i}",
+                     latitude=round(rand.uniform(37.70, 37.81), 7),
+                     longitude=round(rand.uniform(-122.51, -122.37), 7),
+                     approved=True)
+            for i in range(count)]
+
+def legacy_add_bathrooms_to_db(bathrooms):
+    """The old ingest loop, one in_database query per bathroom."""
+
+    for bathroom in bathrooms:
+        if not bathroom.in_database():
+            db.session.add(bathroom)
+    db.session.commit()
+
+def time_ingest(ingest, bathrooms, statements):
+    """Time one ingest of bathrooms into an emptied table.
+
+    Returns tuple (seconds, number of SQL statements run).
+    """
+
+    Bathroom.query.delete()
+    db.session.commit()
+
+    # Half the batch is already in the table, like a repeat import
+    add_bathrooms_to_db(make_bathrooms(len(bathrooms) // 2, seed=1))
+
+    statements.clear()
+    start = time.perf_counter()
+    ingest(bathrooms)
+    seconds = time.perf_counter() - start
+
+    return seconds, len(statements)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--database", default="sqlite://")
+    args = parser.parse_args()
+
+    connect_to_db(app, args.database)
+    db.create_all()
+
+    statements = []
+    event.listen(db.engine, "before_cursor_execute",
+                 lambda *cursor_args: statements.append(cursor_args[2]))
+
+    results = {}
+    for name, ingest in [("loop", legacy_add_bathrooms_to_db), ("bulk", add_bathrooms_to_db)]:
+        # Fresh objects each run, the same lat-longs both times
+        bathrooms = make_bathrooms(args.rows // 2, seed=1) + make_bathrooms(args.rows // 2, seed=2)
+        results[name] = time_ingest(ingest, bathrooms, statements)
+        seconds, queries = results[name]
+        print(f"{name:>5}: {seconds * 1000:9.1f} ms  {queries:6d} statements")
+
+    print(f"speedup: {results['loop'][0] / results['bulk'][0]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Benchmark how long a fresh worker takes to import server, and its memory.
+
+Each run imports server in a new Python process, like a web worker starting
+up. Run from the project root:
+
+    python -m benchmarks.bench_startup --runs 20
+    python -m benchmarks.bench_startup --module model
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Run in each child process, prints import seconds and peak RSS in KB
+CHILD_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds,
+                   "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   "modules": len(sys.modules)}}))
+"""
+
+
+def time_import(module):
+    """Import module in a new Python process.
+
+    Returns dictionary of seconds, max_rss_kb and modules loaded.
+    """
+
+    output = subprocess.run([sys.executable, "-c", CHILD_SCRIPT.format(module=module)],
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--module", default="server", help="module to import")
+    args = parser.parse_args()
+
+    # First run warms the OS file cache and .pyc files, don't count it
+    time_import(args.module)
+    runs = [time_import(args.module) for i in range(args.runs)]
+
+    import_ms = sorted(run["seconds"] * 1000 for run in runs)
+    rss_mb = [run["max_rss_kb"] / 1024 for run in runs]
+    print(f"import {args.module}: median {statistics.median(import_ms):7.1f} ms  "
+          f"min {import_ms[0]:7.1f} ms  max {import_ms[-1]:7.1f} ms")
+    print(f"worker RSS: {statistics.median(rss_mb):.1f} MB  "
+          f"modules loaded: {runs[-1]['modules']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""EXPLAIN the SQL crApp's requests run and flag full table scans.
+
+Loads a synthetic dataset, makes each kind of request through the Flask
+test client while recording the statements it runs, then EXPLAINs each
+distinct statement. Sequential scans (PostgreSQL) or full table scans
+(SQLite) of tables with at least --min-rows rows are reported, and the exit
+status is 1 if there are any, so it can run in CI. Run from the project root:
+
+    python -m benchmarks.explain_audit
+    python -m benchmarks.explain_audit --database postgresql:///crapp_audit --bathrooms 500000
+
+The database must be empty. PostgreSQL tables are ANALYZEd after loading,
+so the planner sees the data's real size.
+"""
+
+import argparse
+import random
+import re
+import sys
+
+from sqlalchemy import event
+
+import server
+
+from model import Bathroom, connect_to_db, db
+from refuge import refuge_client
+from benchmarks.fake_refuge import start_fake_refuge
+from sync import upsert_bathrooms
+from synthetic import EAST, NORTH, SOUTH, WEST, load_synthetic_data
+
+
+def make_scenarios(client, counts, rand):
+    """Make the requests to audit.
+
+    Returns list of (name, function) pairs.
+    """
+
+    def log_in(user_id):
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+
+    def near_me():
+        server.near_me_cache.backend.clear()
+        client.get('/get_near_me.json', query_string={"lat": rand.uniform(SOUTH, NORTH),
+                                                      "lng": rand.uniform(WEST, EAST)})
+
+    # Building the search index reads every bathroom once by design, so
+    # build it before the audit starts and only audit incremental refreshes
+    server.search_index.refresh()
+    server.search_index.refreshed_at = 0
+
+    def search():
+        # Synthetic bathrooms are named "Bathroom <id>"
+        client.get('/search.json', query_string={"q": f"bathroom {rand.randint(1, counts['bathrooms'])}",
+                                                 "lat": rand.uniform(SOUTH, NORTH),
+                                                 "lng": rand.uniform(WEST, EAST)})
+
+    def user_info():
+        user_id = rand.randint(1, counts["users"])
+        client.get(f'/users/{user_id}')
+        client.get(f'/users/{user_id}?checkins_page=2&ratings_page=2')
+
+    def user_list():
+        user_id = rand.randint(1, counts["users"])
+        log_in(user_id)
+        client.get(f'/lists/{user_id * 2 - 1}')
+
+    def log_in_and_register():
+        user_id = rand.randint(1, counts["users"])
+        client.post('/login-process', data={"email": f"user{user_id}@example.com", "password": "pw"})
+        client.post('/register', data={"full_name": "Jane Doe", "email": f"user{user_id}@example.com",
+                                       "password": "pw"})
+
+    def add_list_item():
+        user_id = rand.randint(1, counts["users"])
+        log_in(user_id)
+        client.get(f'/add_list_item/{rand.randint(1, counts["bathrooms"])}/{user_id * 2 - 1}')
+
+    def checkin_and_rate():
+        log_in(rand.randint(1, counts["users"]))
+        bathroom_id = rand.randint(1, counts["bathrooms"])
+        page = client.get(f'/checkin/{bathroom_id}').get_data(as_text=True)
+        checkin_id = re.search(rf"/rate/{bathroom_id}/(\d+)", page).group(1)
+        client.get(f'/rate/{bathroom_id}/{checkin_id}')
+        client.post(f'/rate/{bathroom_id}/{checkin_id}', data={"rating": 4})
+
+    def export_checkins():
+        server.EXPORT_TOKEN = "audit"
+        client.get('/export/checkins.ndjson?start=2019-06-01&end=2019-06-02',
+                   headers={"Authorization": "Bearer audit"}).get_data()
+
+    def sync_upsert():
+        bathrooms = [Bathroom(latitude=round(rand.uniform(SOUTH, NORTH), 7),
+                              longitude=round(rand.uniform(WEST, EAST), 7), approved=True,
+                              refuge_id=rand.randint(1, 10 ** 7))
+                     for i in range(30)]
+        upsert_bathrooms(bathrooms)
+
+    return [("get_near_me", near_me),
+            ("search_bathrooms", search),
+            ("show_user_info", user_info),
+            ("show_user_list", user_list),
+            ("login_and_register", log_in_and_register),
+            ("add_list_item", add_list_item),
+            ("checkin_and_rate", checkin_and_rate),
+            ("export_checkins", export_checkins),
+            ("sync_upsert", sync_upsert)]
+
+
+def explain(cursor, statement, parameters):
+    """EXPLAIN one statement.
+
+    Returns list of EXPLAIN output rows.
+    """
+
+    if db.engine.dialect.name == "postgresql":
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+    else:
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+
+    return cursor.fetchall()
+
+
+def find_full_scans(plan_rows, table_names):
+    """Find tables an EXPLAIN output reads in full.
+
+    Returns list of table names.
+    """
+
+    scans = []
+    if db.engine.dialect.name == "postgresql":
+        def visit(node):
+            if node.get("Node Type") == "Seq Scan":
+                scans.append(node["Relation Name"])
+            for child in node.get("Plans", ()):
+                visit(child)
+        for plan in plan_rows[0][0]:
+            visit(plan["Plan"])
+        return scans
+
+    # SQLite says "SCAN bathrooms" (older versions "SCAN TABLE bathrooms"),
+    # or "SCAN ... USING INDEX" when it walks an index instead
+    for row in plan_rows:
+        match = re.match(r"SCAN (?:TABLE )?(\w+)(.*)", row[-1])
+        if match and "INDEX" not in match.group(2):
+            # Aliases SQLAlchemy makes, ex bathrooms_1
+            name = match.group(1)
+            if name not in table_names:
+                name = re.sub(r"_\d+$", "", name)
+            scans.append(name)
+
+    return scans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default="sqlite://",
+                        help="database URI, must be empty (default in-memory SQLite)")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--bathrooms", type=int, default=50000)
+    parser.add_argument("--mean-checkins", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--min-rows", type=int, default=1000,
+                        help="full scans of smaller tables are fine")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake_refuge, refuge_client.base_url = start_fake_refuge(0, 30)
+
+    connect_to_db(server.app, args.database)
+    db.create_all()
+    counts = load_synthetic_data(args.users, args.bathrooms, mean_checkins=args.mean_checkins,
+                                 seed=args.seed, workers=args.workers)
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute("ANALYZE")
+        db.session.commit()
+    print(f"dataset: {counts}")
+
+    row_counts = {table.name: db.session.query(db.func.count()).select_from(table).scalar()
+                  for table in db.metadata.sorted_tables}
+
+    # Statements each scenario runs, with the parameters of their first run
+    statements = {}
+    scenario = {"name": None}
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        if scenario["name"] and not executemany and not statement.lstrip().upper().startswith("INSERT"):
+            statements.setdefault(statement, (scenario["name"], parameters))
+
+    event.listen(db.engine, "before_cursor_execute", record_statement)
+
+    server.app.config['TESTING'] = True
+    client = server.app.test_client()
+    for name, make_request in make_scenarios(client, counts, random.Random(args.seed)):
+        scenario["name"] = name
+        make_request()
+        db.session.remove()
+    scenario["name"] = None
+    server.checkin_queue.close()
+    fake_refuge.shutdown()
+
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
+    flagged = 0
+    for statement, (name, parameters) in statements.items():
+        scans = [table for table in find_full_scans(explain(cursor, statement, parameters), row_counts)
+                 if row_counts.get(table, 0) >= args.min_rows]
+        for table in scans:
+            flagged += 1
+            print(f"{name}: full scan of {table} ({row_counts[table]} rows)\n"
+                  f"    {' '.join(statement.split())[:300]}")
+    connection.close()
+
+    print(f"{len(statements)} statements explained, {flagged} full scans of large tables")
+    sys.exit(1 if flagged else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Local stand-in for the Refuge Restrooms API, for benchmarks.
+
+Serves /api/v1/restrooms/by_location and /api/v1/restrooms/search with
+made-up bathrooms after a configurable delay. Run on its own with:
+
+    python -m benchmarks.fake_refuge --port 8765 --latency-ms 120 --payload 30
+
+then point the app at it with REFUGE_API_URL=http://127.0.0.1:8765/api/v1
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def make_fake_bathrooms(latitude, longitude, count, seed):
+    """Make count Refuge-style bathroom dictionaries around a lat-long.
+
+    Returns list of dictionaries.
+    """
+
+    rand = random.Random(seed)
+    bathrooms = []
+    for i in range(count):
+        bathrooms.append({"id": seed * 1000 + i,
+                          "name": f"Fake Bathroom {i}",
+                          "street": f"{rand.randint(1, 999)} Fake St",
+                          "city": "San Francisco",
+                          "state": "CA",
+                          "country": "US",
+                          "accessible": rand.random() < 0.5,
+                          "unisex": rand.random() < 0.5,
+                          "changing_table": rand.random() < 0.2,
+                          "directions": "In the back",
+                          "comment": "",
+                          "latitude": latitude + rand.uniform(-0.01, 0.01),
+                          "longitude": longitude + rand.uniform(-0.01, 0.01),
+                          "created_at": "2019-05-01T00:00:00.000Z",
+                          "updated_at": "2019-05-01T00:00:00.000Z",
+                          "upvote": rand.randint(0, 10),
+                          "downvote": rand.randint(0, 3),
+                          "approved": True,
+                          "distance": rand.uniform(0, 1),
+                          "bearing": str(rand.uniform(0, 360))})
+
+    return bathrooms
+
+
+class FakeRefugeHandler(BaseHTTPRequestHandler):
+    """Answers Refuge API requests after the server's latency."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        time.sleep(self.server.latency_ms / 1000)
+
+        if url.path.endswith("/restrooms/by_location"):
+            latitude = float(params.get("lat", 37.78))
+            longitude = float(params.get("lng", -122.41))
+            body = make_fake_bathrooms(latitude, longitude, self.server.payload_size,
+                                       seed=hash((round(latitude, 4), round(longitude, 4))) % 10000)
+        elif url.path.endswith("/restrooms/search"):
+            # A few pages of results, then an empty page
+            page = int(params.get("page", 1))
+            count = int(params.get("per_page", self.server.payload_size)) if page <= 3 else 0
+            body = make_fake_bathrooms(37.78, -122.41, count, seed=page)
+        else:
+            self.send_error(404)
+            return
+
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        """Keep benchmark output quiet."""
+
+
+def start_fake_refuge(latency_ms=100, payload_size=30, port=0):
+    """Start the fake Refuge API in a background thread.
+
+    latency_ms -- delay before each response
+    payload_size -- bathrooms in each by_location response
+    port -- port to listen on, 0 picks a free one
+
+    Returns tuple (server, base URL to use as REFUGE_API_URL).
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeRefugeHandler)
+    server.daemon_threads = True
+    server.latency_ms = latency_ms
+    server.payload_size = payload_size
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Refuge Restrooms API.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--payload", type=int, default=30)
+    args = parser.parse_args()
+
+    server, base_url = start_fake_refuge(args.latency_ms, args.payload, args.port)
+    print(f"Fake Refuge API at {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,217 @@
+"""Benchmark crApp's main request paths against a fake Refuge API.
+
+Reports p50/p95/p99 latency, throughput and SQL queries per request for each
+scenario, and saves the results as JSON so runs on different commits can be
+compared. Run from the project root:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --database postgresql:///crapp_bench --latency-ms 150
+    python -m benchmarks.run --compare benchmarks/results/<older commit>.json
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import time
+
+from sqlalchemy import event
+
+import server
+
+from benchmarks.fake_refuge import start_fake_refuge
+from model import Bathroom, add_bathrooms_to_db, connect_to_db, db
+from refuge import refuge_client
+from synthetic import EAST, NORTH, SOUTH, WEST, load_synthetic_data
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def get_percentile(sorted_samples, percent):
+    """Returns the percent percentile of already sorted samples."""
+
+    index = min(len(sorted_samples) - 1, int(round(percent / 100 * (len(sorted_samples) - 1))))
+
+    return sorted_samples[index]
+
+
+def run_scenario(make_request, iterations, statements):
+    """Call make_request(i) iterations times, timing each call.
+
+    Returns dictionary of latency percentiles (ms), throughput (requests per
+    second) and mean SQL queries per request.
+    """
+
+    latencies = []
+    queries = 0
+    start = time.perf_counter()
+    for i in range(iterations):
+        statements.clear()
+        request_start = time.perf_counter()
+        make_request(i)
+        latencies.append((time.perf_counter() - request_start) * 1000)
+        queries += len(statements)
+        db.session.remove()
+    total = time.perf_counter() - start
+
+    latencies.sort()
+    return {"iterations": iterations,
+            "p50_ms": round(get_percentile(latencies, 50), 3),
+            "p95_ms": round(get_percentile(latencies, 95), 3),
+            "p99_ms": round(get_percentile(latencies, 99), 3),
+            "throughput_rps": round(iterations / total, 1),
+            "queries_per_request": round(queries / iterations, 2)}
+
+
+def make_scenarios(client, counts, rand):
+    """Make the benchmark scenarios.
+
+    Returns list of (name, function taking iteration number) pairs.
+    """
+
+    def log_in(user_id):
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+
+    def near_me_local(i):
+        # Points inside the dataset, answered from the bathrooms table
+        client.get('/get_near_me.json', query_string={"lat": rand.uniform(SOUTH, NORTH),
+                                                      "lng": rand.uniform(WEST, EAST)})
+
+    def near_me_upstream(i):
+        # Points far from the dataset, a cache miss goes to the fake Refuge API
+        server.near_me_cache.backend.clear()
+        client.get('/get_near_me.json', query_string={"lat": rand.uniform(40.70, 40.80),
+                                                      "lng": rand.uniform(-74.02, -73.93)})
+
+    def near_me_cached(i):
+        # The same tile over and over
+        client.get('/get_near_me.json', query_string={"lat": 40.7484, "lng": -73.9857})
+
+    def user_info(i):
+        client.get(f'/users/{rand.randint(1, counts["users"])}')
+
+    def user_list(i):
+        user_id = rand.randint(1, counts["users"])
+        log_in(user_id)
+        client.get(f'/lists/{user_id * 2 - 1}')
+
+    def checkin_and_rate(i):
+        log_in(rand.randint(1, counts["users"]))
+        bathroom_id = rand.randint(1, counts["bathrooms"])
+        # The checkin is queued, its id is in the rating link on the page
+        page = client.get(f'/checkin/{bathroom_id}').get_data(as_text=True)
+        checkin_id = re.search(rf"/rate/{bathroom_id}/(\d+)", page).group(1)
+        client.post(f'/rate/{bathroom_id}/{checkin_id}', data={"rating": rand.randint(1, 5)})
+
+    def add_bathrooms(i):
+        # A Refuge-sized batch of 30, half already in the table
+        bathrooms = [Bathroom(latitude=round(rand.uniform(SOUTH, NORTH), 7),
+                              longitude=round(rand.uniform(WEST, EAST), 7), approved=True)
+                     for j in range(15)]
+        existing = Bathroom.query.order_by(db.func.random()).limit(15).all()
+        bathrooms += [Bathroom(latitude=b.latitude, longitude=b.longitude, approved=True)
+                      for b in existing]
+        add_bathrooms_to_db(bathrooms)
+
+    return [("get_near_me_local", near_me_local),
+            ("get_near_me_upstream", near_me_upstream),
+            ("get_near_me_cached", near_me_cached),
+            ("show_user_info", user_info),
+            ("show_user_list", user_list),
+            ("checkin_and_rate", checkin_and_rate),
+            ("add_bathrooms_to_db", add_bathrooms)]
+
+
+def get_commit():
+    """Returns short hash of the current git commit, or "unknown"."""
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_comparison(results, baseline):
+    """Print change in p50/p95 and queries per request against a baseline run."""
+
+    print(f"\ncompared to {baseline['commit']}:")
+    for name, result in results["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if old is None:
+            continue
+        changes = []
+        for key in ("p50_ms", "p95_ms", "queries_per_request"):
+            if old[key]:
+                changes.append(f"{key} {(result[key] - old[key]) / old[key] * 100:+.0f}%")
+        print(f"{name:>22}: {', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default="sqlite://",
+                        help="database URI, must be empty (default in-memory SQLite)")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--bathrooms", type=int, default=5000)
+    parser.add_argument("--mean-checkins", type=int, default=50,
+                        help="average checkins per user, a few power users have far more")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="processes generating the dataset")
+    parser.add_argument("--latency-ms", type=float, default=100,
+                        help="fake Refuge API response delay")
+    parser.add_argument("--payload", type=int, default=30,
+                        help="bathrooms per fake Refuge API response")
+    parser.add_argument("--scenarios", nargs="+", help="only run these scenarios")
+    parser.add_argument("--output", help="where to save results JSON")
+    parser.add_argument("--compare", help="results JSON from an earlier run to compare to")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake_refuge, refuge_client.base_url = start_fake_refuge(args.latency_ms, args.payload)
+
+    connect_to_db(server.app, args.database)
+    db.create_all()
+    counts = load_synthetic_data(args.users, args.bathrooms, mean_checkins=args.mean_checkins,
+                                 seed=args.seed, workers=args.workers)
+    print(f"dataset: {counts}")
+
+    statements = []
+    event.listen(db.engine, "before_cursor_execute",
+                 lambda *cursor_args: statements.append(cursor_args[2]))
+
+    server.app.config['TESTING'] = True
+    client = server.app.test_client()
+    rand = random.Random(args.seed)
+
+    results = {"commit": get_commit(),
+               "config": vars(args),
+               "dataset": counts,
+               "scenarios": {}}
+    for name, make_request in make_scenarios(client, counts, rand):
+        if args.scenarios and name not in args.scenarios:
+            continue
+        result = run_scenario(make_request, args.iterations, statements)
+        results["scenarios"][name] = result
+        print(f"{name:>22}: p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms  "
+              f"p99 {result['p99_ms']:8.2f} ms  {result['throughput_rps']:8.1f} req/s  "
+              f"{result['queries_per_request']:6.2f} queries/req")
+
+    fake_refuge.shutdown()
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"saved {output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print_comparison(results, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+"""Geo-tile cache for Refuge API lookups and rendered page fragment cache for crApp."""
+
+import json
+import math
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+from geo import geohash_encode
+from singleflight import SingleFlight
+
+##################################################################
+# Cache backends
+
+
+class LocalBackend:
+    """In-process cache store with per-entry expiry and LRU eviction."""
+
+    def __init__(self, max_entries=1024):
+        """Initialize a LocalBackend object.
+
+        max_entries -- most entries kept before least recently used are evicted
+
+        Returns: LocalBackend object
+        """
+
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get value stored under key.
+
+        Returns value, or None if key is missing or expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            # Mark entry as most recently used
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        """Store value under key for ttl seconds."""
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+
+            # Drop least recently used entries once over capacity
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """Remove key from the cache if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry from the cache."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedBackend:
+    """Cache store shared between workers, kept in a cache server.
+
+    Works with any client that has redis-style get/setex/delete methods
+    (ex redis.Redis). The server does its own LRU eviction, so configure it
+    with an LRU maxmemory policy.
+    """
+
+    def __init__(self, client, prefix="crapp:"):
+        """Initialize a SharedBackend object.
+
+        client -- cache server client, ex redis.Redis()
+        prefix -- prepended to every key to namespace crApp's entries
+
+        Returns: SharedBackend object
+        """
+
+        self.client = client
+        self.prefix = prefix
+        self.evictions = 0
+
+    def get(self, key):
+        """Get value stored under key.
+
+        Returns value, or None if key is missing or expired.
+        """
+
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return None
+
+        return json.loads(raw)
+
+    def set(self, key, value, ttl):
+        """Store value under key for ttl seconds."""
+
+        self.client.setex(self.prefix + key, int(math.ceil(ttl)), json.dumps(value))
+
+    def delete(self, key):
+        """Remove key from the cache if present."""
+
+        self.client.delete(self.prefix + key)
+
+    def __len__(self):
+        return 0
+
+
+def connect_shared_backend(url, prefix="crapp:"):
+    """Connect to a redis cache server.
+
+    url -- server URL, ex "redis://localhost:6379/0"
+
+    Returns SharedBackend object.
+    """
+
+    # Only deployments with several workers need a cache server
+    import redis
+
+    return SharedBackend(redis.Redis.from_url(url), prefix=prefix)
+
+##################################################################
+# Tile cache
+
+
+class TileCache:
+    """Caches lookups by the geohash tile a lat-long falls in."""
+
+    def __init__(self, backend=None, precision=7, ttl=300, single_flight=None):
+        """Initialize a TileCache object.
+
+        backend -- optional - where entries are stored, defaults to LocalBackend
+        precision -- geohash length used for tiles (7 is about 150m x 150m)
+        ttl -- seconds before a cached tile is fetched again
+        single_flight -- optional - SingleFlight coalescing concurrent misses
+                         for the same tile, defaults to one for this process
+
+        Returns: TileCache object
+        """
+
+        self.backend = backend if backend is not None else LocalBackend()
+        self.single_flight = single_flight if single_flight is not None else SingleFlight()
+        self.precision = precision
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def tile_for(self, latitude, longitude):
+        """Returns geohash of the tile lat-long falls in."""
+
+        return geohash_encode(latitude, longitude, self.precision)
+
+    def get(self, tile):
+        """Get cached value for tile, counting the hit or miss.
+
+        Returns value, or None on a miss.
+        """
+
+        value = self.backend.get(tile)
+        with self._lock:
+            if value is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return value
+
+    def get_or_fetch(self, tile, fetch):
+        """Get cached value for tile, calling fetch(tile) to fill it on a miss.
+
+        Only one fetch per tile runs at a time, callers missing the same
+        tile while it runs get its result.
+
+        Returns cached or freshly fetched value.
+        """
+
+        value = self.get(tile)
+        if value is not None:
+            return value
+
+        def fetch_and_store():
+            # Another caller may have filled the tile while this one waited
+            value = self.backend.get(tile)
+            if value is None:
+                value = fetch(tile)
+                self.backend.set(tile, value, self.ttl)
+            return value
+
+        # Concurrent misses for the same tile share one fetch
+        return self.single_flight.do(tile, fetch_and_store,
+                                     recheck=lambda: self.backend.get(tile))
+
+    def stats(self):
+        """Returns dictionary of hit/miss/eviction counters."""
+
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.backend.evictions,
+                "entries": len(self.backend)}
+
+##################################################################
+# Fragment cache
+
+
+class FragmentCache:
+    """Caches rendered HTML fragments, invalidated by tag when their data changes.
+
+    Each fragment is cached with tags naming the data it was rendered from
+    (ex "user:5"). Every tag has a version, a random string kept in the
+    backend, and a fragment's key includes the versions of its tags.
+    invalidate(tag) gives the tag a new version, so every fragment rendered
+    from the old data stops being found and ages out of the LRU. If a
+    version is evicted, the tag just gets a new one, which can't match any
+    old fragment.
+
+    With several worker processes, keep tag versions in a SharedBackend
+    (tag_backend) so invalidating on one worker reaches them all. Fragments
+    can stay in each worker's LocalBackend, since they're looked up by the
+    shared versions.
+    """
+
+    def __init__(self, backend=None, ttl=600, tag_backend=None):
+        """Initialize a FragmentCache object.
+
+        backend -- optional - where fragments are stored, defaults to LocalBackend
+        ttl -- seconds a fragment is kept at most, bounds how stale it can be
+               after changes nothing invalidates (ex a bathroom renamed by a sync)
+        tag_backend -- optional - where tag versions are stored, defaults to backend
+
+        Returns: FragmentCache object
+        """
+
+        self.backend = backend if backend is not None else LocalBackend()
+        self.tag_backend = tag_backend if tag_backend is not None else self.backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def get_version(self, tag):
+        """Returns tag's current version, making one if it has none."""
+
+        version = self.tag_backend.get(f"tag:{tag}")
+        if version is None:
+            version = uuid.uuid4().hex[:12]
+            self.tag_backend.set(f"tag:{tag}", version, self.ttl)
+
+        return version
+
+    def get_or_render(self, key, tags, render):
+        """Get cached fragment, calling render() to make it on a miss.
+
+        key -- names the fragment, ex the page and its arguments
+        tags -- data the fragment shows, invalidating any of them re-renders it
+
+        Returns HTML string.
+        """
+
+        versions = ".".join(self.get_version(tag) for tag in tags)
+        full_key = f"fragment:{key}:{versions}"
+
+        html = self.backend.get(full_key)
+        with self._lock:
+            if html is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if html is None:
+            html = render()
+            self.backend.set(full_key, html, self.ttl)
+
+        return html
+
+    def invalidate(self, tag):
+        """Stop serving fragments rendered from tag's data."""
+
+        self.tag_backend.set(f"tag:{tag}", uuid.uuid4().hex[:12], self.ttl)
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self):
+        """Returns dictionary of hit/miss/invalidation/eviction counters."""
+
+        lookups = self.hits + self.misses
+
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "invalidations": self.invalidations,
+                "evictions": self.backend.evictions,
+                "entries": len(self.backend)}
@@ -0,0 +1,439 @@
+"""Write-behind queue for checkins.
+
+Checking in used to be an INSERT and a COMMIT on the request, one
+transaction per tap. Now a checkin gets its id straight away from a block
+of ids reserved ahead of time, is appended to a local log file (fsynced, so
+a crash doesn't lose it) and is inserted later together with other
+checkins in one transaction, once batch_size are waiting or max_delay
+seconds have passed.
+
+The id handed out is the row's real checkin_id, so the rating form can
+link to it right away. Rating a checkin that's still queued flushes the
+queue first, or waits for the process that queued it to insert it (see
+CheckinQueue.wait_for).
+
+Each process appends to its own log in log_dir and holds a file lock on
+it. When a queue starts, logs whose process is gone (nobody holds the
+lock) are replayed into the database and removed.
+"""
+
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from datetime import datetime
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from model import Checkin, db, record_checkins
+from replicas import read_from_primary
+
+# Checkins inserted per transaction at most
+CHECKIN_BATCH_SIZE = 200
+
+# Seconds a checkin waits in the queue at most (unless the database is down)
+CHECKIN_MAX_DELAY = 0.5
+
+# Checkin ids reserved from the database at a time
+CHECKIN_ID_BLOCK = 100
+
+# Seconds past max_delay to wait for a checkin queued by another process,
+# and seconds between looking for it
+WAIT_MARGIN = 2.0
+WAIT_POLL_INTERVAL = 0.05
+
+# Checkin datetimes in the log
+LOG_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+logger = logging.getLogger("crapp.checkin_queue")
+
+
+def reserve_checkin_ids(count, after=0):
+    """Reserve checkin ids no other insert will use.
+
+    On PostgreSQL they come from the checkins id sequence, so other
+    processes and regular inserts never get them. Other databases (ex
+    sqlite in tests) have one process writing, so ids continue after the
+    highest stored one (or after, if higher). Either way the primary is
+    asked, since a replica can't advance a sequence and may be behind.
+
+    Returns sorted list of count ids.
+    """
+
+    primary = db.get_engine()
+    if primary.dialect.name == "postgresql":
+        # nextval writes, but a SELECT would be routed to a replica
+        rows = db.session.execute("SELECT nextval(pg_get_serial_sequence('checkins', 'checkin_id')) "
+                                  "FROM generate_series(1, :count)", {"count": count}, bind=primary)
+        return sorted(row[0] for row in rows)
+
+    highest = db.session.execute(db.select([db.func.max(Checkin.checkin_id)]), bind=primary).scalar()
+    highest = max(highest or 0, after)
+
+    return list(range(highest + 1, highest + count + 1))
+
+
+def get_log_line(row):
+    """Returns a checkin row as one line of JSON for the log."""
+
+    row = dict(row, checkin_datetime=row["checkin_datetime"].strftime(LOG_DATETIME_FORMAT))
+
+    return json.dumps(row) + "\n"
+
+
+def read_log(log_file):
+    """Read checkin rows from a log file.
+
+    A line cut short by a crash can only be the last one, it's skipped
+    (that checkin's request never got an answer).
+
+    Returns list of row dictionaries.
+    """
+
+    rows = []
+    for line in log_file:
+        try:
+            row = json.loads(line)
+        except ValueError:
+            continue
+        row["checkin_datetime"] = datetime.strptime(row["checkin_datetime"], LOG_DATETIME_FORMAT)
+        rows.append(row)
+
+    return rows
+
+
+def insert_checkin_rows(rows):
+    """Insert checkin rows and count them (see record_checkins) in one transaction.
+
+    Rows whose ids are already stored are skipped.
+
+    If the batch fails (ex a checkin for a bathroom merged away since), rows
+    are retried one at a time and ones that still fail are logged and
+    dropped, so one bad checkin can't hold up the rest.
+
+    Returns list of rows inserted.
+    """
+
+    # Replaying a log can repeat checkins that were inserted before a crash
+    ids = [row["checkin_id"] for row in rows]
+    stored = set()
+    for start in range(0, len(ids), 500):
+        query = db.session.query(Checkin.checkin_id).filter(Checkin.checkin_id.in_(ids[start:start + 500]))
+        stored.update(checkin_id for checkin_id, in query)
+    rows = [row for row in rows if row["checkin_id"] not in stored]
+    if not rows:
+        db.session.rollback()
+        return []
+
+    try:
+        db.session.execute(Checkin.__table__.insert(), rows)
+        # Counted in the same transaction, so a counter rebuild sees each
+        # checkin either counted or not yet inserted
+        record_checkins(rows, commit=False)
+        db.session.commit()
+        return rows
+    except SQLAlchemyError:
+        db.session.rollback()
+        if len(rows) == 1:
+            logger.exception("Dropped checkin %s", rows[0])
+            return []
+
+    return [inserted for row in rows for inserted in insert_checkin_rows([row])]
+
+
+class CheckinQueue:
+    """Checkins accepted but not yet inserted, plus the log keeping them safe.
+
+    add() gives a checkin an id, logs it and queues it. A background thread
+    inserts queued checkins in batches. Counters (accepted, inserted,
+    batches) show how well checkins are being grouped.
+    """
+
+    def __init__(self, log_dir, batch_size=CHECKIN_BATCH_SIZE, max_delay=CHECKIN_MAX_DELAY,
+                 id_block=CHECKIN_ID_BLOCK):
+        """Initialize a CheckinQueue object.
+
+        log_dir -- directory for the append-only logs, on local disk
+        batch_size -- checkins waiting that trigger an insert straight away
+        max_delay -- seconds between inserts otherwise
+        id_block -- checkin ids reserved from the database at a time
+
+        Returns: CheckinQueue object
+        """
+
+        self.log_dir = log_dir
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.id_block = id_block
+        self.app = None
+        # Functions called with each batch of rows inserted (including ones
+        # recovered from logs)
+        self.listeners = []
+        self.pid = None
+        self.log_path = None
+        self.log_file = None
+        self.pending = []
+        self.pending_ids = set()
+        self.free_ids = []
+        self.highest_id = 0
+        self.logged = 0
+        self.synced = 0
+        self.accepted = 0
+        self.inserted = 0
+        self.batches = 0
+        self.stopping = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._start_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Use app's database for background inserts."""
+
+        self.app = app
+
+    def start_if_needed(self):
+        """Start the queue in this process, if it isn't running yet.
+
+        Replays logs left by processes that are gone, opens this process's
+        log and starts the background insert thread. Call with an app
+        context (ex from a request).
+        """
+
+        # A forked worker needs its own log and thread
+        if self.pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self.pid == os.getpid():
+                return
+
+            # File locks are Unix only, so only import when they're used
+            import fcntl
+
+            os.makedirs(self.log_dir, exist_ok=True)
+            self.recover()
+
+            # pid alone could repeat after a restart (ex pid 1 in a container)
+            self.log_path = os.path.join(self.log_dir, f"checkins-{os.getpid()}-{uuid.uuid4().hex[:8]}.log")
+            self.log_file = open(self.log_path, "a")
+            fcntl.flock(self.log_file, fcntl.LOCK_EX)
+
+            self.pending = []
+            self.pending_ids = set()
+            self.free_ids = []
+            self.stopping = False
+            self._thread = threading.Thread(target=self.run, name="crapp-checkins", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+            self.pid = os.getpid()
+
+    def recover(self):
+        """Insert checkins from logs of processes that are gone, then remove the logs.
+
+        Returns number of checkins inserted.
+        """
+
+        import fcntl
+
+        count = 0
+        for path in sorted(glob.glob(os.path.join(self.log_dir, "checkins-*.log"))):
+            if path == self.log_path:
+                continue
+            try:
+                log_file = open(path)
+            except FileNotFoundError:
+                # Another process recovered it first
+                continue
+            with log_file:
+                try:
+                    fcntl.flock(log_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Its process is still running
+                    continue
+                rows = read_log(log_file)
+                for start in range(0, len(rows), self.batch_size):
+                    inserted = insert_checkin_rows(rows[start:start + self.batch_size])
+                    self.notify(inserted)
+                    count += len(inserted)
+                if os.path.exists(path):
+                    os.remove(path)
+
+        return count
+
+    def add(self, user_id, bathroom_id, checkin_datetime=None):
+        """Accept a checkin, it's inserted within about max_delay seconds.
+
+        Returns checkin_id the checkin will be stored with. The checkin is
+        in the log on disk by the time this returns.
+        """
+
+        self.start_if_needed()
+        row = {"user_id": user_id,
+               "bathroom_id": bathroom_id,
+               "checkin_datetime": checkin_datetime or datetime.now(),
+               "rating_id": None}
+
+        with self._lock:
+            if not self.free_ids:
+                self.free_ids = reserve_checkin_ids(self.id_block, after=self.highest_id)
+                self.highest_id = self.free_ids[-1]
+            row["checkin_id"] = self.free_ids.pop(0)
+
+            self.log_file.write(get_log_line(row))
+            self.log_file.flush()
+            self.logged += 1
+            position = self.logged
+
+            self.pending.append(row)
+            self.pending_ids.add(row["checkin_id"])
+            self.accepted += 1
+            if len(self.pending) >= self.batch_size:
+                self._wake.notify()
+
+        self.sync_log(position)
+
+        return row["checkin_id"]
+
+    def sync_log(self, position):
+        """Make sure the log is on disk up to its position-th line.
+
+        Callers arriving while an fsync runs wait for it and usually find
+        their line already covered, so one fsync serves a group of them.
+        """
+
+        with self._sync_lock:
+            if self.synced >= position:
+                return
+            with self._lock:
+                logged = self.logged
+            os.fsync(self.log_file.fileno())
+            self.synced = logged
+
+    def flush(self):
+        """Insert every queued checkin now, in one transaction.
+
+        Returns number of checkins inserted.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                rows = list(self.pending)
+            if not rows:
+                return 0
+
+            inserted = insert_checkin_rows(rows)
+            self.notify(inserted)
+
+            with self._lock:
+                # Checkins added during the insert stay queued
+                del self.pending[:len(rows)]
+                self.pending_ids.difference_update(row["checkin_id"] for row in rows)
+                self.inserted += len(inserted)
+                self.batches += 1
+                if not self.pending:
+                    # Everything logged is in the database, start the log over
+                    self.log_file.seek(0)
+                    self.log_file.truncate()
+
+            return len(inserted)
+
+    def notify(self, rows):
+        """Call listeners with rows just inserted.
+
+        A listener failing is logged rather than raised, the checkins are
+        already stored.
+        """
+
+        if not rows:
+            return
+
+        for listener in self.listeners:
+            try:
+                listener(rows)
+            except Exception:
+                logger.exception("Checkin listener %s failed", listener.__name__)
+                db.session.rollback()
+
+    def wait_for(self, checkin_id):
+        """Wait for a checkin to be in the database, flushing now if it's queued here.
+
+        A checkin queued by another worker process is inserted by that
+        process within max_delay seconds, so the primary is checked until
+        then (plus WAIT_MARGIN). A replica could still be behind at the
+        deadline.
+
+        Returns True if the checkin is in the database, False if it never
+        showed up (ex the id doesn't exist).
+        """
+
+        with self._lock:
+            queued = checkin_id in self.pending_ids
+        if queued:
+            self.flush()
+
+        read_from_primary()
+        deadline = time.monotonic() + self.max_delay + WAIT_MARGIN
+        while True:
+            query = db.session.query(Checkin.checkin_id).filter(Checkin.checkin_id == checkin_id)
+            if query.first() is not None:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(WAIT_POLL_INTERVAL)
+
+    def run(self):
+        """Background thread inserting queued checkins."""
+
+        while True:
+            with self._lock:
+                if not self.stopping and len(self.pending) < self.batch_size:
+                    self._wake.wait(self.max_delay)
+                if self.stopping:
+                    return
+
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    # Ex database down, checkins stay queued and logged for the next try
+                    logger.exception("Inserting %s queued checkins failed", len(self.pending))
+                finally:
+                    db.session.remove()
+
+    def close(self):
+        """Stop the background thread and insert what's still queued."""
+
+        if self.pid != os.getpid():
+            return
+
+        with self._lock:
+            self.stopping = True
+            self._wake.notify()
+        self._thread.join()
+
+        with self.app.app_context():
+            try:
+                self.flush()
+            finally:
+                db.session.remove()
+        self.log_file.close()
+        if not self.pending:
+            os.remove(self.log_path)
+        self.pid = None
+
+    def stats(self):
+        """Returns dictionary of queue counters."""
+
+        with self._lock:
+            return {"accepted": self.accepted,
+                    "inserted": self.inserted,
+                    "batches": self.batches,
+                    "queued": len(self.pending)}
@@ -0,0 +1,206 @@
+"""Server-side map marker clustering for crApp viewport lookups."""
+
+import logging
+import math
+import threading
+import time
+
+from flask import current_app
+from model import Bathroom, db
+from sqlalchemy.orm import joinedload
+
+# Highest zoom that gets clusters, past it the map shows single bathrooms
+MAX_CLUSTER_ZOOM = 15
+
+# Clusters are square cells this many screen pixels wide at each zoom
+CELL_PIXELS = 64
+
+# Most single bathrooms sent for one viewport
+MAX_VIEWPORT_BATHROOMS = 500
+
+logger = logging.getLogger("crapp.clusters")
+
+
+def get_world_pixel(latitude, longitude, zoom):
+    """Project a lat-long to Web Mercator pixels (the projection Google Maps uses).
+
+    Returns tuple (x, y) of pixels from the map's top left corner at zoom.
+    """
+
+    world_size = 256 * 2 ** zoom
+    sin_lat = min(max(math.sin(math.radians(float(latitude))), -0.9999), 0.9999)
+    x = (float(longitude) + 180) / 360 * world_size
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world_size
+
+    return x, y
+
+
+def get_cell(latitude, longitude, zoom):
+    """Returns tuple (column, row) of cluster cell a lat-long falls in at zoom."""
+
+    x, y = get_world_pixel(latitude, longitude, zoom)
+
+    return int(x // CELL_PIXELS), int(y // CELL_PIXELS)
+
+
+class ClusterIndex:
+    """Bathroom clusters precomputed for every zoom level.
+
+    Each zoom level maps grid cells to [count, latitude sum, longitude sum,
+    bathroom_id]. Cells are a fixed number of pixels wide, so a cell at one
+    zoom covers exactly 2x2 cells of the next zoom in, and each level is built
+    by merging the level below it instead of re-reading every bathroom.
+    Rebuilds run in a background thread and swap in every level at once, so
+    viewport lookups keep using the old clusters until then.
+    """
+
+    def __init__(self, max_age=600):
+        """Initialize a ClusterIndex object.
+
+        max_age -- seconds before clusters are rebuilt from the database
+
+        Returns: ClusterIndex object
+        """
+
+        self.max_age = max_age
+        self.levels = {}
+        self.built_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def build(self, points):
+        """Build clusters for every zoom from (bathroom_id, latitude, longitude) points."""
+
+        levels = {}
+
+        finest = {}
+        for bathroom_id, latitude, longitude in points:
+            cell = get_cell(latitude, longitude, MAX_CLUSTER_ZOOM)
+            cluster = finest.get(cell)
+            if cluster is None:
+                finest[cell] = [1, float(latitude), float(longitude), bathroom_id]
+            else:
+                cluster[0] += 1
+                cluster[1] += float(latitude)
+                cluster[2] += float(longitude)
+        levels[MAX_CLUSTER_ZOOM] = finest
+
+        # Merge each 2x2 block of cells into one cell of the zoom above
+        for zoom in range(MAX_CLUSTER_ZOOM - 1, -1, -1):
+            merged = {}
+            for (column, row), (count, lat_sum, long_sum, bathroom_id) in levels[zoom + 1].items():
+                parent = merged.get((column >> 1, row >> 1))
+                if parent is None:
+                    merged[(column >> 1, row >> 1)] = [count, lat_sum, long_sum, bathroom_id]
+                else:
+                    parent[0] += count
+                    parent[1] += lat_sum
+                    parent[2] += long_sum
+            levels[zoom] = merged
+
+        self.levels = levels
+        self.built_at = time.monotonic()
+
+    def build_from_db(self):
+        """Build clusters from every bathroom in the database."""
+
+        points = db.session.query(Bathroom.bathroom_id, Bathroom.latitude, Bathroom.longitude)
+        self.build(points.yield_per(10000))
+
+    def refresh_if_stale(self):
+        """Start a background rebuild if the clusters are older than max_age.
+
+        Only the first build is waited for, since there's nothing to show
+        before it. Call with an app context (ex from a request).
+        """
+
+        if self.built_at is None:
+            self.start_refresh(current_app._get_current_object()).join()
+        elif time.monotonic() - self.built_at > self.max_age:
+            self.start_refresh(current_app._get_current_object())
+
+    def start_refresh(self, app):
+        """Rebuild from app's database in a background thread, unless one is running.
+
+        Returns the rebuild's Thread.
+        """
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run_refresh, args=(app,),
+                                                name="crapp-clusters", daemon=True)
+                self._thread.start()
+
+            return self._thread
+
+    def run_refresh(self, app):
+        """Rebuild from app's database, logging errors instead of raising them."""
+
+        with app.app_context():
+            try:
+                self.build_from_db()
+            except Exception:
+                # Ex database down, lookups keep the old clusters and the next one retries
+                logger.exception("Rebuilding map clusters failed")
+
+    def get_clusters(self, south, west, north, east, zoom):
+        """Get clusters with cells in a viewport.
+
+        Looks up only the cells the viewport covers, so the work depends on
+        the screen size rather than the number of bathrooms.
+
+        Returns list of cluster dictionaries with latitude, longitude (the
+        average of bathrooms in the cluster) and count. Single bathroom
+        clusters also have bathroom_id.
+        """
+
+        level = self.levels.get(zoom, {})
+        west_column, north_row = get_cell(north, west, zoom)
+        east_column, south_row = get_cell(south, east, zoom)
+
+        # Viewport crossing the antimeridian wraps back to column 0
+        columns_in_world = 2 ** zoom * 256 // CELL_PIXELS
+        if east_column < west_column:
+            east_column += columns_in_world
+
+        columns = range(west_column, east_column + 1)
+        rows = range(north_row, south_row + 1)
+        if len(columns) * len(rows) <= len(level):
+            cells = ((column % columns_in_world, row) for column in columns for row in rows)
+            in_view = ((cell, level.get(cell)) for cell in cells)
+        else:
+            # Viewport has more cells than the level has clusters, scan those instead
+            wrapped_columns = {column % columns_in_world for column in columns}
+            in_view = (((column, row), cluster) for (column, row), cluster in level.items()
+                       if column in wrapped_columns and north_row <= row <= south_row)
+
+        clusters = []
+        for cell, cluster in in_view:
+            if cluster is None:
+                continue
+            count, lat_sum, long_sum, bathroom_id = cluster
+            cluster_dict = {"latitude": lat_sum / count,
+                            "longitude": long_sum / count,
+                            "count": count}
+            if count == 1:
+                cluster_dict["bathroom_id"] = bathroom_id
+            clusters.append(cluster_dict)
+
+        return clusters
+
+
+def get_bathrooms_in_view(south, west, north, east, limit=MAX_VIEWPORT_BATHROOMS):
+    """Get single bathrooms in a viewport, for zooms past MAX_CLUSTER_ZOOM.
+
+    Returns list of bathroom dictionaries (see Bathroom.to_dict).
+    """
+
+    query = Bathroom.query.filter(Bathroom.latitude.between(south, north))
+    if west <= east:
+        query = query.filter(Bathroom.longitude.between(west, east))
+    else:
+        query = query.filter(db.or_(Bathroom.longitude >= west, Bathroom.longitude <= east))
+
+    query = query.options(joinedload(Bathroom.stats)).limit(limit)
+
+    return [bathroom.to_dict() for bathroom in query]
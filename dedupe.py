@@ -0,0 +1,165 @@
+"""Find near-duplicate bathrooms by location and name for crApp.
+
+Refuge API coordinates jitter between submissions, so the same bathroom can
+come in at slightly different lat-longs. Bathrooms within DUPLICATE_METERS
+of each other are compared by name and city. To avoid comparing every pair,
+bathrooms go into a grid of cells DUPLICATE_METERS tall, and each one is
+only compared with bathrooms in the cells around it.
+"""
+
+import difflib
+import math
+import re
+
+from geo import haversine_miles
+
+# Farthest apart two listings of the same bathroom can be
+DUPLICATE_METERS = 25
+
+# Lowest score (0-1, see get_duplicate_score) counted as a duplicate
+DUPLICATE_SCORE = 0.6
+
+METERS_PER_MILE = 1609.344
+METERS_PER_DEGREE_LAT = 111320
+
+# Words that say nothing about which bathroom it is
+NAME_STOP_WORDS = {"the", "a", "an", "of", "at", "and", "restroom", "restrooms",
+                   "bathroom", "bathrooms", "toilet", "toilets", "public", "wc"}
+
+
+def normalize_name(name):
+    """Returns name lower cased, without punctuation or NAME_STOP_WORDS."""
+
+    words = re.findall(r"[a-z0-9]+", (name or "").lower())
+
+    return " ".join(word for word in words if word not in NAME_STOP_WORDS)
+
+
+def get_duplicate_score(bathroom, other, meters=DUPLICATE_METERS):
+    """Score how likely two bathrooms are the same one.
+
+    bathroom, other -- tuples (bathroom_id, latitude, longitude, normalized
+                       name, normalized city), see get_grid_entry
+
+    Returns score from 0 to 1, or None if they're too far apart (or in
+    different cities) to be the same. Bathrooms at exactly the same
+    lat-long always score 1.
+    """
+
+    distance = haversine_miles(bathroom[1], bathroom[2], other[1], other[2]) * METERS_PER_MILE
+    if distance > meters:
+        return None
+    if distance == 0:
+        return 1.0
+    if bathroom[4] and other[4] and bathroom[4] != other[4]:
+        return None
+
+    # Unnamed bathrooms match on closeness alone
+    if bathroom[3] and other[3]:
+        name_score = difflib.SequenceMatcher(None, bathroom[3], other[3]).ratio()
+    else:
+        name_score = 0.5
+
+    return 0.7 * name_score + 0.3 * (1 - distance / meters)
+
+
+def get_grid_entry(bathroom_id, latitude, longitude, name, city):
+    """Returns tuple stored in a DuplicateGrid for one bathroom."""
+
+    return (bathroom_id, float(latitude), float(longitude), normalize_name(name),
+            normalize_name(city))
+
+
+class DuplicateGrid:
+    """Bathrooms bucketed into grid cells at least DUPLICATE_METERS wide.
+
+    Cells are DUPLICATE_METERS tall. Each row of cells gets a width in
+    degrees of longitude that is DUPLICATE_METERS wide at that row's
+    latitude, so a bathroom's possible duplicates are always in the row
+    above, its own row or the row below, within one cell width either way.
+    """
+
+    def __init__(self, meters=DUPLICATE_METERS, min_score=DUPLICATE_SCORE):
+        """Initialize a DuplicateGrid object.
+
+        meters -- farthest apart duplicates can be
+        min_score -- lowest get_duplicate_score counted as a duplicate
+
+        Returns: DuplicateGrid object
+        """
+
+        self.meters = meters
+        self.min_score = min_score
+        self.lat_step = meters / METERS_PER_DEGREE_LAT
+        self.cells = {}
+
+    def get_long_step(self, row):
+        """Returns cell width in degrees of longitude for a row of cells."""
+
+        latitude = min(abs((row + 0.5) * self.lat_step), 89.9)
+
+        return min(self.lat_step / math.cos(math.radians(latitude)), 360.0)
+
+    def get_cell(self, latitude, longitude):
+        """Returns tuple (row, column) of the cell a lat-long is in."""
+
+        row = math.floor(latitude / self.lat_step)
+
+        return row, math.floor(longitude / self.get_long_step(row))
+
+    def get_nearby_cells(self, latitude, longitude):
+        """Returns cells that could hold bathrooms within meters of a lat-long."""
+
+        row = math.floor(latitude / self.lat_step)
+        cells = []
+        for nearby_row in (row - 1, row, row + 1):
+            long_step = self.get_long_step(nearby_row)
+            column = math.floor(longitude / long_step)
+            cells.extend((nearby_row, nearby_column)
+                         for nearby_column in (column - 1, column, column + 1))
+
+        return cells
+
+    def add(self, entry):
+        """Add a bathroom's grid entry (see get_grid_entry)."""
+
+        self.cells.setdefault(self.get_cell(entry[1], entry[2]), []).append(entry)
+
+    def remove(self, entry):
+        """Remove a bathroom's grid entry."""
+
+        cell = self.get_cell(entry[1], entry[2])
+        self.cells[cell].remove(entry)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def find_duplicate(self, entry):
+        """Find the bathroom in the grid most likely to be the same as entry.
+
+        Returns grid entry of best match, or None if nothing scores at least
+        min_score.
+        """
+
+        best_score = self.min_score
+        best = None
+        for cell in self.get_nearby_cells(entry[1], entry[2]):
+            for other in self.cells.get(cell, ()):
+                if other[0] is not None and other[0] == entry[0]:
+                    continue
+                score = get_duplicate_score(entry, other, self.meters)
+                if score is not None and score >= best_score:
+                    best_score = score
+                    best = other
+
+        return best
+
+    def drop_rows_below(self, latitude):
+        """Forget bathrooms more than a row of cells south of latitude.
+
+        When bathrooms are added in latitude order, nothing added later can
+        be a duplicate of them, so this keeps memory to a band of the map.
+        """
+
+        lowest_row = math.floor(latitude / self.lat_step) - 1
+        for cell in [cell for cell in self.cells if cell[0] < lowest_row]:
+            del self.cells[cell]
@@ -0,0 +1,179 @@
+"""Streaming bulk export of bathrooms, checkins and ratings for analytics.
+
+Rows are read with a server-side cursor in batches of EXPORT_BATCH_SIZE and
+written out batch by batch as NDJSON or CSV, optionally gzipped, so memory
+stays flat however many rows are exported.
+"""
+
+import csv
+import io
+import json
+import zlib
+
+from datetime import date, datetime
+from decimal import Decimal
+
+from model import Bathroom, Checkin, Rating, db
+
+# Rows fetched from the database (and written out) at a time
+EXPORT_BATCH_SIZE = 2000
+
+EXPORT_TABLES = ("bathrooms", "checkins", "ratings")
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def get_export_columns(table):
+    """Get the columns exported for a table, with the date column its date range filters on.
+
+    Returns tuple (list of columns, date column or None).
+    """
+
+    if table == "bathrooms":
+        return ([Bathroom.bathroom_id, Bathroom.name, Bathroom.city, Bathroom.state,
+                 Bathroom.country, Bathroom.latitude, Bathroom.longitude, Bathroom.unisex,
+                 Bathroom.accessible, Bathroom.changing_table], None)
+    if table == "checkins":
+        return ([Checkin.checkin_id, Checkin.user_id, Checkin.bathroom_id,
+                 Checkin.checkin_datetime, Checkin.rating_id], Checkin.checkin_datetime)
+    if table == "ratings":
+        # Ratings have no date of their own, they're dated by their checkin
+        return ([Rating.rating_id, Rating.user_id, Rating.bathroom_id, Rating.checkin_id,
+                 Rating.score, Rating.review_text, Checkin.checkin_datetime],
+                Checkin.checkin_datetime)
+
+    raise ValueError(f"Can't export {table}, choose bathrooms, checkins or ratings")
+
+
+def get_export_query(table, start=None, end=None, bounds=None, state=None):
+    """Build the query for an export.
+
+    table -- bathrooms, checkins or ratings
+    start, end -- optional - datetimes, only rows dated start <= date < end
+                  (checkins and ratings only)
+    bounds -- optional - tuple (south, west, north, east), only rows for
+              bathrooms inside it
+    state -- optional - only rows for bathrooms in this state
+
+    Returns tuple (query of row tuples, list of column names).
+    """
+
+    columns, date_column = get_export_columns(table)
+    if (start or end) and date_column is None:
+        raise ValueError(f"{table} can't be filtered by date")
+
+    query = db.session.query(*columns)
+    if table == "ratings":
+        query = query.join(Checkin, Rating.checkin_id == Checkin.checkin_id)
+    if table != "bathrooms" and (bounds or state):
+        query = query.join(Bathroom, columns[2] == Bathroom.bathroom_id)
+
+    if start:
+        query = query.filter(date_column >= start)
+    if end:
+        query = query.filter(date_column < end)
+    if bounds:
+        south, west, north, east = bounds
+        query = query.filter(Bathroom.latitude.between(south, north))
+        if west <= east:
+            query = query.filter(Bathroom.longitude.between(west, east))
+        else:
+            query = query.filter(db.or_(Bathroom.longitude >= west, Bathroom.longitude <= east))
+    if state:
+        query = query.filter(Bathroom.state == state)
+
+    # Primary key order keeps exports repeatable, stream_results asks the
+    # driver for a server-side cursor instead of fetching every row at once
+    query = query.order_by(columns[0])
+    query = query.execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+    return query, [column.key for column in columns]
+
+
+def format_value(value):
+    """Make a database value JSON/CSV friendly.
+
+    Returns value as str, float, int, bool or None.
+    """
+
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+
+    return value
+
+
+def generate_ndjson(rows, names):
+    """Write rows as one JSON object per line.
+
+    Returns generator of text chunks, one per batch of rows.
+    """
+
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(names, map(format_value, row)))))
+        if len(lines) == EXPORT_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def generate_csv(rows, names):
+    """Write rows as CSV with a header line.
+
+    Returns generator of text chunks, one per batch of rows.
+    """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    count = 0
+    for row in rows:
+        writer.writerow([format_value(value) for value in row])
+        count += 1
+        if count == EXPORT_BATCH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    yield buffer.getvalue()
+
+
+def gzip_chunks(chunks):
+    """Gzip a stream of text chunks as they're made.
+
+    Returns generator of gzip bytes.
+    """
+
+    # wbits 31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode("utf-8"))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def generate_export(table, export_format="ndjson", gzip=False, **filters):
+    """Stream an export of table (see get_export_query for filters).
+
+    Returns generator of text chunks, or gzip bytes if gzip.
+    """
+
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Can't export as {export_format}, choose ndjson or csv")
+
+    # Build the query now so bad arguments fail before anything is sent
+    query, names = get_export_query(table, **filters)
+
+    if export_format == "ndjson":
+        chunks = generate_ndjson(query, names)
+    else:
+        chunks = generate_csv(query, names)
+
+    if gzip:
+        return gzip_chunks(chunks)
+
+    return chunks
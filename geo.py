@@ -0,0 +1,168 @@
+"""Geographic helper functions for crApp (geohash tiles, distance, bearing)."""
+
+import math
+
+# Base32 alphabet used by geohash strings
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_INDEX = {char: i for i, char in enumerate(GEOHASH_ALPHABET)}
+
+EARTH_RADIUS_MILES = 3958.8
+
+
+def geohash_encode(latitude, longitude, precision=7):
+    """Encode a lat-long as a geohash string.
+
+    Nearby points share a geohash prefix, so a geohash of a given precision
+    names the tile a point falls in (precision 7 is roughly 150m x 150m).
+
+    Returns geohash string with precision characters.
+    """
+
+    latitude = float(latitude)
+    longitude = float(longitude)
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even_bit = True
+
+    while len(geohash) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        if even_bit:
+            value, bounds = longitude, long_range
+        else:
+            value, bounds = latitude, lat_range
+
+        mid = (bounds[0] + bounds[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            bounds[0] = mid
+        else:
+            bits = bits << 1
+            bounds[1] = mid
+
+        even_bit = not even_bit
+        bit_count += 1
+
+        # Every 5 bits becomes one base32 character
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(geohash)
+
+
+def geohash_bounds(geohash):
+    """Get the bounding box of a geohash tile.
+
+    Returns tuple (south, west, north, east).
+    """
+
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+    even_bit = True
+
+    for char in geohash:
+        bits = GEOHASH_INDEX[char]
+        for shift in range(4, -1, -1):
+            bounds = long_range if even_bit else lat_range
+            mid = (bounds[0] + bounds[1]) / 2
+            if (bits >> shift) & 1:
+                bounds[0] = mid
+            else:
+                bounds[1] = mid
+            even_bit = not even_bit
+
+    return (lat_range[0], long_range[0], lat_range[1], long_range[1])
+
+
+def geohash_center(geohash):
+    """Get the center point of a geohash tile.
+
+    Returns tuple (latitude, longitude).
+    """
+
+    south, west, north, east = geohash_bounds(geohash)
+
+    return ((south + north) / 2, (west + east) / 2)
+
+
+def geohash_cells_in_box(south, west, north, east, precision):
+    """Get the geohash cells of one precision that a lat-long box overlaps.
+
+    Returns set of geohash strings.
+    """
+
+    south_west = geohash_bounds(geohash_encode(south, west, precision))
+    height = south_west[2] - south_west[0]
+    width = south_west[3] - south_west[1]
+
+    # Step a cell at a time from the south west corner, finishing on each edge
+    cells = set()
+    latitude = south
+    while True:
+        longitude = west
+        while True:
+            cells.add(geohash_encode(latitude, longitude, precision))
+            if longitude >= east:
+                break
+            longitude = min(longitude + width, east)
+        if latitude >= north:
+            break
+        latitude = min(latitude + height, north)
+
+    return cells
+
+
+def geohash_prefix_end(geohash):
+    """Get the first geohash after every one that starts with geohash, ex 9q8yy is 9q8yz, 9q8yz is 9q8z.
+
+    geohash <= other < geohash_prefix_end(geohash) finds geohashes with the
+    prefix in any collation that sorts digits and lowercase letters the
+    usual way (unlike geohash + "~", which locale collations like
+    en_US.UTF-8 mostly ignore).
+
+    Returns geohash string, or None if no geohash comes after (ex "zz").
+    """
+
+    # Drop trailing z's, like carrying when adding one
+    prefix = geohash.rstrip("z")
+    if not prefix:
+        return None
+
+    return prefix[:-1] + GEOHASH_ALPHABET[GEOHASH_INDEX[prefix[-1]] + 1]
+
+
+def haversine_miles(lat1, long1, lat2, long2):
+    """Great-circle distance between two lat-longs.
+
+    Returns distance in miles (the unit Refuge API uses).
+    """
+
+    lat1, long1, lat2, long2 = map(math.radians, (float(lat1), float(long1),
+                                                  float(lat2), float(long2)))
+    dlat = lat2 - lat1
+    dlong = long2 - long1
+    a = (math.sin(dlat / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin(dlong / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+
+def bearing_degrees(lat1, long1, lat2, long2):
+    """Initial compass bearing from the first lat-long to the second.
+
+    Returns bearing in degrees, 0-360 clockwise from north.
+    """
+
+    lat1, long1, lat2, long2 = map(math.radians, (float(lat1), float(long1),
+                                                  float(lat2), float(long2)))
+    dlong = long2 - long1
+    x = math.sin(dlong) * math.cos(lat2)
+    y = (math.cos(lat1) * math.sin(lat2)
+         - math.sin(lat1) * math.cos(lat2) * math.cos(dlong))
+
+    return (math.degrees(math.atan2(x, y)) + 360) % 360
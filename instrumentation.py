@@ -0,0 +1,173 @@
+"""Always-on per-request timing and SQL instrumentation for crApp."""
+
+import logging
+import threading
+import time
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import COUNT_BUCKETS, Histogram
+
+logger = logging.getLogger("crapp.slow_requests")
+
+
+class RequestMetrics:
+    """Records wall, DB, upstream and template time per route.
+
+    Timings are gathered on flask.g while a request runs, from Flask request
+    hooks, SQLAlchemy engine events, template signals and RefugeClient
+    listeners, then added to per-route histograms when it finishes. Requests
+    slower than slow_request_ms are logged with the queries they ran.
+    """
+
+    # Per-route histograms, by name
+    TIMINGS = ("wall_ms", "db_ms", "upstream_ms", "render_ms")
+
+    def __init__(self, slow_request_ms=500):
+        """Initialize a RequestMetrics object.
+
+        slow_request_ms -- requests taking longer are logged with their queries
+
+        Returns: RequestMetrics object
+        """
+
+        self.slow_request_ms = slow_request_ms
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app, refuge_client=None):
+        """Hook into app's requests, every SQLAlchemy engine and refuge_client's calls."""
+
+        app.before_request(self.start_request)
+        # Teardown runs for requests that raise too, unlike after_request
+        app.teardown_request(self.finish_request)
+        before_render_template.connect(self.start_render, app)
+        template_rendered.connect(self.finish_render, app)
+
+        # Listening on the Engine class covers engines created later by connect_to_db
+        event.listen(Engine, "before_cursor_execute", self.start_query)
+        event.listen(Engine, "after_cursor_execute", self.finish_query)
+        event.listen(Engine, "handle_error", self.fail_query)
+
+        if refuge_client is not None:
+            refuge_client.listeners.append(self.record_upstream)
+
+    def start_request(self):
+        """Start timing a request."""
+
+        g.request_started = time.perf_counter()
+        g.queries = []
+        g.db_ms = 0.0
+        g.upstream_ms = 0.0
+        g.render_ms = 0.0
+
+    def finish_request(self, error=None):
+        """Record finished (or failed) request's timings, logging it if slow."""
+
+        if "request_started" not in g:
+            return
+
+        timings = {"wall_ms": (time.perf_counter() - g.request_started) * 1000,
+                   "db_ms": g.db_ms,
+                   "upstream_ms": g.upstream_ms,
+                   "render_ms": g.render_ms}
+        route = f"{request.method} {request.url_rule.rule if request.url_rule else '<unmatched>'}"
+        self.record(route, timings, len(g.queries))
+
+        if timings["wall_ms"] >= self.slow_request_ms:
+            logger.warning("Slow request %s %s: %.1f ms (db %.1f ms, upstream %.1f ms, "
+                           "render %.1f ms), %d queries:\n%s",
+                           route, request.full_path, timings["wall_ms"], timings["db_ms"],
+                           timings["upstream_ms"], timings["render_ms"], len(g.queries),
+                           "\n".join(f"  {ms:.1f} ms  {statement}" for statement, ms in g.queries))
+
+    def start_render(self, app, template, context, **extra):
+        """Start timing a template render."""
+
+        if has_request_context():
+            g.render_started = time.perf_counter()
+
+    def finish_render(self, app, template, context, **extra):
+        """Add template render time to the request."""
+
+        if has_request_context() and "render_started" in g:
+            g.render_ms += (time.perf_counter() - g.render_started) * 1000
+
+    def start_query(self, conn, cursor, statement, parameters, context, executemany):
+        """Start timing a SQL statement."""
+
+        # Kept on the statement's execution context, so a statement that
+        # raises doesn't leave a start time behind on the pooled connection
+        if context is not None:
+            context.query_started = time.perf_counter()
+
+    def finish_query(self, conn, cursor, statement, parameters, context, executemany):
+        """Add SQL statement and its time to the request."""
+
+        self.add_query(context, statement)
+
+    def fail_query(self, exception_context):
+        """Add a SQL statement that raised, and its time, to the request."""
+
+        self.add_query(exception_context.execution_context, exception_context.statement)
+
+    def add_query(self, context, statement):
+        """Add a timed statement to the request, if it's in one."""
+
+        started = getattr(context, "query_started", None)
+        if started is None:
+            return
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        context.query_started = None
+        if has_request_context() and "queries" in g:
+            g.db_ms += elapsed_ms
+            g.queries.append((statement, elapsed_ms))
+
+    def record_upstream(self, elapsed_ms):
+        """Add a Refuge API call's time to the request."""
+
+        if has_request_context() and "upstream_ms" in g:
+            g.upstream_ms += elapsed_ms
+
+    def record(self, route, timings, query_count=None):
+        """Add one request's timings and query count to route's histograms.
+
+        timings -- dictionary of milliseconds by name in TIMINGS, missing
+                   ones aren't recorded
+        query_count -- optional - SQL statements run, not recorded if None
+        """
+
+        with self._lock:
+            histograms = self.routes.get(route)
+            if histograms is None:
+                histograms = {name: Histogram() for name in self.TIMINGS}
+                histograms["queries"] = Histogram(COUNT_BUCKETS)
+                self.routes[route] = histograms
+
+        for name, value in timings.items():
+            histograms[name].observe(value)
+        if query_count is not None:
+            histograms["queries"].observe(query_count)
+
+    def to_dict(self):
+        """Returns dictionary of each route's histograms that can be turned into JSON."""
+
+        return {route: {name: histogram.to_dict() for name, histogram in histograms.items()}
+                for route, histograms in self.routes.items()}
+
+    def to_prometheus(self):
+        """Returns every route's histograms in Prometheus text exposition format."""
+
+        lines = []
+        for name in self.TIMINGS + ("queries",):
+            metric = f"crapp_request_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for route, histograms in sorted(self.routes.items()):
+                method, rule = route.split(" ", 1)
+                lines.extend(histograms[name].to_prometheus(metric, {"method": method,
+                                                                      "route": rule}))
+
+        return "\n".join(lines) + "\n"
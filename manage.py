@@ -0,0 +1,130 @@
+"""Command line maintenance tasks for the crapp database.
+
+Usage: python manage.py <command>, see python manage.py --help
+"""
+
+import argparse
+import sys
+
+from datetime import datetime
+
+from export import EXPORT_FORMATS, EXPORT_TABLES, generate_export
+from migrate import apply_migrations
+from model import (connect_to_db, db, merge_duplicate_bathrooms, rebuild_bathroom_stats,
+                   rebuild_checkin_counters)
+from server import app, forget_bathroom_pages
+from sync import sync_bathrooms
+
+
+def rebuild_stats(args):
+    """Recompute rating stats for every bathroom."""
+
+    count = rebuild_bathroom_stats()
+    print(f"Rebuilt rating stats for {count} bathrooms")
+
+
+def rebuild_trending(args):
+    """Recompute busyness and trending checkin counters for every bathroom."""
+
+    count = rebuild_checkin_counters()
+    print(f"Rebuilt {count} checkin counters")
+
+
+def export(args):
+    """Stream bathrooms, checkins or ratings to a file as NDJSON or CSV."""
+
+    bounds = tuple(args.bounds) if args.bounds else None
+    chunks = generate_export(args.table, args.format, gzip=args.gzip, start=args.start,
+                             end=args.end, bounds=bounds, state=args.state)
+
+    if args.output == "-":
+        output_file = sys.stdout.buffer if args.gzip else sys.stdout
+    else:
+        output_file = open(args.output, "wb" if args.gzip else "w")
+    try:
+        for chunk in chunks:
+            output_file.write(chunk)
+    finally:
+        if output_file not in (sys.stdout, sys.stdout.buffer):
+            output_file.close()
+
+
+def sync(args):
+    """Apply bathrooms the Refuge API changed since the last sync."""
+
+    # Only reaches the web workers' page caches with CRAPP_CACHE_URL set
+    totals = sync_bathrooms(since=args.since, on_change=forget_bathroom_pages)
+    print(f"Inserted {totals['inserted']}, updated {totals['updated']}, "
+          f"unchanged {totals['unchanged']}, skipped {totals['skipped']} duplicate bathrooms, "
+          f"watermark now {totals['watermark']}")
+
+
+def dedupe(args):
+    """Merge bathrooms listed more than once at nearly the same spot."""
+
+    # Only reaches the web workers' page caches with CRAPP_CACHE_URL set
+    count = merge_duplicate_bathrooms(on_merge=forget_bathroom_pages)
+    print(f"Merged {count} duplicate bathrooms")
+
+
+def migrate(args):
+    """Apply database migrations not applied yet (PostgreSQL)."""
+
+    versions = apply_migrations(dry_run=args.dry_run)
+    if args.dry_run:
+        print("\n".join(versions) or "Nothing to apply")
+    else:
+        print(f"Applied {len(versions)} migrations")
+
+
+def get_date(value):
+    """Returns datetime parsed from a YYYY-MM-DD argument."""
+
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="crApp maintenance tasks.")
+    parser.add_argument("--database", default="postgresql:///crapp",
+                        help="database URI to connect to")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    rebuild_stats_parser = commands.add_parser("rebuild-stats", help=rebuild_stats.__doc__)
+    rebuild_stats_parser.set_defaults(run=rebuild_stats)
+
+    rebuild_trending_parser = commands.add_parser("rebuild-trending", help=rebuild_trending.__doc__)
+    rebuild_trending_parser.set_defaults(run=rebuild_trending)
+
+    export_parser = commands.add_parser("export", help=export.__doc__)
+    export_parser.add_argument("table", choices=EXPORT_TABLES)
+    export_parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="ndjson")
+    export_parser.add_argument("--output", default="-", help="file to write, - for stdout")
+    export_parser.add_argument("--gzip", action="store_true")
+    export_parser.add_argument("--start", type=get_date, help="first date (YYYY-MM-DD)")
+    export_parser.add_argument("--end", type=get_date, help="date to stop before (YYYY-MM-DD)")
+    export_parser.add_argument("--bounds", type=float, nargs=4,
+                               metavar=("SOUTH", "WEST", "NORTH", "EAST"))
+    export_parser.add_argument("--state", help="only bathrooms in this state")
+    export_parser.set_defaults(run=export)
+
+    sync_parser = commands.add_parser("sync", help=sync.__doc__)
+    sync_parser.add_argument("--since", type=get_date,
+                             help="sync from this date (YYYY-MM-DD) instead of the last watermark")
+    sync_parser.set_defaults(run=sync)
+
+    dedupe_parser = commands.add_parser("dedupe", help=dedupe.__doc__)
+    dedupe_parser.set_defaults(run=dedupe)
+
+    migrate_parser = commands.add_parser("migrate", help=migrate.__doc__)
+    migrate_parser.add_argument("--dry-run", action="store_true",
+                                help="only list migrations that would be applied")
+    migrate_parser.set_defaults(run=migrate)
+
+    args = parser.parse_args()
+
+    connect_to_db(app, args.database)
+    # In case tables haven't been created, create them (migrations make their own)
+    if args.run is not migrate:
+        db.create_all()
+    args.run(args)
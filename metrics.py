@@ -0,0 +1,88 @@
+"""In-process metrics (latency histograms) for crApp."""
+
+import bisect
+import threading
+
+# Default histogram bucket upper bounds, in milliseconds
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Bucket upper bounds for counts, ex queries per request
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, cheap enough to record every request."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        """Initialize a Histogram object.
+
+        buckets -- sorted upper bounds of each bucket, values above the last
+                   bound go in an overflow bucket
+
+        Returns: Histogram object
+        """
+
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record one value."""
+
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+
+    def percentile(self, percent):
+        """Estimate a percentile from the buckets.
+
+        Returns upper bound of the bucket the percentile falls in (None if it
+        falls in the overflow bucket or nothing has been observed).
+        """
+
+        if not self.count:
+            return None
+
+        rank = percent / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return None
+
+    def to_dict(self):
+        """Returns dictionary of counts and summary stats that can be turned into JSON."""
+
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+                "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"],
+                                    self.counts))}
+
+    def to_prometheus(self, name, labels):
+        """Format histogram in Prometheus text exposition format.
+
+        name -- metric name, ex "crapp_request_ms"
+        labels -- dictionary of label names to values
+
+        Returns list of lines.
+        """
+
+        label_text = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+        lines = []
+        cumulative = 0
+        for bound, count in zip([str(bound) for bound in self.buckets] + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{label_text}}} {self.total}")
+        lines.append(f"{name}_count{{{label_text}}} {self.count}")
+
+        return lines
@@ -0,0 +1,107 @@
+"""Apply the SQL migrations in migrations/ to a PostgreSQL database.
+
+Migrations are numbered .sql files run in order, each one once. Applied
+ones are recorded in the schema_migrations table. Statements run one at a
+time outside a transaction, so indexes can be built CONCURRENTLY without
+locking out writes. Every statement checks before it changes anything (ex
+IF NOT EXISTS), so a migration that failed part way can simply be run
+again, and a database made by db.create_all() can be migrated too.
+
+Run with python manage.py migrate.
+"""
+
+import os
+
+from datetime import datetime
+
+from model import backfill_bathroom_geohashes, db, rebuild_bathroom_stats, rebuild_checkin_counters
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Data fixes to run after a migration is applied, by migration version
+AFTER_MIGRATION = {"0002_bathroom_sync_and_stats": (backfill_bathroom_geohashes, rebuild_bathroom_stats),
+                   "0003_indexes_and_unique_keys": (rebuild_bathroom_stats,),
+                   "0004_checkin_counters": (rebuild_checkin_counters,)}
+
+
+def get_migrations(migrations_dir=MIGRATIONS_DIR):
+    """Returns list of (version, path) tuples for every migration, in order."""
+
+    return [(file_name[:-len(".sql")], os.path.join(migrations_dir, file_name))
+            for file_name in sorted(os.listdir(migrations_dir)) if file_name.endswith(".sql")]
+
+
+def split_statements(sql):
+    """Split a migration into statements.
+
+    Statements end with a semicolon at the end of a line, -- comment lines
+    are dropped.
+
+    Returns list of statement strings.
+    """
+
+    statements = []
+    lines = []
+    for line in sql.splitlines():
+        if line.strip().startswith("--"):
+            continue
+        lines.append(line)
+        if line.rstrip().endswith(";"):
+            statements.append("\n".join(lines).strip().rstrip(";"))
+            lines = []
+
+    if "\n".join(lines).strip():
+        statements.append("\n".join(lines).strip())
+
+    return statements
+
+
+def get_applied_versions(connection):
+    """Returns set of migration versions already applied."""
+
+    connection.execute("CREATE TABLE IF NOT EXISTS schema_migrations ("
+                       "version VARCHAR(100) PRIMARY KEY, "
+                       "applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL)")
+
+    return {version for version, in connection.execute("SELECT version FROM schema_migrations")}
+
+
+def apply_migrations(migrations_dir=MIGRATIONS_DIR, dry_run=False):
+    """Apply every migration not applied yet, then their data fixes.
+
+    dry_run -- only list the migrations that would be applied
+
+    Returns list of versions applied (or to apply, for a dry run).
+    """
+
+    if db.engine.dialect.name != "postgresql":
+        raise ValueError("Migrations are for PostgreSQL, create other databases with db.create_all()")
+
+    connection = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        applied = get_applied_versions(connection)
+        pending = [(version, path) for version, path in get_migrations(migrations_dir)
+                   if version not in applied]
+        if dry_run:
+            return [version for version, path in pending]
+
+        for version, path in pending:
+            with open(path) as migration_file:
+                for statement in split_statements(migration_file.read()):
+                    connection.execute(statement)
+            connection.execute("INSERT INTO schema_migrations (version, applied_at) VALUES (%s, %s)",
+                               (version, datetime.now()))
+            print(f"Applied {version}")
+    finally:
+        connection.close()
+
+    # Each data fix once, after the schema is all there
+    after = []
+    for version, path in pending:
+        for function in AFTER_MIGRATION.get(version, ()):
+            if function not in after:
+                after.append(function)
+    for function in after:
+        function()
+
+    return [version for version, path in pending]
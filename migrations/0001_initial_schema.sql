@@ -0,0 +1,62 @@
+-- Tables as first released, before any migrations existed.
+-- Every statement checks first, so this is harmless on a database made by
+-- db.create_all().
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id SERIAL PRIMARY KEY,
+    full_name VARCHAR(70) NOT NULL,
+    password VARCHAR(64) NOT NULL,
+    email VARCHAR(256) NOT NULL,
+    gender VARCHAR(30),
+    date_of_birth DATE,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    is_premium BOOLEAN NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS bathrooms (
+    bathroom_id SERIAL PRIMARY KEY,
+    name VARCHAR(100),
+    directions VARCHAR(500),
+    notes VARCHAR(500),
+    city VARCHAR(60),
+    state VARCHAR(60),
+    country VARCHAR(60),
+    latitude NUMERIC(11, 7) NOT NULL,
+    longitude NUMERIC(11, 7) NOT NULL,
+    unisex BOOLEAN,
+    accessible BOOLEAN,
+    changing_table BOOLEAN,
+    approved BOOLEAN NOT NULL,
+    is_premium BOOLEAN NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS lists (
+    list_id SERIAL PRIMARY KEY,
+    list_name VARCHAR(32) NOT NULL,
+    user_id INTEGER REFERENCES users (user_id)
+);
+
+CREATE TABLE IF NOT EXISTS list_items (
+    list_item_id SERIAL PRIMARY KEY,
+    list_id INTEGER REFERENCES lists (list_id),
+    user_id INTEGER NOT NULL REFERENCES users (user_id),
+    bathroom_id INTEGER NOT NULL REFERENCES bathrooms (bathroom_id),
+    datetime_added TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS checkins (
+    checkin_id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (user_id),
+    bathroom_id INTEGER NOT NULL REFERENCES bathrooms (bathroom_id),
+    checkin_datetime TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    rating_id INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS ratings (
+    rating_id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users (user_id),
+    bathroom_id INTEGER NOT NULL REFERENCES bathrooms (bathroom_id),
+    checkin_id INTEGER NOT NULL REFERENCES checkins (checkin_id),
+    score INTEGER NOT NULL,
+    review_text VARCHAR(200)
+);
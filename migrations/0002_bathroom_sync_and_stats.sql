@@ -0,0 +1,28 @@
+-- Columns and tables added since the first release: geohash and Refuge sync
+-- columns on bathrooms, bathroom_stats (rating aggregates) and sync_state.
+-- After this, manage.py migrate fills in geohashes and rating stats.
+
+ALTER TABLE bathrooms ADD COLUMN IF NOT EXISTS geohash VARCHAR(12);
+ALTER TABLE bathrooms ADD COLUMN IF NOT EXISTS refuge_id INTEGER;
+ALTER TABLE bathrooms ADD COLUMN IF NOT EXISTS refuge_updated_at TIMESTAMP WITHOUT TIME ZONE;
+ALTER TABLE bathrooms ADD COLUMN IF NOT EXISTS upvotes INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE bathrooms ADD COLUMN IF NOT EXISTS downvotes INTEGER NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS bathroom_stats (
+    bathroom_id INTEGER PRIMARY KEY REFERENCES bathrooms (bathroom_id),
+    rating_count INTEGER NOT NULL,
+    score_sum INTEGER NOT NULL,
+    score_1_count INTEGER NOT NULL,
+    score_2_count INTEGER NOT NULL,
+    score_3_count INTEGER NOT NULL,
+    score_4_count INTEGER NOT NULL,
+    score_5_count INTEGER NOT NULL,
+    last_rated_at TIMESTAMP WITHOUT TIME ZONE
+);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    name VARCHAR(40) PRIMARY KEY,
+    watermark TIMESTAMP WITHOUT TIME ZONE,
+    last_run_at TIMESTAMP WITHOUT TIME ZONE,
+    last_changed_count INTEGER NOT NULL
+);
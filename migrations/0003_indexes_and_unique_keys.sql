@@ -0,0 +1,43 @@
+-- Indexes for every foreign key and lookup the app makes, and unique keys
+-- where the data model needs them. Names match what db.create_all() makes.
+-- Indexes are built CONCURRENTLY so the tables stay writable. If a build
+-- fails, drop the INVALID index it leaves (\d table shows it) and migrate again.
+
+-- Unique keys. Uniqueness is enforced by unique indexes, which is all
+-- INSERT ... ON CONFLICT needs.
+
+-- Fails if bathrooms share a lat-long, merge them with python manage.py
+-- dedupe and migrate again
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS bathrooms_lat_long_key ON bathrooms (latitude, longitude);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS bathrooms_refuge_id_key ON bathrooms (refuge_id);
+
+-- Fails if users share an email, find them with
+-- SELECT email FROM users GROUP BY email HAVING count(*) > 1;
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_email_key ON users (email);
+
+-- A user adds a bathroom to a list once, drop repeats first
+DELETE FROM list_items later USING list_items earlier
+ WHERE later.list_id = earlier.list_id AND later.user_id = earlier.user_id
+   AND later.bathroom_id = earlier.bathroom_id AND later.list_item_id > earlier.list_item_id;
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS list_items_list_id_user_id_bathroom_id_key ON list_items (list_id, user_id, bathroom_id);
+
+-- One rating per checkin, keep the first of any resubmitted ones (stats are
+-- rebuilt after)
+DELETE FROM ratings later USING ratings earlier
+ WHERE later.checkin_id = earlier.checkin_id AND later.rating_id > earlier.rating_id;
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ratings_checkin_id_key ON ratings (checkin_id);
+
+-- Nearby searches (geohash prefix ranges), syncs and snapshot refreshes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bathrooms_geohash ON bathrooms (geohash);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bathrooms_refuge_updated_at ON bathrooms (refuge_updated_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bathroom_stats_last_rated_at ON bathroom_stats (last_rated_at);
+
+-- Foreign keys, user hub pages and exports by date
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_lists_user_id ON lists (user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_list_items_user_id ON list_items (user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_list_items_bathroom_id ON list_items (bathroom_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_checkins_user_id_checkin_datetime ON checkins (user_id, checkin_datetime);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_checkins_bathroom_id ON checkins (bathroom_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_checkins_checkin_datetime ON checkins (checkin_datetime);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ratings_user_id ON ratings (user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ratings_bathroom_id ON ratings (bathroom_id);
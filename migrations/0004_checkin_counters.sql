@@ -0,0 +1,14 @@
+-- checkin_counters: per bathroom checkin counts by hour, day and hour of the
+-- week, for busyness and trending. After this, manage.py migrate backfills
+-- them from checkins (same as python manage.py rebuild-trending).
+
+CREATE TABLE IF NOT EXISTS checkin_counters (
+    bathroom_id INTEGER NOT NULL REFERENCES bathrooms (bathroom_id),
+    kind VARCHAR(10) NOT NULL,
+    slot INTEGER NOT NULL,
+    bucket_start TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    checkin_count INTEGER NOT NULL,
+    PRIMARY KEY (bathroom_id, kind, slot)
+);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_checkin_counters_kind_bucket_start ON checkin_counters (kind, bucket_start);
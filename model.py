@@ -1,20 +1,61 @@
 """Models and database functions for crApp."""
 
-import requests
+import math
+import secrets
+import string
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import joinedload
+from datetime import datetime, timedelta
+from decimal import Decimal
+from refuge import refuge_client
+from replicas import RoutingSQLAlchemy, get_replica_binds
+from dedupe import DUPLICATE_METERS, METERS_PER_DEGREE_LAT, DuplicateGrid, get_grid_entry
+from geo import (bearing_degrees, geohash_bounds, geohash_cells_in_box, geohash_center,
+                 geohash_encode, geohash_prefix_end, haversine_miles)
+
+# Establish connection to the PostgreSQL database, reads can be routed to
+# replicas (see replicas.py)
+db = RoutingSQLAlchemy()
+
+# Characters used in generated initial passwords
+PASSWORD_CHARACTER_SETS = (string.ascii_lowercase, string.ascii_uppercase,
+                           string.digits, "!@#$%^&*()_+")
 
-from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime 
-from faker import Faker
-from faker.providers import misc
+# TODO: use bcrypt to encrypt user passwords before adding real users
 
-# Establish connection to the PostgreSQL database
-db = SQLAlchemy()
+# Fewest local bathrooms near a tile before falling back to the Refuge API
+MIN_LOCAL_RESULTS = 10
 
-# Set up Faker object to generate fake initial passwords for users
-fake = Faker()
-fake.add_provider(misc)
+# Scores a Rating can give
+SCORES = (1, 2, 3, 4, 5)
 
-# TODO: use bcrypt to encrypt user passwords before adding real users
+# Hours and days of checkin counts kept per bathroom (see CheckinCounter)
+HOUR_SLOTS = 7 * 24
+DAY_SLOTS = 28
+
+# Counter slots are numbered from here
+COUNTER_EPOCH = datetime(1970, 1, 1)
+
+# SyncState row whose last_run_at is when bathrooms were last deleted
+BATHROOM_DELETIONS = "bathroom_deletions"
+
+
+def generate_password(length=10):
+    """Generate a random initial password with lower and upper case letters,
+    digits and special characters.
+
+    Returns password string.
+    """
+
+    # One character from each set, the rest from any set, then shuffle
+    rand = secrets.SystemRandom()
+    characters = [rand.choice(character_set) for character_set in PASSWORD_CHARACTER_SETS]
+    all_characters = "".join(PASSWORD_CHARACTER_SETS)
+    characters += [rand.choice(all_characters) for i in range(length - len(characters))]
+    rand.shuffle(characters)
+
+    return "".join(characters)
 
 ##################################################################
 # Model definitions
@@ -27,7 +68,8 @@ class User(db.Model):
     user_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     full_name = db.Column(db.String(70), nullable=False)
     password = db.Column(db.String(64), nullable=False)
-    email = db.Column(db.String(256), nullable=False)
+    # Unique, registering again with the same email logs in instead
+    email = db.Column(db.String(256), nullable=False, unique=True)
     gender = db.Column(db.String(30), nullable=True)
     date_of_birth = db.Column(db.Date, nullable=True)
     created_at = db.Column(db.DateTime, nullable=False)
@@ -56,8 +98,7 @@ class User(db.Model):
         if password:
             self.password = password
         else:
-            self.password = fake.password(length=10, special_chars=True, digits=True, 
-                                          upper_case=True, lower_case=True) 
+            self.password = generate_password()
 
     def __repr__(self):
         """Provide helpful User representation when printed."""
@@ -68,6 +109,7 @@ class Bathroom(db.Model):
     """Bathroom on crApp website."""
 
     __tablename__ = "bathrooms"
+    __table_args__ = (db.UniqueConstraint("latitude", "longitude", name="bathrooms_lat_long_key"),)
 
     bathroom_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     name = db.Column(db.String(100), nullable=True)
@@ -83,6 +125,13 @@ class Bathroom(db.Model):
     changing_table = db.Column(db.Boolean, nullable=True)
     approved = db.Column(db.Boolean, nullable=False)
     is_premium = db.Column(db.Boolean, default=False, nullable=False)
+    # Geohash of lat-long, B-tree indexed so nearby bathrooms are a prefix range scan
+    geohash = db.Column(db.String(12), nullable=True, index=True)
+    # Refuge API's id and last update time, for delta syncs (see sync.py)
+    refuge_id = db.Column(db.Integer, nullable=True, unique=True)
+    refuge_updated_at = db.Column(db.DateTime, nullable=True, index=True)
+    upvotes = db.Column(db.Integer, default=0, nullable=False)
+    downvotes = db.Column(db.Integer, default=0, nullable=False)
 
     # Define relationships
     checkins = db.relationship("Checkin", backref=db.backref("bathroom"))
@@ -91,7 +140,8 @@ class Bathroom(db.Model):
 
     def __init__(self, latitude, longitude, name=None, directions=None, notes=None, city=None, 
                  state=None, country=None, unisex=None, accessible=None, changing_table=None, 
-                 approved=False, is_premium=False):
+                 approved=False, is_premium=False, refuge_id=None, refuge_updated_at=None,
+                 upvotes=0, downvotes=0):
         """Initialize a Bathroom object.
 
         name -- optional - name of building/location of bathroom
@@ -104,12 +154,17 @@ class Bathroom(db.Model):
         changing_table -- optional boolean - true is there is a changing table
         approved -- boolean - true if bathroom has been approved by admin
         is_premium -- for future use with VIPee program
+        refuge_id -- optional - bathroom's id in the Refuge API
+        refuge_updated_at -- optional - datetime Refuge API last changed it
+        upvotes, downvotes -- optional - Refuge API vote counts
 
         Returns: Bathroom object
         """
 
         self.latitude = latitude
         self.longitude = longitude
+        if latitude is not None and longitude is not None:
+            self.geohash = geohash_encode(latitude, longitude, 12)
         if name:
             self.name = name
         if directions:
@@ -132,6 +187,12 @@ class Bathroom(db.Model):
             self.approved = approved
         if is_premium:
             self.is_premium = is_premium
+        if refuge_id:
+            self.refuge_id = refuge_id
+        if refuge_updated_at:
+            self.refuge_updated_at = refuge_updated_at
+        self.upvotes = upvotes or 0
+        self.downvotes = downvotes or 0
 
     def __repr__(self):
         """Provide helpful Bathroom representation with printed."""
@@ -141,6 +202,9 @@ class Bathroom(db.Model):
  
     def in_database(self):
         """Use Bathroom object lat-long to see if it's already in the database.
+
+        Only finds exact lat-long matches, add_bathrooms_to_db also catches
+        near-duplicates (see dedupe.py).
         
         Returns boolean - true if Bathroom's lat-long in database, false if not
         """
@@ -152,6 +216,67 @@ class Bathroom(db.Model):
         else: 
             return False
 
+    def to_dict(self, distance=None, bearing=None):
+        """Make dictionary of Bathroom with the same fields Refuge API returns.
+
+        distance -- optional - miles from the lat-long that was searched
+        bearing -- optional - degrees from the lat-long that was searched
+
+        Returns dictionary that can be turned into JSON.
+        """
+
+        bathroom_dict = {"id": self.bathroom_id,
+                         "bathroom_id": self.bathroom_id,
+                         "name": self.name,
+                         "directions": self.directions,
+                         "comment": self.notes,
+                         "city": self.city,
+                         "state": self.state,
+                         "country": self.country,
+                         "latitude": float(self.latitude),
+                         "longitude": float(self.longitude),
+                         "accessible": bool(self.accessible),
+                         "unisex": bool(self.unisex),
+                         "changing_table": bool(self.changing_table),
+                         "approved": bool(self.approved),
+                         "upvote": self.upvotes or 0,
+                         "downvote": self.downvotes or 0}
+
+        # Rating stats are precomputed, see BathroomStats
+        if self.stats:
+            bathroom_dict["rating_count"] = self.stats.rating_count
+            bathroom_dict["average_score"] = self.stats.mean_score
+        else:
+            bathroom_dict["rating_count"] = 0
+            bathroom_dict["average_score"] = None
+
+        if distance is not None:
+            bathroom_dict["distance"] = distance
+        if bearing is not None:
+            # Refuge API sends bearing as a string
+            bathroom_dict["bearing"] = str(bearing)
+
+        return bathroom_dict
+
+    def to_row(self):
+        """Make dictionary of Bathroom's column values for a bulk insert.
+
+        Column defaults are filled in, since bulk inserts skip the ORM.
+
+        Returns dictionary keyed by column name, without bathroom_id.
+        """
+
+        row = {}
+        for column in Bathroom.__table__.columns:
+            if column.key == "bathroom_id":
+                continue
+            value = getattr(self, column.key)
+            if value is None and column.default is not None:
+                value = column.default.arg
+            row[column.key] = value
+
+        return row
+
 class NamedList(db.Model):
     """Named lists for users to add bathrooms to (fave, least fave, etc)."""
 
@@ -159,7 +284,7 @@ class NamedList(db.Model):
 
     list_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     list_name = db.Column(db.String(32), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=True, index=True)
 
     # Define relationship
     list_items = db.relationship("ListItem", backref=db.backref("named_list"))
@@ -189,11 +314,14 @@ class ListItem(db.Model):
     """ListItems - bathrooms, user, named list they've been put on."""
 
     __tablename__ = "list_items"
+    # A user adds a bathroom to a list once, the index also finds a list's items
+    __table_args__ = (db.UniqueConstraint("list_id", "user_id", "bathroom_id",
+                                          name="list_items_list_id_user_id_bathroom_id_key"),)
 
     list_item_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     list_id = db.Column(db.Integer, db.ForeignKey('lists.list_id'))
-    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
-    bathroom_id = db.Column(db.Integer, db.ForeignKey('bathrooms.bathroom_id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False, index=True)
+    bathroom_id = db.Column(db.Integer, db.ForeignKey('bathrooms.bathroom_id'), nullable=False, index=True)
     datetime_added = db.Column(db.DateTime, nullable=False)
 
     def __init__(self, list_id, user_id, bathroom_id):
@@ -218,11 +346,14 @@ class Checkin(db.Model):
     """Checkins when a user visits a bathroom."""
 
     __tablename__ = "checkins"
+    # A user's checkins newest first (user hub), also finds them by user_id
+    __table_args__ = (db.Index("ix_checkins_user_id_checkin_datetime", "user_id", "checkin_datetime"),)
 
     checkin_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
-    bathroom_id = db.Column(db.Integer, db.ForeignKey('bathrooms.bathroom_id'), nullable=False)
-    checkin_datetime = db.Column(db.DateTime, nullable=False)
+    bathroom_id = db.Column(db.Integer, db.ForeignKey('bathrooms.bathroom_id'), nullable=False, index=True)
+    # Indexed for exports by date range
+    checkin_datetime = db.Column(db.DateTime, nullable=False, index=True)
     rating_id = db.Column(db.Integer, nullable=True)
 
     rating = db.relationship("Rating", uselist=False)
@@ -250,9 +381,10 @@ class Rating(db.Model):
     __tablename__ = "ratings"
 
     rating_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
-    bathroom_id = db.Column(db.Integer, db.ForeignKey('bathrooms.bathroom_id'), nullable=False)
-    checkin_id = db.Column(db.Integer, db.ForeignKey('checkins.checkin_id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False, index=True)
+    bathroom_id = db.Column(db.Integer, db.ForeignKey('bathrooms.bathroom_id'), nullable=False, index=True)
+    # One rating per checkin
+    checkin_id = db.Column(db.Integer, db.ForeignKey('checkins.checkin_id'), nullable=False, unique=True)
     score = db.Column(db.Integer, nullable=False)
     review_text = db.Column(db.String(200), nullable=True)
 
@@ -269,26 +401,459 @@ class Rating(db.Model):
 
         return f"<Rating id={self.rating_id} user={self.user_id} bathroom={self.bathroom_id} checkin={self.checkin_id} score={self.score}>"
 
+class BathroomStats(db.Model):
+    """Rating stats for a bathroom, updated as each rating is added."""
+
+    __tablename__ = "bathroom_stats"
+
+    bathroom_id = db.Column(db.Integer, db.ForeignKey('bathrooms.bathroom_id'), primary_key=True)
+    rating_count = db.Column(db.Integer, default=0, nullable=False)
+    score_sum = db.Column(db.Integer, default=0, nullable=False)
+    # Histogram of scores, one column per possible score
+    score_1_count = db.Column(db.Integer, default=0, nullable=False)
+    score_2_count = db.Column(db.Integer, default=0, nullable=False)
+    score_3_count = db.Column(db.Integer, default=0, nullable=False)
+    score_4_count = db.Column(db.Integer, default=0, nullable=False)
+    score_5_count = db.Column(db.Integer, default=0, nullable=False)
+    # Indexed so snapshot refreshes find newly rated bathrooms
+    last_rated_at = db.Column(db.DateTime, nullable=True, index=True)
+
+    # Define relationship
+    bathroom = db.relationship("Bathroom", backref=db.backref("stats", uselist=False))
+
+    def __repr__(self):
+        """Provide helpful BathroomStats representation when printed."""
+
+        return f"<BathroomStats bathroom={self.bathroom_id} count={self.rating_count} mean={self.mean_score}>"
+
+    @property
+    def mean_score(self):
+        """Average score, None if bathroom hasn't been rated."""
+
+        if not self.rating_count:
+            return None
+
+        return self.score_sum / self.rating_count
+
+    @property
+    def histogram(self):
+        """List of how many ratings gave each score, from 1 to 5."""
+
+        return [getattr(self, f"score_{score}_count") for score in SCORES]
+
+    def to_dict(self):
+        """Returns dictionary of stats that can be turned into JSON."""
+
+        return {"bathroom_id": self.bathroom_id,
+                "rating_count": self.rating_count,
+                "average_score": self.mean_score,
+                "histogram": self.histogram,
+                "last_rated_at": self.last_rated_at.isoformat() if self.last_rated_at else None}
+
+class SyncState(db.Model):
+    """Progress of a repeating sync job, so each run picks up where the last left off."""
+
+    __tablename__ = "sync_state"
+
+    name = db.Column(db.String(40), primary_key=True)
+    # Newest upstream update time applied so far
+    watermark = db.Column(db.DateTime, nullable=True)
+    last_run_at = db.Column(db.DateTime, nullable=True)
+    last_changed_count = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful SyncState representation when printed."""
+
+        return f"<SyncState name={self.name} watermark={self.watermark}>"
+
+class CheckinCounter(db.Model):
+    """Checkins at a bathroom in one hour, one day or one hour of the week.
+
+    "hour" and "day" counters are ring buffers of HOUR_SLOTS and DAY_SLOTS
+    slots per bathroom, so they never grow: a slot counts the hour or day
+    starting at bucket_start, and is started over when a checkin from a
+    newer hour or day lands in it. "profile" counters (slot is weekday * 24
+    + hour) count every checkin ever, bucket_start is the first one's hour.
+    """
+
+    __tablename__ = "checkin_counters"
+    # Trending reads every bathroom's day counters since a date
+    __table_args__ = (db.Index("ix_checkin_counters_kind_bucket_start", "kind", "bucket_start"),)
+
+    bathroom_id = db.Column(db.Integer, db.ForeignKey('bathrooms.bathroom_id'), primary_key=True)
+    kind = db.Column(db.String(10), primary_key=True)
+    slot = db.Column(db.Integer, primary_key=True)
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    checkin_count = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful CheckinCounter representation when printed."""
+
+        return (f"<CheckinCounter bathroom={self.bathroom_id} {self.kind}={self.slot} "
+                f"start={self.bucket_start} count={self.checkin_count}>")
+
 #################################################################
 # Helper functions
 
-def connect_to_db(app, database='postgresql:///crapp'):
-    """Connect a database to flask app."""
+def connect_to_db(app, database='postgresql:///crapp', replicas=(), pool_size=None,
+                  max_overflow=None, pool_recycle=None, pool_timeout=None):
+    """Connect a database to flask app.
+
+    replicas -- URIs of read replicas of database, bound as replica_1,
+                replica_2, ... for a replicas.ReplicaRouter to send reads to
+    pool_size, max_overflow, pool_recycle, pool_timeout -- connection pool
+                settings for database and each replica, SQLAlchemy's
+                defaults if None
+    """
 
     # Configure to use PostgreSQL db or whatever db is passed in
     app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app.config['SQLALCHEMY_BINDS'] = get_replica_binds(replicas) or None
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_POOL_SIZE'] = pool_size
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = max_overflow
+    app.config['SQLALCHEMY_POOL_RECYCLE'] = pool_recycle
+    app.config['SQLALCHEMY_POOL_TIMEOUT'] = pool_timeout
     db.app = app
     db.init_app(app)
 
+def get_geohash_prefix_filter(cell):
+    """Returns filter for bathrooms in a geohash cell, a range scan on the geohash index."""
+
+    end = geohash_prefix_end(cell)
+    if end is None:
+        return Bathroom.geohash >= cell
+
+    return db.and_(Bathroom.geohash >= cell, Bathroom.geohash < end)
+
+def get_geohash_cells_covering(latitude, longitude, radius_miles):
+    """Get geohash cells that together cover a circle around a lat-long.
+
+    Uses the smallest cells at least as big as the radius, so the circle always
+    fits inside the cell the lat-long is in plus its 8 neighbors.
+
+    Returns set of geohash strings.
+    """
+
+    # Shorten geohash until the cell is taller and wider than the radius
+    for precision in range(8, 0, -1):
+        center_cell = geohash_encode(latitude, longitude, precision)
+        south, west, north, east = geohash_bounds(center_cell)
+        height_miles = haversine_miles(south, west, north, west)
+        width_miles = haversine_miles(latitude, west, latitude, east)
+        if min(height_miles, width_miles) >= radius_miles:
+            break
+
+    cell_lat, cell_long = geohash_center(center_cell)
+    height = north - south
+    width = east - west
+
+    cells = set()
+    for lat_step in (-1, 0, 1):
+        for long_step in (-1, 0, 1):
+            neighbor_lat = min(max(cell_lat + lat_step * height, -89.999999), 89.999999)
+            neighbor_long = (cell_long + long_step * width + 180) % 360 - 180
+            cells.add(geohash_encode(neighbor_lat, neighbor_long, precision))
+
+    return cells
+
+def find_nearby_bathrooms(latitude, longitude, limit=30, radius_miles=1.0):
+    """Find the closest bathrooms in the database to a lat-long.
+
+    limit -- most bathrooms returned
+    radius_miles -- only bathrooms within this distance are returned
+
+    Returns list of bathroom dictionaries (see Bathroom.to_dict) with distance
+    and bearing, sorted closest first.
+    """
+
+    # Each covering cell is a range scan on the geohash index
+    cells = get_geohash_cells_covering(latitude, longitude, radius_miles)
+    cell_filters = [get_geohash_prefix_filter(cell) for cell in cells]
+    candidates = (Bathroom.query.filter(db.or_(*cell_filters))
+                                .options(joinedload(Bathroom.stats))
+                                .all())
+
+    nearby = []
+    for bathroom in candidates:
+        distance = haversine_miles(latitude, longitude, bathroom.latitude, bathroom.longitude)
+        if distance <= radius_miles:
+            nearby.append((distance, bathroom))
+    nearby.sort(key=lambda pair: pair[0])
+
+    return [bathroom.to_dict(distance=distance,
+                             bearing=bearing_degrees(latitude, longitude,
+                                                     bathroom.latitude, bathroom.longitude))
+            for distance, bathroom in nearby[:limit]]
+
+def backfill_bathroom_geohashes():
+    """Set geohash for bathrooms added before the geohash column existed."""
+
+    for bathroom in Bathroom.query.filter(Bathroom.geohash.is_(None)):
+        bathroom.geohash = geohash_encode(bathroom.latitude, bathroom.longitude, 12)
+    db.session.commit()
+
+def record_rating(rating):
+    """Add a new rating to its bathroom's BathroomStats.
+
+    Call before committing the rating, so stats are updated in the same
+    transaction. Counters are incremented in the database, so ratings
+    committed at the same time don't overwrite each other.
+    """
+
+    score = int(rating.score)
+    bathroom_id = int(rating.bathroom_id)
+    table = BathroomStats.__table__
+    increments = {"rating_count": table.c.rating_count + 1,
+                  "score_sum": table.c.score_sum + score,
+                  f"score_{score}_count": table.c[f"score_{score}_count"] + 1,
+                  "last_rated_at": datetime.now()}
+
+    if db.engine.dialect.name == "postgresql":
+        # Insert first stats row or increment existing one in one statement
+        first_stats = {"bathroom_id": bathroom_id, "rating_count": 1, "score_sum": score,
+                       "last_rated_at": increments["last_rated_at"]}
+        first_stats.update({f"score_{other}_count": int(other == score) for other in SCORES})
+        db.session.execute(postgresql.insert(table).values(first_stats)
+                                     .on_conflict_do_update(index_elements=["bathroom_id"],
+                                                            set_=increments))
+        return
+
+    updated = db.session.execute(table.update()
+                                      .where(table.c.bathroom_id == bathroom_id)
+                                      .values(increments))
+    if not updated.rowcount:
+        stats = BathroomStats(bathroom_id=bathroom_id, rating_count=1, score_sum=score,
+                              last_rated_at=increments["last_rated_at"])
+        for other in SCORES:
+            setattr(stats, f"score_{other}_count", int(other == score))
+        db.session.add(stats)
+
+def rebuild_bathroom_stats():
+    """Recompute every BathroomStats row from the ratings table.
+
+    Used to backfill stats for ratings made before BathroomStats existed, or
+    to repair them. Ratings have no timestamp of their own, so last_rated_at
+    is taken from the latest rated checkin.
+
+    On PostgreSQL the stats table is locked against writes first. Ratings
+    update their stats in the transaction that inserts them (see
+    record_rating), so ones committed before the lock are in the counts
+    read here and ones still being made wait and add theirs after. Other
+    databases (ex sqlite in development) should only be rebuilt while
+    nobody is rating.
+
+    Returns number of bathrooms with stats.
+    """
+
+    if db.engine.dialect.name == "postgresql":
+        # Readers can still read the old stats meanwhile
+        db.session.execute("LOCK TABLE bathroom_stats IN EXCLUSIVE MODE")
+
+    aggregates = [Rating.bathroom_id,
+                  db.func.count(Rating.rating_id),
+                  db.func.sum(Rating.score)]
+    aggregates += [db.func.sum(db.case([(Rating.score == score, 1)], else_=0)) for score in SCORES]
+    aggregates.append(db.func.max(Checkin.checkin_datetime))
+    select = (db.select(aggregates)
+                .select_from(Rating.__table__.outerjoin(Checkin.__table__,
+                                                       Rating.checkin_id == Checkin.checkin_id))
+                .group_by(Rating.bathroom_id))
+
+    columns = ["bathroom_id", "rating_count", "score_sum"]
+    columns += [f"score_{score}_count" for score in SCORES]
+    columns.append("last_rated_at")
+
+    # Replace all rows in one transaction so readers never see partial stats
+    BathroomStats.query.delete()
+    db.session.execute(BathroomStats.__table__.insert().from_select(columns, select))
+    db.session.commit()
+
+    return BathroomStats.query.count()
+
+def get_counter_keys(checkin_datetime):
+    """Find the CheckinCounters a checkin is counted in.
+
+    Returns list of (kind, slot, bucket_start) tuples.
+    """
+
+    hour = checkin_datetime.replace(minute=0, second=0, microsecond=0)
+    day = hour.replace(hour=0)
+    hours = int((hour - COUNTER_EPOCH).total_seconds()) // 3600
+
+    return [("hour", hours % HOUR_SLOTS, hour),
+            ("day", (day - COUNTER_EPOCH).days % DAY_SLOTS, day),
+            ("profile", hour.weekday() * 24 + hour.hour, hour)]
+
+def add_counter_value(values, key, bucket_start, count):
+    """Add count checkins from bucket_start to a (bathroom_id, kind, slot) key's value.
+
+    Ring buffer slots keep the newest bucket only, profile slots add up and
+    keep the oldest.
+    """
+
+    value = values.get(key)
+    if value is None:
+        values[key] = [bucket_start, count]
+    elif key[1] == "profile":
+        value[0] = min(value[0], bucket_start)
+        value[1] += count
+    elif value[0] == bucket_start:
+        value[1] += count
+    elif value[0] < bucket_start:
+        values[key] = [bucket_start, count]
+
+def record_checkins(rows, commit=True):
+    """Count newly inserted checkins in their bathrooms' CheckinCounters.
+
+    rows -- dictionaries with bathroom_id and checkin_datetime, ex the
+            checkin queue's rows
+    commit -- False to leave committing to the caller, ex so counters are
+              bumped in the same transaction that inserts the checkins
+
+    Counters are incremented in the database, so workers recording at the
+    same time don't overwrite each other.
+    """
+
+    values = {}
+    for row in rows:
+        for kind, slot, bucket_start in get_counter_keys(row["checkin_datetime"]):
+            add_counter_value(values, (row["bathroom_id"], kind, slot), bucket_start, 1)
+    if not values:
+        return
+
+    # Same order in every worker, so their row locks can't deadlock
+    keys = sorted(values)
+    table = CheckinCounter.__table__
+
+    if db.engine.dialect.name == "postgresql":
+        for kinds in (("hour", "day"), ("profile",)):
+            counters = [{"bathroom_id": bathroom_id, "kind": kind, "slot": slot,
+                         "bucket_start": values[(bathroom_id, kind, slot)][0],
+                         "checkin_count": values[(bathroom_id, kind, slot)][1]}
+                        for bathroom_id, kind, slot in keys if kind in kinds]
+            if not counters:
+                continue
+            insert = postgresql.insert(table).values(counters)
+            if kinds == ("profile",):
+                increments = {"checkin_count": table.c.checkin_count + insert.excluded.checkin_count,
+                              "bucket_start": db.func.least(table.c.bucket_start,
+                                                            insert.excluded.bucket_start)}
+            else:
+                # Same hour or day adds up, a newer one starts the slot over, an older one is too old
+                increments = {"checkin_count": db.case([(table.c.bucket_start == insert.excluded.bucket_start,
+                                                         table.c.checkin_count + insert.excluded.checkin_count),
+                                                        (table.c.bucket_start < insert.excluded.bucket_start,
+                                                         insert.excluded.checkin_count)],
+                                                       else_=table.c.checkin_count),
+                              "bucket_start": db.func.greatest(table.c.bucket_start,
+                                                               insert.excluded.bucket_start)}
+            db.session.execute(insert.on_conflict_do_update(index_elements=["bathroom_id", "kind", "slot"],
+                                                            set_=increments))
+        if commit:
+            db.session.commit()
+        return
+
+    # Not flushing before each lookup, new counters are all inserted at the commit
+    with db.session.no_autoflush:
+        for key in keys:
+            bucket_start, count = values[key]
+            counter = CheckinCounter.query.get(key)
+            if counter is None:
+                db.session.add(CheckinCounter(bathroom_id=key[0], kind=key[1], slot=key[2],
+                                              bucket_start=bucket_start, checkin_count=count))
+                continue
+            current = {key: [counter.bucket_start, counter.checkin_count]}
+            add_counter_value(current, key, bucket_start, count)
+            counter.bucket_start, counter.checkin_count = current[key]
+    if commit:
+        db.session.commit()
+
+def rebuild_checkin_counters(now=None):
+    """Recompute every CheckinCounter from the checkins table.
+
+    Used to backfill counters for checkins made before CheckinCounter
+    existed, or to repair them. Ring buffers get the last HOUR_SLOTS hours
+    and DAY_SLOTS days before now, profiles every checkin.
+
+    On PostgreSQL the counters table is locked against writes first.
+    Checkins are counted in the transaction that inserts them, so ones
+    committed before the lock are in the counts read here and ones still
+    being inserted wait and add theirs after. Other databases (ex sqlite
+    in development) should only be rebuilt with the checkin queue drained.
+
+    Returns number of counters.
+    """
+
+    if db.engine.dialect.name == "postgresql":
+        # Readers (busyness, trending) can still read the old counters meanwhile
+        db.session.execute("LOCK TABLE checkin_counters IN EXCLUSIVE MODE")
+
+    now = now or datetime.now()
+    first_hour = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=HOUR_SLOTS - 1)
+    first_day = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=DAY_SLOTS - 1)
+
+    values = {}
+    recent = (db.session.query(Checkin.bathroom_id, Checkin.checkin_datetime)
+                        .filter(Checkin.checkin_datetime >= first_day)
+                        .yield_per(10000))
+    for bathroom_id, checkin_datetime in recent:
+        for kind, slot, bucket_start in get_counter_keys(checkin_datetime)[:2]:
+            if bucket_start >= first_hour or kind == "day":
+                add_counter_value(values, (bathroom_id, kind, slot), bucket_start, 1)
+
+    # Profiles add up every checkin ever, so let the database count them (dow 0 is Sunday)
+    weekday = db.extract("dow", Checkin.checkin_datetime)
+    hour = db.extract("hour", Checkin.checkin_datetime)
+    profiles = (db.session.query(Checkin.bathroom_id, weekday, hour, db.func.count(Checkin.checkin_id),
+                                 db.func.min(Checkin.checkin_datetime))
+                          .group_by(Checkin.bathroom_id, weekday, hour))
+    for bathroom_id, weekday, hour, count, first_checkin in profiles:
+        slot = (int(weekday) + 6) % 7 * 24 + int(hour)
+        add_counter_value(values, (bathroom_id, "profile", slot),
+                          first_checkin.replace(minute=0, second=0, microsecond=0), count)
+
+    rows = [{"bathroom_id": bathroom_id, "kind": kind, "slot": slot, "bucket_start": bucket_start,
+             "checkin_count": count}
+            for (bathroom_id, kind, slot), (bucket_start, count) in values.items()]
+
+    # Replace all rows in one transaction so readers never see partial counters
+    CheckinCounter.query.delete()
+    for start in range(0, len(rows), 10000):
+        db.session.execute(CheckinCounter.__table__.insert(), rows[start:start + 10000])
+    db.session.commit()
+
+    return len(rows)
+
 def get_bathrooms_by_lat_long(latitude, longitude):
     """Makes Refuge API call for bathrooms near that lat-long.
         
-   Returns Response object. 
+   Returns Response object, raises refuge.RefugeUnavailable if call fails.
    """
         
     # Get request for bathrooms located near lat-long passed in."""
-    return requests.get(f"https://www.refugerestrooms.org/api/v1/restrooms/by_location?page=1&per_page=30&offset=0&lat={latitude}&lng={longitude}")
+    return refuge_client.get("/restrooms/by_location",
+                             params={"page": 1, "per_page": 30, "offset": 0,
+                                     "lat": latitude, "lng": longitude})
+
+def get_bathrooms_near_tile(geohash):
+    """Get bathrooms near the center of a geohash tile.
+
+    Uses bathrooms from our database, only making a Refuge API call when there
+    are fewer than MIN_LOCAL_RESULTS of them nearby. Every lat-long in the tile
+    shares this one lookup, so distances are measured from the tile center.
+
+    Returns list of bathroom dictionaries, raises refuge.RefugeUnavailable if
+    the Refuge API call fails.
+    """
+
+    tile_lat, tile_long = geohash_center(geohash)
+
+    local_bathrooms = find_nearby_bathrooms(tile_lat, tile_long)
+    if len(local_bathrooms) >= MIN_LOCAL_RESULTS:
+        return local_bathrooms
+
+    return get_bathrooms_by_lat_long(round(tile_lat, 7), round(tile_long, 7)).json()
 
 def get_bathroom_objs_from_request(response):
     """Takes Response object with bathroom data from Refuge API, returns list of Bathroom objects."""
@@ -300,11 +865,7 @@ def get_bathroom_objs_from_request(response):
 
     # Make bathroom object for each bathroom from response 
     for bathroom in bathrooms:
-        bathroom = Bathroom(name=bathroom.get('name'), directions=bathroom.get('directions'), notes=bathroom.get('comment'),
-                            state=bathroom.get('state'), city=bathroom.get('city'), country=bathroom.get('country'),
-                            latitude=bathroom.get('latitude'), longitude=bathroom.get('longitude'),
-                            accessible=bathroom.get('accessible'), unisex=bathroom.get('unisex'),
-                            changing_table=bathroom.get('changing_table'), approved=bathroom.get('approved'))
+        bathroom = get_bathroom_obj_from_dict(bathroom)
             
         # Add each bathroom object to the list of bathrooms 
         bathroom_objects.append(bathroom)
@@ -312,15 +873,257 @@ def get_bathroom_objs_from_request(response):
     # Return list of bathroom objects to be displayed to user
     return bathroom_objects
 
+def get_bathroom_obj_from_dict(bathroom):
+    """Takes one bathroom dictionary from Refuge API, returns Bathroom object."""
+
+    return Bathroom(name=bathroom.get('name'), directions=bathroom.get('directions'), notes=bathroom.get('comment'),
+                    state=bathroom.get('state'), city=bathroom.get('city'), country=bathroom.get('country'),
+                    latitude=bathroom.get('latitude'), longitude=bathroom.get('longitude'),
+                    accessible=bathroom.get('accessible'), unisex=bathroom.get('unisex'),
+                    changing_table=bathroom.get('changing_table'), approved=bathroom.get('approved'),
+                    refuge_id=bathroom.get('id'),
+                    refuge_updated_at=parse_refuge_datetime(bathroom.get('updated_at')),
+                    upvotes=bathroom.get('upvote'), downvotes=bathroom.get('downvote'))
+
+def parse_refuge_datetime(value):
+    """Parse a Refuge API timestamp like 2019-03-04T18:21:41.409Z.
+
+    Returns datetime (UTC, without tzinfo), or None if value is missing.
+    """
+
+    if not value:
+        return None
+
+    for date_format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+
+    raise ValueError(f"Unexpected Refuge API timestamp {value}")
+
+def get_lat_long_key(latitude, longitude):
+    """Returns tuple of lat-long as Decimals rounded the way the database stores them."""
+
+    places = Decimal("0.0000001")
+
+    return (Decimal(str(latitude)).quantize(places), Decimal(str(longitude)).quantize(places))
+
+def get_duplicate_grid(rows):
+    """Load bathrooms in the database that could be duplicates of rows.
+
+    rows -- bathroom column dictionaries (see Bathroom.to_row)
+
+    Returns DuplicateGrid of the nearby bathrooms.
+    """
+
+    # Geohash cells (about 1.2km x 0.6km) overlapping the box around each row
+    # a duplicate could be in, each one a range scan on the geohash index
+    cells = set()
+    lat_margin = DUPLICATE_METERS / METERS_PER_DEGREE_LAT
+    for row in rows:
+        latitude = float(row["latitude"])
+        longitude = float(row["longitude"])
+        long_margin = lat_margin / max(math.cos(math.radians(latitude)), 0.01)
+        cells.update(geohash_cells_in_box(latitude - lat_margin, longitude - long_margin,
+                                          latitude + lat_margin, longitude + long_margin, 6))
+    cells = sorted(cells)
+
+    grid = DuplicateGrid()
+    for start in range(0, len(cells), 100):
+        cell_filters = [get_geohash_prefix_filter(cell) for cell in cells[start:start + 100]]
+        nearby = (db.session.query(Bathroom.bathroom_id, Bathroom.latitude, Bathroom.longitude,
+                                   Bathroom.name, Bathroom.city)
+                            .filter(db.or_(*cell_filters)))
+        for bathroom in nearby:
+            grid.add(get_grid_entry(*bathroom))
+
+    return grid
+
+def insert_bathroom_rows(rows):
+    """Bulk insert bathrooms, leaving out any whose lat-long or refuge_id is taken.
+
+    On Postgres the unique keys settle it, so concurrent ingests can't race.
+    Other databases don't skip conflicts on every unique key, so rows are
+    checked against the database and each other first.
+
+    rows -- bathroom column dictionaries (see Bathroom.to_row)
+
+    Returns number of bathrooms inserted.
+    """
+
+    if not rows:
+        return 0
+
+    table = Bathroom.__table__
+    if db.engine.dialect.name == "postgresql":
+        insert = (postgresql.insert(table).values(rows)
+                            .on_conflict_do_nothing()
+                            .returning(table.c.bathroom_id))
+        return len(db.session.execute(insert).fetchall())
+
+    taken_lat_longs = set()
+    latitudes = sorted({get_lat_long_key(row["latitude"], row["longitude"])[0] for row in rows})
+    for start in range(0, len(latitudes), 500):
+        query = (db.session.query(Bathroom.latitude, Bathroom.longitude)
+                           .filter(Bathroom.latitude.in_(latitudes[start:start + 500])))
+        taken_lat_longs.update(get_lat_long_key(latitude, longitude) for latitude, longitude in query)
+
+    taken_refuge_ids = set()
+    refuge_ids = sorted({row["refuge_id"] for row in rows if row.get("refuge_id") is not None})
+    for start in range(0, len(refuge_ids), 500):
+        query = (db.session.query(Bathroom.refuge_id)
+                           .filter(Bathroom.refuge_id.in_(refuge_ids[start:start + 500])))
+        taken_refuge_ids.update(refuge_id for refuge_id, in query)
+
+    new_rows = []
+    for row in rows:
+        lat_long = get_lat_long_key(row["latitude"], row["longitude"])
+        refuge_id = row.get("refuge_id")
+        if lat_long in taken_lat_longs or (refuge_id is not None and refuge_id in taken_refuge_ids):
+            continue
+        taken_lat_longs.add(lat_long)
+        if refuge_id is not None:
+            taken_refuge_ids.add(refuge_id)
+        new_rows.append(row)
+
+    if new_rows:
+        db.session.execute(table.insert(), new_rows)
+
+    return len(new_rows)
+
 def add_bathrooms_to_db(bathrooms):
-    """Checks if bathrooms are in database, adds them if they are not.
+    """Adds bathrooms that aren't in the database yet, all in one bulk insert.
     
-    Takes in a list of Bathroom objects.
+    Takes in a list of Bathroom objects. A bathroom is skipped if it's a
+    near-duplicate (see dedupe.py) of one in the database or earlier in the
+    list. Possible duplicates are loaded with one query per 100 geohash
+    cells, instead of querying once per bathroom.
+
+    Returns dictionary with counts of inserted and skipped bathrooms.
+    """
+
+    rows = [bathroom.to_row() for bathroom in bathrooms
+            if bathroom.latitude is not None and bathroom.longitude is not None]
+    grid = get_duplicate_grid(rows)
+
+    # Each new bathroom goes in the grid too, so the list is deduped against itself
+    new_rows = []
+    for row in rows:
+        entry = get_grid_entry(None, row["latitude"], row["longitude"], row["name"], row["city"])
+        if grid.find_duplicate(entry) is None:
+            grid.add(entry)
+            new_rows.append(row)
+
+    inserted = insert_bathroom_rows(new_rows)
+    db.session.commit()
+
+    return {"inserted": inserted, "skipped": len(bathrooms) - inserted}
+
+def record_bathroom_deletions(count):
+    """Note that count bathrooms were deleted, as part of the current transaction.
+
+    In-memory indexes (ex search.py's) rebuild when this changes, instead of
+    counting every bathroom to find out.
+    """
+
+    state = SyncState.query.get(BATHROOM_DELETIONS)
+    if state is None:
+        state = SyncState(name=BATHROOM_DELETIONS)
+        db.session.add(state)
+    state.last_run_at = datetime.now()
+    state.last_changed_count = count
+
+def get_bathrooms_deleted_at():
+    """Returns datetime bathrooms were last deleted (see record_bathroom_deletions), or None."""
+
+    return (db.session.query(SyncState.last_run_at)
+                      .filter(SyncState.name == BATHROOM_DELETIONS)
+                      .scalar())
+
+def merge_duplicate_bathrooms(batch_size=10000, on_merge=None):
+    """Merge near-duplicate bathrooms already in the database.
+
+    Bathrooms are streamed in latitude order (the leading column of the
+    lat-long unique index) into a DuplicateGrid that only keeps a narrow
+    band of latitudes, so memory stays small however many bathrooms there
+    are. Of each group of duplicates the lowest bathroom_id is kept, and the
+    others' checkins, ratings and list items are moved to it.
+
+    on_merge -- optional - called with the list of bathroom ids merged away,
+                once the merge is committed (ex to forget cached pages)
+
+    Returns number of bathrooms merged away.
     """
+
+    grid = DuplicateGrid()
+    keeper_ids = {}
+    bathrooms = (db.session.query(Bathroom.bathroom_id, Bathroom.latitude, Bathroom.longitude,
+                                  Bathroom.name, Bathroom.city)
+                           .order_by(Bathroom.latitude, Bathroom.bathroom_id)
+                           .yield_per(batch_size))
     for bathroom in bathrooms:
-        if not bathroom.in_database():
-            db.session.add(bathroom)
+        entry = get_grid_entry(*bathroom)
+        grid.drop_rows_below(entry[1])
+        duplicate = grid.find_duplicate(entry)
+        if duplicate is None:
+            grid.add(entry)
+        elif entry[0] < duplicate[0]:
+            # Keep the older bathroom, it takes the other's place in the grid
+            keeper_ids[duplicate[0]] = entry[0]
+            grid.remove(duplicate)
+            grid.add(entry)
+        else:
+            keeper_ids[entry[0]] = duplicate[0]
+
+    # Follow chains of merges (a into b, b into c) to the bathroom kept
+    for duplicate_id in keeper_ids:
+        keeper_id = keeper_ids[duplicate_id]
+        while keeper_id in keeper_ids:
+            keeper_id = keeper_ids[keeper_id]
+        keeper_ids[duplicate_id] = keeper_id
+
+    # Per 500 duplicates, one UPDATE per table maps each to its keeper with a CASE
+    duplicate_ids = list(keeper_ids)
+    for start in range(0, len(duplicate_ids), 500):
+        chunk = duplicate_ids[start:start + 500]
+        chunk_keepers = {duplicate_id: keeper_ids[duplicate_id] for duplicate_id in chunk}
+
+        # A user lists a bathroom once per list, drop list items the move would repeat
+        listed = set()
+        repeated_ids = []
+        list_items = (db.session.query(ListItem.list_item_id, ListItem.list_id, ListItem.user_id,
+                                       ListItem.bathroom_id)
+                                .filter(ListItem.bathroom_id.in_(chunk + list(set(chunk_keepers.values()))))
+                                .order_by(ListItem.list_item_id))
+        for list_item_id, list_id, user_id, bathroom_id in list_items:
+            key = (list_id, user_id, chunk_keepers.get(bathroom_id, bathroom_id))
+            if key in listed:
+                repeated_ids.append(list_item_id)
+            else:
+                listed.add(key)
+        if repeated_ids:
+            ListItem.query.filter(ListItem.list_item_id.in_(repeated_ids)).delete(synchronize_session=False)
+
+        for model in (Checkin, Rating, ListItem):
+            (model.query.filter(model.bathroom_id.in_(chunk))
+                        .update({"bathroom_id": db.case(chunk_keepers, value=model.bathroom_id)},
+                                synchronize_session=False))
+        for model in (BathroomStats, CheckinCounter):
+            model.query.filter(model.bathroom_id.in_(chunk)).delete(synchronize_session=False)
+        Bathroom.query.filter(Bathroom.bathroom_id.in_(chunk)).delete(synchronize_session=False)
+    if duplicate_ids:
+        record_bathroom_deletions(len(duplicate_ids))
     db.session.commit()
+    if on_merge is not None and duplicate_ids:
+        on_merge(duplicate_ids)
+
+    # Keepers' stats and counters now need the ratings and checkins they took over
+    if duplicate_ids:
+        rebuild_bathroom_stats()
+        rebuild_checkin_counters()
+
+    return len(duplicate_ids)
 
 if __name__ == "__main__":
     # If run interactively, will be in state to work with db directly
@@ -0,0 +1,216 @@
+"""JSON response bodies for crApp's bathroom endpoints, with ETags and compression.
+
+A JsonPayload is serialized once and compressed at most once per encoding,
+however many responses it's sent in. Its ETag is a hash of the JSON, so a
+client polling with If-None-Match gets a 304 while the bathrooms around it
+haven't changed. orjson and brotli are used when installed, otherwise the
+standard json module and gzip only.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+
+from cache import LocalBackend
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies aren't worth compressing, they'd fit in one packet anyway
+MIN_COMPRESS_SIZE = 1024
+
+# Middling levels, most of the size win for a fraction of the CPU of the top ones
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Encodings we can send, most preferred first
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def dumps(value):
+    """Serialize value to compact JSON.
+
+    Returns UTF-8 bytes.
+    """
+
+    if orjson is not None:
+        # Snapshot results can hold NumPy numbers
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def compress(body, encoding):
+    """Returns body compressed with encoding ("br" or "gzip")."""
+
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+
+    # mtime=0 so the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def choose_encoding(accept_encoding):
+    """Pick the encoding to send from an Accept-Encoding header.
+
+    Ex "gzip, deflate, br" gives "br" (if brotli is installed), "gzip;q=0"
+    or no header gives None.
+
+    Returns "br", "gzip" or None for uncompressed.
+    """
+
+    weights = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        if name:
+            weights[name.strip().lower()] = weight
+
+    best = None
+    best_weight = 0.0
+    for encoding in ENCODINGS:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        # Ties go to the encoding we prefer, which comes first
+        if weight > best_weight:
+            best = encoding
+            best_weight = weight
+
+    return best
+
+
+class JsonPayload:
+    """A value serialized to JSON once, with its ETag and compressed bodies."""
+
+    def __init__(self, value):
+        """Initialize a JsonPayload object.
+
+        value -- anything that can be turned into JSON
+
+        Returns: JsonPayload object
+        """
+
+        self.body = dumps(value)
+        # Weak, since the gzip and brotli bodies share it with the plain one
+        self.etag = f'W/"{hashlib.blake2b(self.body, digest_size=12).hexdigest()}"'
+        self._compressed = {}
+        self._lock = threading.Lock()
+
+    def get_body(self, encoding):
+        """Get the body for encoding, compressing it the first time it's asked for.
+
+        Returns (bytes, encoding actually used) tuple, encoding is None when
+        the body is sent uncompressed.
+        """
+
+        if encoding is None or len(self.body) < MIN_COMPRESS_SIZE:
+            return self.body, None
+
+        with self._lock:
+            body = self._compressed.get(encoding)
+            if body is None:
+                body = compress(self.body, encoding)
+                self._compressed[encoding] = body
+
+        return body, encoding
+
+    def matches(self, if_none_match):
+        """Returns True if an If-None-Match header names this payload's ETag."""
+
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+
+        # If-None-Match compares weakly, W/"x" and "x" match
+        tag = self.etag[2:]
+        return any(candidate.strip().replace("W/", "", 1) == tag
+                   for candidate in if_none_match.split(","))
+
+    def get_response(self, if_none_match=None, accept_encoding=None):
+        """Answer a request for this payload.
+
+        if_none_match -- the request's If-None-Match header, if any
+        accept_encoding -- the request's Accept-Encoding header, if any
+
+        Returns (status, list of (header, value) tuples, body bytes) tuple.
+        """
+
+        headers = [("ETag", self.etag),
+                   ("Vary", "Accept-Encoding"),
+                   # Clients keep the body but check it's current each time
+                   ("Cache-Control", "no-cache")]
+        if self.matches(if_none_match):
+            return 304, headers, b""
+
+        body, encoding = self.get_body(choose_encoding(accept_encoding))
+        headers.append(("Content-Type", "application/json"))
+        if encoding is not None:
+            headers.append(("Content-Encoding", encoding))
+
+        return 200, headers, body
+
+
+class PayloadCache:
+    """Remembers the JsonPayload made for each cached value.
+
+    Cached lookups (ex a TileCache hit on a LocalBackend) hand back the same
+    object until it's refetched, so a payload is reused for as long as the
+    value it was made from is still the one being served. Values that are
+    new objects every time (ex from a SharedBackend) are serialized again.
+    """
+
+    def __init__(self, max_entries=2048):
+        """Initialize a PayloadCache object.
+
+        max_entries -- most payloads kept before least recently used are dropped
+
+        Returns: PayloadCache object
+        """
+
+        self.backend = LocalBackend(max_entries=max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_payload(self, key, value):
+        """Get the payload for value, cached under key (ex its tile).
+
+        Returns JsonPayload object.
+        """
+
+        entry = self.backend.get(key)
+        # Keeping value in the entry means its id can't be reused by another object
+        if entry is not None and entry[0] is value:
+            with self._lock:
+                self.hits += 1
+            return entry[1]
+
+        payload = JsonPayload(value)
+        # Entries are replaced when their value changes, they don't need to expire
+        self.backend.set(key, (value, payload), float("inf"))
+        with self._lock:
+            self.misses += 1
+
+        return payload
+
+    def stats(self):
+        """Returns dictionary of hit/miss/eviction counters."""
+
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.backend.evictions,
+                "entries": len(self.backend)}
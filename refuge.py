@@ -0,0 +1,180 @@
+"""Shared HTTP client for calls to the Refuge Restrooms API."""
+
+import os
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import Histogram
+
+REFUGE_API_URL = os.environ.get("REFUGE_API_URL", "https://www.refugerestrooms.org/api/v1")
+
+
+class RefugeUnavailable(Exception):
+    """Refuge API call failed (error, timeout, or circuit breaker open)."""
+
+
+class CircuitOpen(RefugeUnavailable):
+    """Refuge API call skipped because recent calls kept failing."""
+
+
+class RefugeRequestError(RefugeUnavailable):
+    """Refuge API rejected the call (4xx response), ex bad parameters.
+
+    The API itself is up, so these don't count against the circuit breaker.
+    """
+
+
+class CircuitBreaker:
+    """Stops calling upstream after repeated failures, then lets a trial call through.
+
+    Closed -- calls go through
+    Open -- calls fail fast for reset_after seconds
+    Half open -- one trial call goes through, success closes the circuit
+    """
+
+    def __init__(self, failure_threshold=5, reset_after=30):
+        """Initialize a CircuitBreaker object.
+
+        failure_threshold -- failures in a row before the circuit opens
+        reset_after -- seconds the circuit stays open before a trial call
+
+        Returns: CircuitBreaker object
+        """
+
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """Returns "closed", "open" or "half_open"."""
+
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_after:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        """Returns True if a call may go upstream now."""
+
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        """Close the circuit after a call succeeds."""
+
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        """Count a failed call, opening the circuit past the threshold."""
+
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class RefugeClient:
+    """Pooled Refuge API client with timeouts, retries and a circuit breaker.
+
+    One client is shared by everything calling the API, so connections are
+    kept alive and reused instead of paying a new TCP+TLS handshake each call.
+    """
+
+    def __init__(self, base_url=REFUGE_API_URL, pool_size=20, connect_timeout=3.05,
+                 read_timeout=10, retries=2, backoff=0.3, breaker=None):
+        """Initialize a RefugeClient object.
+
+        base_url -- Refuge API URL paths are added to, REFUGE_API_URL env var
+                    overrides the default (ex to point at a local stand-in)
+        pool_size -- most kept-alive connections to the API
+        connect_timeout, read_timeout -- seconds before a call is given up on
+        retries -- retries of failed connections and 5xx responses
+        backoff -- retry backoff factor, waits backoff * 2 ** (retry - 1) seconds
+        breaker -- optional - CircuitBreaker, defaults to a new one
+
+        Returns: RefugeClient object
+        """
+
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.latency_ms = Histogram()
+        self.errors = 0
+        # Functions called with each call's milliseconds, ex by request instrumentation
+        self.listeners = []
+
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, path, params=None, timeout=None):
+        """Make GET request to a Refuge API path.
+
+        path -- API path, ex "/restrooms/by_location"
+        params -- optional - dictionary of query parameters
+        timeout -- optional - (connect, read) seconds, defaults to client's
+
+        Returns Response object. Raises RefugeUnavailable if the call fails,
+        RefugeRequestError if the API rejects it or CircuitOpen if upstream
+        is being skipped.
+        """
+
+        if not self.breaker.allow():
+            raise CircuitOpen("Refuge API circuit breaker is open")
+
+        start = time.perf_counter()
+        try:
+            response = self.session.get(self.base_url + path, params=params,
+                                        timeout=timeout or self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as error:
+            self.errors += 1
+            # Connection errors and timeouts have no response
+            if error.response is not None and error.response.status_code < 500:
+                # The API answered, so it's up (and a half open trial is over)
+                self.breaker.record_success()
+                raise RefugeRequestError(str(error)) from error
+            self.breaker.record_failure()
+            raise RefugeUnavailable(str(error)) from error
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.latency_ms.observe(elapsed_ms)
+            for listener in self.listeners:
+                listener(elapsed_ms)
+
+        self.breaker.record_success()
+        return response
+
+    def stats(self):
+        """Returns dictionary of latency histogram, errors and breaker state."""
+
+        return {"latency_ms": self.latency_ms.to_dict(),
+                "errors": self.errors,
+                "circuit": self.breaker.state}
+
+
+# Client shared by the app and seed scripts
+refuge_client = RefugeClient()
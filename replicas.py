@@ -0,0 +1,318 @@
+"""Read replica routing and connection pool metrics for crApp's database.
+
+connect_to_db can bind read replicas alongside the primary (as binds named
+replica_1, replica_2, ...). While a ReplicaRouter is hooked into the app,
+each read-only request picks one replica, round robin, and its session reads
+from it. Writes always go to the primary, and after a user writes their
+reads stay on the primary for a few seconds, so they see their own changes
+before the replicas catch up.
+"""
+
+import itertools
+import threading
+import time
+import weakref
+
+from flask import current_app, g, has_app_context, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+# Binds whose names start with this are read replicas of the primary
+REPLICA_PREFIX = "replica_"
+
+# Request methods that only read
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Seconds a user's reads stay on the primary after they write, well over
+# the usual replica lag
+STICKY_SECONDS = 10
+
+# Environment variables read by get_connect_options, with their
+# connect_to_db argument
+POOL_SETTINGS = {"DATABASE_POOL_SIZE": "pool_size",
+                 "DATABASE_MAX_OVERFLOW": "max_overflow",
+                 "DATABASE_POOL_RECYCLE": "pool_recycle",
+                 "DATABASE_POOL_TIMEOUT": "pool_timeout"}
+
+
+def get_replica_binds(replica_urls):
+    """Name each read replica's database URI as a bind.
+
+    Ex ["postgresql://replica-a/crapp"] gives
+    {"replica_1": "postgresql://replica-a/crapp"}.
+
+    Returns dictionary of bind name to URI.
+    """
+
+    return {f"{REPLICA_PREFIX}{number}": url
+            for number, url in enumerate(replica_urls, start=1)}
+
+
+def get_connect_options(environ):
+    """Get read replicas and pool settings for connect_to_db from the environment.
+
+    DATABASE_REPLICA_URLS is a comma separated list of replica URIs,
+    DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_RECYCLE
+    (seconds) and DATABASE_POOL_TIMEOUT (seconds) apply to every bind.
+
+    Returns dictionary of connect_to_db keyword arguments.
+    """
+
+    options = {"replicas": [url.strip() for url in environ.get("DATABASE_REPLICA_URLS", "").split(",")
+                            if url.strip()]}
+    for name, option in POOL_SETTINGS.items():
+        if environ.get(name):
+            options[option] = int(environ[name])
+
+    return options
+
+
+def use_primary(view):
+    """Mark a view whose reads must go to the primary, ex one that writes on a GET.
+
+    Goes under @app.route, so the view registered is the marked one.
+    """
+
+    view.use_primary = True
+    return view
+
+
+def read_from_primary():
+    """Send the rest of this app context's reads to the primary, if the app has a ReplicaRouter.
+
+    For code that can't reach the router itself, ex the checkin queue.
+    """
+
+    if has_app_context():
+        router = current_app.extensions.get("replica_router")
+        if router is not None:
+            router.read_from_primary()
+
+
+def get_pool_capacity(pool):
+    """Returns most connections a QueuePool will hand out at once (inf if unlimited)."""
+
+    if pool._max_overflow < 0:
+        return float("inf")
+
+    return pool.size() + pool._max_overflow
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from the replica its request was routed to.
+
+    Flushes and INSERT/UPDATE/DELETE statements go to the primary, and
+    mark the request as having written so its later reads do too.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        """Returns the engine to run clause (or mapper's query) on."""
+
+        router = self.app.extensions.get("replica_router")
+        if router is not None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                router.record_write()
+            else:
+                replica = router.get_replica()
+                if replica is not None:
+                    return self.app.extensions["sqlalchemy"].db.get_engine(self.app, bind=replica)
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose sessions are RoutingSessions."""
+
+    def create_session(self, options):
+        """Returns sessionmaker for RoutingSessions."""
+
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaRouter:
+    """Picks the bind each request reads from and keeps pool metrics per bind."""
+
+    def __init__(self, sticky_seconds=STICKY_SECONDS):
+        """Initialize a ReplicaRouter object.
+
+        sticky_seconds -- how long a user's reads stay on the primary after
+                          they write
+
+        Returns: ReplicaRouter object
+        """
+
+        self.sticky_seconds = sticky_seconds
+        # Requests routed to each replica, or to the primary and why
+        self.routed = {"primary_write": 0, "primary_sticky": 0, "primary_pinned": 0}
+        # Most connections checked out at once and times a pool was left
+        # with none to spare, per pool
+        self.peak_checked_out = weakref.WeakKeyDictionary()
+        self.full_checkouts = weakref.WeakKeyDictionary()
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Route app's sessions and watch every engine's pool."""
+
+        app.extensions["replica_router"] = self
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+        # Listening on the Engine class covers engines created later by connect_to_db
+        event.listen(Engine, "engine_connect", self.record_checkout)
+
+    def get_replicas(self):
+        """Returns sorted list of the current app's replica bind names."""
+
+        binds = current_app.config.get("SQLALCHEMY_BINDS") or {}
+        return sorted(bind for bind in binds if bind.startswith(REPLICA_PREFIX))
+
+    def count(self, target):
+        """Count a request routed to target."""
+
+        with self._lock:
+            self.routed[target] = self.routed.get(target, 0) + 1
+
+    def use_replica(self):
+        """Send the rest of this app context's reads to the next replica (ex for async near me).
+
+        Returns the replica's bind name, or None if there are no replicas.
+        """
+
+        replicas = self.get_replicas()
+        g.db_replica = replicas[next(self._turns) % len(replicas)] if replicas else None
+        if g.db_replica is not None:
+            self.count(g.db_replica)
+
+        return g.db_replica
+
+    def choose_replica(self):
+        """Pick the replica for this request's reads.
+
+        Returns the replica's bind name, or None for the primary.
+        """
+
+        if not self.get_replicas():
+            return None
+
+        view = current_app.view_functions.get(request.endpoint)
+        if request.method not in READ_METHODS:
+            self.count("primary_write")
+        elif getattr(view, "use_primary", False):
+            self.count("primary_pinned")
+        elif time.time() - session.get("db_wrote_at", 0) < self.sticky_seconds:
+            # Replicas may not have this user's last write yet
+            self.count("primary_sticky")
+        else:
+            return self.use_replica()
+
+        return None
+
+    def get_replica(self):
+        """Get the replica reads in this app context go to, choosing it on the first read.
+
+        Work outside a request (ex the checkin queue's inserts) uses the
+        primary unless use_replica was called.
+
+        Returns the replica's bind name, or None for the primary.
+        """
+
+        if not has_app_context() or g.get("db_wrote"):
+            return None
+        if "db_replica" not in g:
+            g.db_replica = self.choose_replica() if has_request_context() else None
+
+        return g.db_replica
+
+    def read_from_primary(self):
+        """Send the rest of this app context's reads to the primary, without making the user sticky.
+
+        Ex for content cached for every user, which shouldn't be rendered
+        from a replica that's behind.
+        """
+
+        if has_app_context():
+            g.db_replica = None
+
+    def record_write(self):
+        """Note that this app context wrote, so its reads and its user's next ones use the primary."""
+
+        if has_app_context():
+            g.db_wrote = True
+
+    def start_request(self):
+        """Forget a previous request's routing if the app context is reused (ex in tests)."""
+
+        g.pop("db_replica", None)
+        g.pop("db_wrote", None)
+
+    def finish_request(self, response):
+        """Keep the user's reads on the primary for a while if the request wrote."""
+
+        if g.get("db_wrote") and self.get_replicas():
+            session["db_wrote_at"] = time.time()
+
+        return response
+
+    def record_checkout(self, conn, branch):
+        """Track how full the pool a connection came from is."""
+
+        pool = conn.engine.pool
+        if branch or not isinstance(pool, QueuePool):
+            return
+
+        checked_out = pool.checkedout()
+        with self._lock:
+            self.peak_checked_out[pool] = max(self.peak_checked_out.get(pool, 0), checked_out)
+            if checked_out >= get_pool_capacity(pool):
+                self.full_checkouts[pool] = self.full_checkouts.get(pool, 0) + 1
+
+    def get_pool_stats(self, pool):
+        """Returns dictionary of pool's size, use and saturation (share of its connections in use)."""
+
+        stats = {"pool": type(pool).__name__}
+        if isinstance(pool, QueuePool):
+            capacity = get_pool_capacity(pool)
+            stats.update({"size": pool.size(),
+                          "max_overflow": pool._max_overflow,
+                          "checked_out": pool.checkedout(),
+                          "checked_in": pool.checkedin(),
+                          "overflow": pool.overflow(),
+                          "peak_checked_out": self.peak_checked_out.get(pool, 0),
+                          "full_checkouts": self.full_checkouts.get(pool, 0),
+                          # No limit with a negative max_overflow
+                          "saturation": (round(pool.checkedout() / capacity, 3)
+                                         if capacity != float("inf") else None)})
+
+        return stats
+
+    def stats(self):
+        """Returns dictionary of routing counters and each bind's pool stats."""
+
+        db = current_app.extensions["sqlalchemy"].db
+        pools = {"primary": self.get_pool_stats(db.get_engine(current_app).pool)}
+        for replica in self.get_replicas():
+            pools[replica] = self.get_pool_stats(db.get_engine(current_app, bind=replica).pool)
+
+        return {"routed": dict(self.routed), "pools": pools}
+
+    def to_prometheus(self):
+        """Returns routing counters and pool gauges in Prometheus text exposition format."""
+
+        stats = self.stats()
+        lines = ["# TYPE crapp_db_routed_requests_total counter"]
+        for target, count in sorted(stats["routed"].items()):
+            lines.append(f'crapp_db_routed_requests_total{{target="{target}"}} {count}')
+
+        for name, metric_type in (("checked_out", "gauge"), ("peak_checked_out", "gauge"),
+                                  ("saturation", "gauge"), ("full_checkouts", "counter")):
+            metric = f"crapp_db_pool_{name}"
+            lines.append(f"# TYPE {metric} {metric_type}")
+            for bind, pool_stats in sorted(stats["pools"].items()):
+                if pool_stats.get(name) is not None:
+                    lines.append(f'{metric}{{bind="{bind}"}} {pool_stats[name]}')
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,496 @@
+"""In-memory full-text search over bathroom names, places, directions and notes.
+
+An inverted index maps each word to the bathrooms using it, so a search
+only reads the postings of its own words instead of scanning every
+bathroom. The last word of a query also matches words it's the start of
+(autocomplete), and words that aren't in the index at all are matched to
+similar ones by shared trigrams (typos). Results can be ranked by distance
+as well as by how well they match.
+
+Like the bathroom snapshot, the index refreshes incrementally: bathrooms
+added or changed since the last refresh go into a small overlay, and the
+whole index is only rebuilt once the overlay is large or bathrooms were
+deleted. Refreshes run in a background thread, searches keep using the
+index as it was until the refresh swaps its changes in.
+"""
+
+import bisect
+import heapq
+import logging
+import re
+import threading
+import time
+import unicodedata
+
+from array import array
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+
+from model import Bathroom, db, get_bathrooms_deleted_at
+
+# Weight of a match in each field, a word in the name counts most
+NAME, PLACE, DETAILS = 0, 1, 2
+FIELD_WEIGHTS = (3.0, 1.5, 1.0)
+
+# Postings are bathroom_id << FIELD_BITS | field
+FIELD_BITS = 2
+
+# Match quality for words the query word starts (autocomplete) or looks like (typo)
+PREFIX_QUALITY = 0.8
+FUZZY_QUALITY = 0.7
+
+# Index words one query word can expand to at most
+MAX_PREFIX_TERMS = 50
+MAX_FUZZY_TERMS = 5
+
+# Least trigram similarity for a typo match (same default as pg_trgm)
+MIN_SIMILARITY = 0.3
+
+# Text score is divided by 1 + miles / this when searching near a lat-long
+DISTANCE_SCALE_MILES = 1.0
+
+# Bathrooms changed since the last rebuild before the overlay is merged in
+MAX_OVERLAY = 5000
+
+logger = logging.getLogger("crapp.search")
+
+
+def tokenize(text):
+    """Split text into lowercase ASCII words, ex "Quizno's Café" is quiznos, cafe.
+
+    Returns list of words.
+    """
+
+    if not text:
+        return []
+
+    # Accents dropped and apostrophes joined, so typing either way matches
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+
+    return re.findall(r"[a-z0-9]+", text.lower().replace("'", ""))
+
+
+def get_trigrams(word):
+    """Returns set of a word's trigrams, padded like pg_trgm ("  c", " ca", "cat", "at ")."""
+
+    padded = f"  {word} "
+
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def get_search_query():
+    """Returns query of every column the index keeps, one row per bathroom."""
+
+    return (db.session.query(Bathroom.bathroom_id, Bathroom.name, Bathroom.city, Bathroom.state,
+                             Bathroom.directions, Bathroom.notes, Bathroom.latitude,
+                             Bathroom.longitude, Bathroom.refuge_updated_at)
+                      .order_by(Bathroom.bathroom_id))
+
+
+def get_row_postings(row):
+    """Returns set of (word, field) pairs for a row from get_search_query."""
+
+    fields = ((NAME, (row[1],)), (PLACE, (row[2], row[3])), (DETAILS, (row[4], row[5])))
+
+    return {(word, field) for field, texts in fields for text in texts for word in tokenize(text)}
+
+
+class SearchIndex:
+    """Inverted index of bathroom text, plus each bathroom's location.
+
+    The base index is built in one go and never changed: vocabulary is the
+    sorted list of every word, postings[i] an array of the postings of
+    vocabulary[i], trigrams maps each trigram to the vocabulary positions of
+    words that have it, and ids, latitudes and longitudes are arrays sorted
+    by bathroom_id. Bathrooms changed since go into the overlay, whose
+    postings replace theirs in the base. Refreshes swap in new
+    dictionaries, so searches running at the same time see one version or
+    the other.
+    """
+
+    def __init__(self, max_age=60, max_overlay=MAX_OVERLAY):
+        """Initialize a SearchIndex object.
+
+        max_age -- seconds before searches trigger an incremental refresh
+        max_overlay -- bathrooms changed since the last rebuild before it's rebuilt
+
+        Returns: SearchIndex object
+        """
+
+        self.max_age = max_age
+        self.max_overlay = max_overlay
+        self.refreshed_at = None
+        self.max_bathroom_id = 0
+        self.updated_watermark = None
+        self.deleted_at = None
+        self.count = 0
+        self.rebuilds = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self.set_rows([])
+
+    def __len__(self):
+        return self.count
+
+    def set_rows(self, rows):
+        """Replace the whole index with rows from get_search_query (sorted by bathroom_id)."""
+
+        word_postings = {}
+        ids = array("q")
+        latitudes = array("d")
+        longitudes = array("d")
+        self.max_bathroom_id = 0
+        self.updated_watermark = None
+
+        for row in rows:
+            for word, field in get_row_postings(row):
+                postings = word_postings.get(word)
+                if postings is None:
+                    postings = word_postings[word] = array("q")
+                postings.append(row[0] << FIELD_BITS | field)
+            ids.append(row[0])
+            latitudes.append(float(row[6]))
+            longitudes.append(float(row[7]))
+            self.update_watermarks(row)
+
+        vocabulary = sorted(word_postings)
+        trigrams = {}
+        for position, word in enumerate(vocabulary):
+            for trigram in get_trigrams(word):
+                trigrams.setdefault(trigram, array("i")).append(position)
+
+        # Assigned together once built, searches use the old index until then
+        self.base, self.overlay = ({"vocabulary": vocabulary,
+                                    "postings": [word_postings[word] for word in vocabulary],
+                                    "trigrams": trigrams,
+                                    "ids": ids,
+                                    "latitudes": latitudes,
+                                    "longitudes": longitudes},
+                                   {"postings": {}, "locations": {}})
+        self.count = len(ids)
+        self.rebuilds += 1
+
+    def apply_rows(self, rows):
+        """Put added or changed bathrooms in the overlay.
+
+        rows -- rows from get_search_query
+        """
+
+        if not rows:
+            return
+
+        postings = {word: list(entries) for word, entries in self.overlay["postings"].items()}
+        locations = dict(self.overlay["locations"])
+        changed_ids = {row[0] for row in rows}
+        for word in postings:
+            postings[word] = [entry for entry in postings[word]
+                              if entry >> FIELD_BITS not in changed_ids]
+
+        for row in rows:
+            if row[0] not in locations and self.get_base_position(row[0]) is None:
+                self.count += 1
+            for word, field in get_row_postings(row):
+                postings.setdefault(word, []).append(row[0] << FIELD_BITS | field)
+            locations[row[0]] = (float(row[6]), float(row[7]))
+            self.update_watermarks(row)
+
+        self.overlay = {"postings": {word: entries for word, entries in postings.items() if entries},
+                        "locations": locations}
+
+    def update_watermarks(self, row):
+        """Move max_bathroom_id and the Refuge update watermark past row."""
+
+        self.max_bathroom_id = max(self.max_bathroom_id, row[0])
+        if row[8] is not None:
+            self.updated_watermark = max(row[8], self.updated_watermark or row[8])
+
+    def get_base_position(self, bathroom_id):
+        """Returns bathroom's position in the base index's arrays, or None if it isn't there."""
+
+        ids = self.base["ids"]
+        position = bisect.bisect_left(ids, bathroom_id)
+        if position < len(ids) and ids[position] == bathroom_id:
+            return position
+
+        return None
+
+    def refresh(self):
+        """Read bathrooms added or changed since the last refresh.
+
+        Added means a higher bathroom_id, changed means a newer Refuge
+        update. If bathrooms were deleted (ex by a dedupe merge, see
+        model.record_bathroom_deletions), or the overlay has grown past
+        max_overlay, the whole index is rebuilt.
+        """
+
+        # Read first, so bathrooms deleted during a rebuild are caught next time
+        deleted_at = get_bathrooms_deleted_at()
+
+        if self.refreshed_at is not None:
+            # Two queries rather than one with OR, so each is a range scan of an
+            # index, sorted here since ORDER BY can make planners walk the
+            # primary key instead. >= so changes committed in the same instant
+            # as the last refresh aren't missed, and datetime.min rather than IS
+            # NOT NULL, which planners without stats (ex SQLite) guess is most rows
+            updated = Bathroom.refuge_updated_at >= (self.updated_watermark or datetime.min)
+            rows = {row[0]: row for row in get_search_query().filter(updated).order_by(None)}
+            rows.update((row[0], row) for row in
+                        get_search_query().filter(Bathroom.bathroom_id > self.max_bathroom_id))
+            self.apply_rows([rows[bathroom_id] for bathroom_id in sorted(rows)])
+
+        if (self.refreshed_at is None or len(self.overlay["locations"]) > self.max_overlay
+                or deleted_at != self.deleted_at):
+            self.set_rows(get_search_query().yield_per(10000))
+
+        self.deleted_at = deleted_at
+        self.refreshed_at = time.monotonic()
+
+    def refresh_if_stale(self):
+        """Start a background refresh if the index is older than max_age.
+
+        Only a process's first refresh is waited for, since there's nothing
+        to search before it. Call start_refresh at startup so searches
+        don't wait for that one either. Call with an app context (ex from a
+        request).
+        """
+
+        if self.refreshed_at is None:
+            self.start_refresh(current_app._get_current_object()).join()
+        elif time.monotonic() - self.refreshed_at > self.max_age:
+            self.start_refresh(current_app._get_current_object())
+
+    def start_refresh(self, app):
+        """Refresh from app's database in a background thread, unless one is running.
+
+        Returns the refresh's Thread.
+        """
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run_refresh, args=(app,),
+                                                name="crapp-search-index", daemon=True)
+                self._thread.start()
+
+            return self._thread
+
+    def run_refresh(self, app):
+        """Refresh from app's database, logging errors instead of raising them."""
+
+        with app.app_context():
+            try:
+                self.refresh()
+            except Exception:
+                # Ex database down, searches keep the index as it is and the next one retries
+                logger.exception("Refreshing the search index failed")
+
+    def expand(self, word, prefix=False):
+        """Find index words a query word matches.
+
+        The word itself matches best. With prefix, so do words it's the
+        start of, the most used first. Failing both, words sharing enough
+        trigrams with it match as typos.
+
+        Returns dictionary of index word to match quality (0-1).
+        """
+
+        vocabulary = self.base["vocabulary"]
+        overlay_words = self.overlay["postings"]
+        matches = {}
+        if word in overlay_words or self.get_word_position(word) is not None:
+            matches[word] = 1.0
+
+        if prefix:
+            start = bisect.bisect_left(vocabulary, word)
+            end = bisect.bisect_left(vocabulary, word + "\x7f")
+            positions = range(start, end)
+            if len(positions) > MAX_PREFIX_TERMS:
+                positions = heapq.nlargest(MAX_PREFIX_TERMS, positions,
+                                           key=lambda position: len(self.base["postings"][position]))
+            completions = [vocabulary[position] for position in positions]
+            completions.extend(other for other in overlay_words if other.startswith(word))
+            for completion in completions:
+                matches.setdefault(completion, PREFIX_QUALITY)
+
+        if matches or len(word) < 3:
+            return matches
+
+        # Typo, count trigrams shared with every index word that has any
+        trigrams = get_trigrams(word)
+        shared = Counter()
+        for trigram in trigrams:
+            shared.update(self.base["trigrams"].get(trigram, ()))
+        similar = []
+        for position, count in shared.items():
+            other = vocabulary[position]
+            similar.append((count / (len(trigrams) + len(get_trigrams(other)) - count), other))
+        for other in overlay_words:
+            other_trigrams = get_trigrams(other)
+            count = len(trigrams & other_trigrams)
+            similar.append((count / (len(trigrams) + len(other_trigrams) - count), other))
+
+        for similarity, other in heapq.nlargest(MAX_FUZZY_TERMS, similar):
+            if similarity >= MIN_SIMILARITY:
+                matches[other] = FUZZY_QUALITY * similarity
+
+        return matches
+
+    def get_word_position(self, word):
+        """Returns word's position in the base vocabulary, or None if it isn't there."""
+
+        vocabulary = self.base["vocabulary"]
+        position = bisect.bisect_left(vocabulary, word)
+        if position < len(vocabulary) and vocabulary[position] == word:
+            return position
+
+        return None
+
+    def get_word_scores(self, matches, candidates=None):
+        """Score bathrooms for one query word.
+
+        matches -- dictionary of index word to match quality, from expand
+        candidates -- optional - only score these bathroom_ids (ones earlier
+                      words matched)
+
+        Returns dictionary of bathroom_id to best quality x field weight.
+        """
+
+        replaced = self.overlay["locations"]
+        scores = {}
+
+        def add(entry, quality):
+            bathroom_id = entry >> FIELD_BITS
+            score = quality * FIELD_WEIGHTS[entry & (2 ** FIELD_BITS - 1)]
+            if score > scores.get(bathroom_id, 0):
+                scores[bathroom_id] = score
+
+        for word, quality in matches.items():
+            position = self.get_word_position(word)
+            postings = self.base["postings"][position] if position is not None else ()
+
+            if candidates is not None and len(candidates) * 16 < len(postings):
+                # Few candidates left, look each one up (postings are in bathroom_id order)
+                for bathroom_id in candidates:
+                    if bathroom_id in replaced:
+                        continue
+                    index = bisect.bisect_left(postings, bathroom_id << FIELD_BITS)
+                    while index < len(postings) and postings[index] >> FIELD_BITS == bathroom_id:
+                        add(postings[index], quality)
+                        index += 1
+            else:
+                for entry in postings:
+                    bathroom_id = entry >> FIELD_BITS
+                    # The overlay has the current postings of changed bathrooms
+                    if bathroom_id in replaced or (candidates is not None and bathroom_id not in candidates):
+                        continue
+                    add(entry, quality)
+
+            for entry in self.overlay["postings"].get(word, ()):
+                add(entry, quality)
+
+        return scores
+
+    def get_locations(self, bathroom_ids):
+        """Look up bathrooms' locations.
+
+        bathroom_ids -- NumPy array of ids in the index
+
+        Returns tuple of NumPy arrays (latitudes, longitudes).
+        """
+
+        import numpy as np
+
+        latitudes = np.zeros(len(bathroom_ids))
+        longitudes = np.zeros(len(bathroom_ids))
+        if len(self.base["ids"]):
+            # Views of the base arrays, not copies
+            ids = np.frombuffer(self.base["ids"], dtype=np.int64)
+            positions = np.minimum(np.searchsorted(ids, bathroom_ids), len(ids) - 1)
+            latitudes = np.frombuffer(self.base["latitudes"], dtype=np.float64)[positions]
+            longitudes = np.frombuffer(self.base["longitudes"], dtype=np.float64)[positions]
+
+        for index in np.flatnonzero(np.isin(bathroom_ids, list(self.overlay["locations"]))):
+            latitudes[index], longitudes[index] = self.overlay["locations"][bathroom_ids[index]]
+
+        return latitudes, longitudes
+
+    def search(self, query, latitude=None, longitude=None, limit=20, radius_miles=None):
+        """Find bathrooms matching every word of query.
+
+        The last word also matches words it's the start of, unless query
+        ends with a space (the word is finished).
+
+        latitude, longitude -- optional - rank closer bathrooms higher
+        radius_miles -- optional - with a lat-long, only bathrooms this close
+
+        Returns list of (bathroom_id, score, distance in miles or None)
+        tuples, best first.
+        """
+
+        words = tokenize(query)
+        if not words:
+            return []
+
+        word_matches = [self.expand(word, prefix=(index == len(words) - 1 and not query[-1].isspace()))
+                        for index, word in enumerate(words)]
+        if not all(word_matches):
+            return []
+
+        # Rarest word first, later words only look at bathrooms already found
+        word_matches.sort(key=self.count_postings)
+        scores = None
+        for matches in word_matches:
+            word_scores = self.get_word_scores(matches, candidates=scores)
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {bathroom_id: score + word_scores[bathroom_id]
+                          for bathroom_id, score in scores.items() if bathroom_id in word_scores}
+            if not scores:
+                return []
+
+        if latitude is None or longitude is None:
+            # Best score first, lower bathroom_id breaks ties
+            best = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+            return [(bathroom_id, score, None) for bathroom_id, score in best]
+
+        # NumPy is slow to import, so only workers ranking by distance load it
+        import numpy as np
+        from snapshot import haversine_miles_array
+
+        bathroom_ids = np.fromiter(scores.keys(), dtype=np.int64, count=len(scores))
+        text_scores = np.fromiter(scores.values(), dtype=np.float64, count=len(scores))
+        distances = haversine_miles_array(float(latitude), float(longitude),
+                                          *self.get_locations(bathroom_ids))
+        ranked_scores = text_scores / (1 + distances / DISTANCE_SCALE_MILES)
+        if radius_miles is not None:
+            within = distances <= radius_miles
+            bathroom_ids, distances, ranked_scores = (bathroom_ids[within], distances[within],
+                                                      ranked_scores[within])
+
+        # Best score first, lower bathroom_id breaks ties, lexsort sorts by its last key first
+        order = np.lexsort((bathroom_ids, -ranked_scores))[:limit]
+
+        return [(int(bathroom_ids[index]), float(ranked_scores[index]), float(distances[index]))
+                for index in order]
+
+    def count_postings(self, matches):
+        """Returns how many postings a query word's matches have."""
+
+        count = 0
+        for word in matches:
+            position = self.get_word_position(word)
+            if position is not None:
+                count += len(self.base["postings"][position])
+            count += len(self.overlay["postings"].get(word, ()))
+
+        return count
+
+    def stats(self):
+        """Returns dictionary of index sizes and rebuild count."""
+
+        return {"bathrooms": len(self),
+                "words": len(self.base["vocabulary"]),
+                "overlay_bathrooms": len(self.overlay["locations"]),
+                "rebuilds": self.rebuilds}
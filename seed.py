@@ -1,26 +1,51 @@
 """Utility file to seed bathroom, user, and list data to crapp database""" 
-import requests
+import argparse
+import json
+import os
+import random
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 from model import (User, Bathroom, NamedList, ListItem, Checkin, Rating,
-                   connect_to_db, db)
+                   add_bathrooms_to_db, connect_to_db, db,
+                   get_bathroom_obj_from_dict, rebuild_bathroom_stats,
+                   rebuild_checkin_counters)
+from refuge import refuge_client
 from server import app
+from synthetic import (RATED_SHARE, choose_hot, get_checkin_counts,
+                       load_synthetic_data)
 from faker import Faker
 from faker.providers import internet
 
 fake = Faker()
 fake.add_provider(internet)
 
+# States searched when seeding bathrooms
+DEFAULT_REGIONS = ("California",)
+
+# Records which pages of a bathroom load have been committed
+CHECKPOINT_PATH = "seed_checkpoint.json"
+
 
 def load_users():
     """Generate and load users into crapp database."""
 
-    # Delete all rows in table to avoid duplicate data if run again
+    # Delete all rows in table to avoid duplicate data if run again, after
+    # the rows pointing at users
+    Rating.query.delete()
+    Checkin.query.delete()
+    ListItem.query.delete()
+    NamedList.query.delete()
     User.query.delete()
 
-    for i in range(30):
-        # Generate fake name and email to create fake users
+    emails = set()
+    while len(emails) < 30:
+        # Generate fake name and email to create fake users, emails are unique
         name = fake.name()
         email = fake.email()
+        if email in emails:
+            continue
+        emails.add(email)
         user = User(full_name=name, email=email)
 
         # Add user to database session 
@@ -30,33 +55,164 @@ def load_users():
     db.session.commit()
     print("Users Loaded")
 
-def load_bathrooms():
-    """Load bathroom data from api into crapp database."""
+def load_bathrooms(regions=DEFAULT_REGIONS, workers=8, per_page=100, batch_size=1000,
+                   checkpoint_path=CHECKPOINT_PATH):
+    """Load bathroom data from api into crapp database.
 
-    # Get request to get Response object with California bathrooms from refuge api
-    # Will be used as initial seed data for bathrooms table in crapp database
-    r = requests.get('https://www.refugerestrooms.org/api/v1/restrooms/search?page=1&per_page=100&offset=0&query=%22state%22:%22California%22')
+    Fetches every page of Refuge API search results for each region, several
+    pages at a time, and bulk inserts them in batches. Rows already in the
+    table are skipped rather than deleted first, so the table stays usable
+    while the load runs. Finished pages are saved to a checkpoint file, so
+    running again after a crash picks up where it left off.
 
-    # Get list of dictionaries from request 
-    bathrooms = r.json()
+    regions -- states to search the Refuge API for
+    workers -- most pages fetched at once
+    per_page -- bathrooms requested per page
+    batch_size -- bathrooms written per insert/commit
+    checkpoint_path -- file recording finished pages, removed once load is done
+    """
 
-    # Delete all rows in table to avoid duplicate data if run again
-    Bathroom.query.delete()
-
-    # Make Bathroom object for each bathroom from request
-    for bathroom in bathrooms:
-        bathroom = Bathroom(name=bathroom['name'], directions=bathroom['directions'], notes=bathroom['comment'], 
-                            state=bathroom['state'], city=bathroom['city'], country=bathroom['country'],
-                            latitude=bathroom['latitude'], longitude=bathroom['longitude'], 
-                            accessible=bathroom['accessible'], unisex=bathroom['unisex'],
-                            changing_table=bathroom['changing_table'], approved=bathroom['approved'])
-        
-        # Add each Bathroom object that has lat/long to the database session
-        if bathroom.latitude and bathroom.longitude:
-            db.session.add(bathroom)                    
-    # Commit added Bathroom objects to the database
-    db.session.commit()
-    print("Bathrooms Loaded")
+    checkpoint = load_checkpoint(checkpoint_path)
+    pages = fetch_bathroom_pages(regions, checkpoint, workers, per_page)
+
+    inserted = 0
+    skipped = 0
+    for batch, batch_pages in batch_bathrooms(pages, batch_size):
+        counts = add_bathrooms_to_db(batch)
+        inserted += counts["inserted"]
+        skipped += counts["skipped"]
+
+        # Only mark pages finished once their bathrooms are committed
+        for region, page, is_last_page in batch_pages:
+            region_progress = checkpoint.setdefault(region, {"pages": [], "last_page": None})
+            region_progress["pages"].append(page)
+            if is_last_page and (region_progress["last_page"] is None
+                                 or page < region_progress["last_page"]):
+                region_progress["last_page"] = page
+        save_checkpoint(checkpoint, checkpoint_path)
+
+    # Whole load finished, next run should start fresh
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    print(f"Bathrooms Loaded ({inserted} inserted, {skipped} skipped)")
+
+def fetch_bathroom_page(region, page, per_page):
+    """Get one page of Refuge API search results for region.
+
+    Returns list of bathroom dictionaries.
+    """
+
+    params = {"query": f'"state":"{region}"', "page": page, "per_page": per_page, "offset": 0}
+    # Search pages are slow to build upstream, allow a longer read timeout
+    r = refuge_client.get("/restrooms/search", params=params, timeout=(3.05, 30))
+
+    return r.json()
+
+def fetch_bathroom_pages(regions, checkpoint, workers, per_page):
+    """Fetch pages of bathrooms for regions concurrently, skipping finished pages.
+
+    Keeps at most workers requests in flight. A region's pages are fetched
+    until one comes back short, which marks that region's last page.
+
+    Yields tuples (region, page, is_last_page, bathroom dictionaries) as
+    pages arrive.
+    """
+
+    next_page = {}
+    last_page = {}
+    finished_pages = {}
+    for region in regions:
+        progress = checkpoint.get(region, {"pages": [], "last_page": None})
+        next_page[region] = 1
+        last_page[region] = progress["last_page"]
+        finished_pages[region] = set(progress["pages"])
+
+    turn = 0
+
+    def next_request():
+        """Returns (region, page) of next page to fetch, or None if no more.
+
+        Takes turns between regions so they're all fetched at once.
+        """
+
+        nonlocal turn
+        for offset in range(len(regions)):
+            region = regions[(turn + offset) % len(regions)]
+            while True:
+                page = next_page[region]
+                if last_page[region] is not None and page > last_page[region]:
+                    break
+                next_page[region] += 1
+                if page not in finished_pages[region]:
+                    turn += offset + 1
+                    return region, page
+
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = {}
+        while True:
+            # Top up the pool so workers requests are always running
+            while len(in_flight) < workers:
+                request = next_request()
+                if request is None:
+                    break
+                region, page = request
+                in_flight[pool.submit(fetch_bathroom_page, region, page, per_page)] = request
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                region, page = in_flight.pop(future)
+                bathrooms = future.result()
+
+                is_last_page = len(bathrooms) < per_page
+                if is_last_page and (last_page[region] is None or page < last_page[region]):
+                    last_page[region] = page
+
+                yield region, page, is_last_page, bathrooms
+
+def batch_bathrooms(pages, batch_size):
+    """Group fetched pages into batches of Bathroom objects.
+
+    Yields tuples (list of Bathroom objects, list of (region, page,
+    is_last_page) whose bathrooms are in the batch).
+    """
+
+    batch = []
+    batch_pages = []
+    for region, page, is_last_page, bathrooms in pages:
+        for bathroom in bathrooms:
+            batch.append(get_bathroom_obj_from_dict(bathroom))
+        batch_pages.append((region, page, is_last_page))
+
+        if len(batch) >= batch_size:
+            yield batch, batch_pages
+            batch = []
+            batch_pages = []
+
+    if batch_pages:
+        yield batch, batch_pages
+
+def load_checkpoint(checkpoint_path):
+    """Returns dictionary of finished pages per region from checkpoint file."""
+
+    if not os.path.exists(checkpoint_path):
+        return {}
+
+    with open(checkpoint_path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def save_checkpoint(checkpoint, checkpoint_path):
+    """Write checkpoint file, replacing it in one step so a crash can't corrupt it."""
+
+    temp_path = checkpoint_path + ".tmp"
+    with open(temp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temp_path, checkpoint_path)
 
 def load_named_lists():
     """Load initial named lists for all users to access."""
@@ -75,23 +231,107 @@ def load_named_lists():
 
 def load_list_items():
     """Load list items for users' lists."""
-    # TODO
 
-def load_checkins():
+    # Delete all rows in table to avoid duplicate data if run again
+    ListItem.query.delete()
+
+    rand = random.Random(0)
+    user_ids = [user_id for user_id, in db.session.query(User.user_id)]
+    list_ids = [list_id for list_id, in db.session.query(NamedList.list_id)]
+    bathroom_ids = [bathroom_id for bathroom_id, in db.session.query(Bathroom.bathroom_id)]
+
+    # Each user adds a few bathrooms, popular ones more often, to each list
+    rows = []
+    for user_id in user_ids:
+        for list_id in list_ids:
+            for index in {choose_hot(rand, 0, len(bathroom_ids)) for i in range(rand.randint(0, 5))}:
+                rows.append({"list_id": list_id, "user_id": user_id,
+                             "bathroom_id": bathroom_ids[index], "datetime_added": datetime.now()})
+
+    if rows:
+        db.session.execute(ListItem.__table__.insert(), rows)
+    db.session.commit()
+    print("List Items Loaded")
+
+def load_checkins(mean_checkins=10):
     """Load checkins for fake users created with load_users."""
-    # TODO
+
+    # Delete all rows in table to avoid duplicate data if run again
+    Rating.query.delete()
+    Checkin.query.delete()
+
+    rand = random.Random(0)
+    user_ids = [user_id for user_id, in db.session.query(User.user_id)]
+    bathroom_ids = [bathroom_id for bathroom_id, in db.session.query(Bathroom.bathroom_id)]
+
+    # A few power users check in a lot, mostly at a few popular bathrooms
+    rows = []
+    checkin_counts = get_checkin_counts(0, 0, len(user_ids), mean_checkins)
+    for user_id, checkin_count in zip(user_ids, checkin_counts):
+        for i in range(checkin_count):
+            rows.append({"user_id": user_id,
+                         "bathroom_id": bathroom_ids[choose_hot(rand, 0, len(bathroom_ids))],
+                         "checkin_datetime": datetime.now() - timedelta(minutes=rand.randint(0, 525600)),
+                         "rating_id": None})
+
+    if rows:
+        db.session.execute(Checkin.__table__.insert(), rows)
+    db.session.commit()
+    rebuild_checkin_counters()
+    print("Checkins Loaded")
 
 def load_ratings():
     """Load ratings for fake users created with load_users."""
-    # TODO
+
+    # Delete all rows in table to avoid duplicate data if run again
+    Rating.query.delete()
+
+    rand = random.Random(0)
+    rows = []
+    for checkin_id, user_id, bathroom_id in db.session.query(Checkin.checkin_id, Checkin.user_id,
+                                                             Checkin.bathroom_id):
+        if rand.random() < RATED_SHARE:
+            rows.append({"user_id": user_id, "bathroom_id": bathroom_id, "checkin_id": checkin_id,
+                         "score": rand.randint(1, 5), "review_text": None})
+
+    if rows:
+        db.session.execute(Rating.__table__.insert(), rows)
+    db.session.commit()
+    rebuild_bathroom_stats()
+    print("Ratings Loaded")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed the crapp database.")
+    parser.add_argument("--regions", nargs="+", default=DEFAULT_REGIONS,
+                        help="states to load bathrooms for")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="most Refuge API pages fetched at once")
+    parser.add_argument("--synthetic-users", type=int,
+                        help="instead of the usual seed data, generate this many users "
+                             "(plus bathrooms, lists, checkins and ratings)")
+    parser.add_argument("--synthetic-bathrooms", type=int, default=100000)
+    parser.add_argument("--mean-checkins", type=int, default=20,
+                        help="average checkins per synthetic user")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed for synthetic data")
+    args = parser.parse_args()
+
     connect_to_db(app)
 
     # In case tables haven't been created, create them
     db.create_all()
 
-    # Import data from load functions defined above 
-    load_users()
-    load_bathrooms()
-    load_named_lists()
+    if args.synthetic_users:
+        # Production-size data, generated by worker processes and bulk loaded
+        counts = load_synthetic_data(args.synthetic_users, args.synthetic_bathrooms,
+                                     mean_checkins=args.mean_checkins, seed=args.seed,
+                                     workers=args.workers)
+        print(f"Synthetic Data Loaded {counts}")
+    else:
+        # Import data from load functions defined above 
+        load_users()
+        load_bathrooms(regions=args.regions, workers=args.workers)
+        load_named_lists()
+        load_list_items()
+        load_checkins()
+        load_ratings()
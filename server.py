@@ -1,15 +1,28 @@
 """Flask app for crApp project."""
-import json
-import requests
+import os
+import secrets
 
-from flask import (Flask, render_template, redirect, jsonify, request, flash, 
-                   session, url_for)
-# from flask.ext.bcrypt import Bcrypt
-from flask_debugtoolbar import DebugToolbarExtension
+from datetime import datetime
 
-from model import (connect_to_db, db, get_bathrooms_by_lat_long,
-                   get_bathroom_objs_from_request, User, Bathroom, NamedList,
-                   Checkin, Rating, ListItem)
+from flask import (Flask, Response, render_template, redirect, jsonify, request,
+                   flash, session, url_for, abort, stream_with_context)
+# from flask.ext.bcrypt import Bcrypt
+from markupsafe import Markup
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+
+from cache import FragmentCache, LocalBackend, TileCache, connect_shared_backend
+from checkin_queue import CheckinQueue
+from clusters import ClusterIndex, MAX_CLUSTER_ZOOM, get_bathrooms_in_view
+from export import EXPORT_FORMATS, EXPORT_TABLES, generate_export
+from instrumentation import RequestMetrics
+from refuge import RefugeUnavailable, refuge_client
+from replicas import ReplicaRouter, get_connect_options, use_primary
+from search import SearchIndex
+from trending import get_busyness, get_trending
+from payloads import JsonPayload, PayloadCache
+from model import (connect_to_db, db, get_bathrooms_near_tile, find_nearby_bathrooms,
+                   record_rating, User, Bathroom, NamedList, Checkin, Rating, ListItem, SCORES)
 
 app = Flask(__name__)
 app.jinja_env.add_extension('jinja2.ext.do')
@@ -17,6 +30,83 @@ app.jinja_env.add_extension('jinja2.ext.do')
 # This is only temporary, will change later
 app.secret_key = 'SUpeRsecrEt'
 
+# Cache of Refuge API results per geohash tile (about 150m x 150m), so repeat
+# lookups from the same few blocks don't wait on the API. Swap the backend
+# for a cache.SharedBackend to share entries between workers, and pass
+# single_flight=SingleFlight(lock_dir=...) to coalesce misses between them.
+near_me_cache = TileCache(LocalBackend(max_entries=2048), precision=7, ttl=300)
+
+# JSON (and gzip/brotli) bodies of the tiles in near_me_cache, so a tile is
+# serialized once per fetch rather than once per request
+near_me_payloads = PayloadCache(max_entries=2048)
+
+# Checkins/ratings shown per page of the user hub
+HUB_PAGE_SIZE = 25
+
+# Rendered user hub, list and rating page content, tagged with the user,
+# list or rating it shows. Routes that write invalidate those tags. Set
+# CRAPP_CACHE_URL (ex redis://localhost:6379/0) when running several
+# workers, so tag versions are shared and an invalidation reaches them all.
+CACHE_URL = os.environ.get("CRAPP_CACHE_URL")
+page_cache = FragmentCache(LocalBackend(max_entries=4096), ttl=600,
+                           tag_backend=connect_shared_backend(CACHE_URL) if CACHE_URL else None)
+
+# Map marker clusters for each zoom level, built at startup and rebuilt from
+# the db in the background every 10 minutes
+bathroom_clusters = ClusterIndex(max_age=600)
+
+# Full-text index of bathroom names, places, directions and notes, built
+# at startup and refreshed incrementally in the background every minute
+search_index = SearchIndex(max_age=60)
+
+# Most results one search returns
+MAX_SEARCH_RESULTS = 50
+
+# Per-route wall/DB/upstream/render timings and query counts, requests over
+# half a second are logged with their queries
+request_metrics = RequestMetrics(slow_request_ms=500)
+request_metrics.init_app(app, refuge_client)
+
+# Read-only requests read from a replica (when connect_to_db was given any),
+# users' reads stay on the primary for a while after they write
+replica_router = ReplicaRouter(sticky_seconds=float(os.environ.get("DATABASE_STICKY_SECONDS", 10)))
+replica_router.init_app(app)
+
+# Columnar snapshot of bathrooms for filtered/ranked nearby searches, built
+# on first use (see get_bathroom_snapshot)
+bathroom_snapshot = None
+
+# Checkins are logged to local disk and inserted in batches (see
+# checkin_queue.py), keep the log directory on a persistent local disk
+checkin_queue = CheckinQueue(os.environ.get("CRAPP_CHECKIN_LOG_DIR", "checkin_logs"))
+checkin_queue.init_app(app)
+
+
+def forget_checkin_pages(rows):
+    """Re-render pages of users whose queued checkins were just inserted."""
+
+    for user_id in {row["user_id"] for row in rows}:
+        page_cache.invalidate(f"user:{user_id}")
+
+checkin_queue.listeners.append(forget_checkin_pages)
+
+
+def forget_bathroom_pages(bathroom_ids):
+    """Re-render pages showing bathrooms that were changed or merged away (ex rating pages)."""
+
+    for bathroom_id in bathroom_ids:
+        page_cache.invalidate(f"bathroom:{bathroom_id}")
+
+# Trending lists, by days and limit, for a minute
+trending_cache = LocalBackend(max_entries=64)
+
+# Most bathrooms one trending list shows
+MAX_TRENDING_RESULTS = 50
+
+# Token analytics sends (as a bearer token) to use the export endpoints,
+# exports are off if unset
+EXPORT_TOKEN = os.environ.get("CRAPP_EXPORT_TOKEN")
+
 @app.route('/')
 def homepage():
     """Show homepage."""
@@ -44,12 +134,11 @@ def process_reg():
     user_email = request.form.get("email")
     user_pswd = request.form.get("password")
 
-    # Try to get user from db, create user if not in db
-    try:
-        user_obj = User.query.filter_by(email=user_email, 
-                                        password=user_pswd).one()
+    # Emails are unique, get user from db by email, create user if not in db
+    user_obj = User.query.filter_by(email=user_email).first()
+    if user_obj:
         flash("You're already registered. Go ahead and log in!")
-    except:
+    else:
         user_obj = User(full_name=user_full_name, email=user_email, password=user_pswd)
         db.session.add(user_obj)
         db.session.commit()
@@ -89,44 +178,313 @@ def logout():
    flash("You're logged out. Cool.")
    return redirect("/")
 
+def get_or_render_page(key, tags, render):
+    """Get page content from page_cache, rendering it from the primary on a miss.
+
+    The write that invalidated the page may not have reached the replicas
+    yet, and what's rendered now is served to every user until the next
+    invalidation.
+
+    Returns HTML string.
+    """
+
+    def render_from_primary():
+        replica_router.read_from_primary()
+        return render()
+
+    return page_cache.get_or_render(key, tags, render_from_primary)
+
+def get_bathroom_snapshot():
+    """Returns the bathroom snapshot, making it the first time it's needed."""
+
+    global bathroom_snapshot
+
+    if bathroom_snapshot is None:
+        # NumPy is slow to import, so only workers that search with filters load it
+        from snapshot import BathroomSnapshot
+        bathroom_snapshot = BathroomSnapshot(max_age=30)
+
+    return bathroom_snapshot
+
+def make_json_response(payload):
+    """Send a JsonPayload, or 304 if the client's copy is current.
+
+    The body is gzip or brotli compressed when the client accepts it.
+
+    Returns Response object.
+    """
+
+    status, headers, body = payload.get_response(request.headers.get("If-None-Match"),
+                                                 request.headers.get("Accept-Encoding"))
+
+    return Response(body, status=status, headers=headers)
+
 @app.route('/get_near_me.json')
 def get_near_me():
-    """Get bathrooms near user location using python."""
+    """Get bathrooms near user location using python.
+
+    Optional query args accessible=1, unisex=1, changing_table=1, min_score
+    and sort=rating filter and rank our own bathrooms instead.
+    """
+
+    current_lat = request.args.get("lat", type=float)
+    current_long = request.args.get("lng", type=float)
+    if current_lat is None or current_long is None:
+        abort(400)
+
+    filters = {name: request.args.get(name) == "1"
+               for name in ("accessible", "unisex", "changing_table")}
+    min_score = request.args.get("min_score", type=float)
+    sort = request.args.get("sort", "distance")
+    if any(filters.values()) or min_score is not None or sort == "rating":
+        # Filtered or rating ranked searches are done in memory over our own bathrooms
+        snapshot = get_bathroom_snapshot()
+        ranked = snapshot.get_ranked_bathrooms(current_lat, current_long,
+                                               min_score=min_score, sort=sort, **filters)
+        return make_json_response(JsonPayload(ranked))
+
+    # Get bathrooms for the tile user is in, only calls refuge api on a miss
+    tile = near_me_cache.tile_for(current_lat, current_long)
+    try:
+        near_bathrooms_list = near_me_cache.get_or_fetch(tile, get_bathrooms_near_tile)
+    except RefugeUnavailable:
+        # Refuge API is down or slow, serve what we have locally (uncached)
+        return make_json_response(JsonPayload(find_nearby_bathrooms(current_lat, current_long)))
+
+    return make_json_response(near_me_payloads.get_payload(tile, near_bathrooms_list))
+
+@app.route('/bathrooms_in_view.json')
+def show_bathrooms_in_view():
+    """Get bathrooms in the map's viewport, clustered when zoomed out."""
+
+    south = request.args.get("south", type=float)
+    west = request.args.get("west", type=float)
+    north = request.args.get("north", type=float)
+    east = request.args.get("east", type=float)
+    zoom = request.args.get("zoom", type=int)
+    if None in (south, west, north, east, zoom):
+        abort(400)
+
+    # Zoomed in far enough that markers won't pile up, send single bathrooms
+    if zoom > MAX_CLUSTER_ZOOM:
+        in_view = {"zoom": zoom,
+                   "clusters": [],
+                   "bathrooms": get_bathrooms_in_view(south, west, north, east)}
+        return make_json_response(JsonPayload(in_view))
+
+    bathroom_clusters.refresh_if_stale()
+    in_view = {"zoom": zoom,
+               "clusters": bathroom_clusters.get_clusters(south, west, north, east, max(zoom, 0)),
+               "bathrooms": []}
+
+    return make_json_response(JsonPayload(in_view))
+
+@app.route('/search.json')
+def search_bathrooms():
+    """Search bathroom names, places, directions and notes.
+
+    Query args: q, the words to find (the last one can be partly typed),
+    and optionally lat and lng to rank closer bathrooms higher, radius in
+    miles to only find bathrooms that close, and limit.
+    """
+
+    query = request.args.get("q", "")
+    latitude = request.args.get("lat", type=float)
+    longitude = request.args.get("lng", type=float)
+    radius_miles = request.args.get("radius", type=float)
+    limit = min(request.args.get("limit", 20, type=int), MAX_SEARCH_RESULTS)
+    if not query.strip() or (latitude is None) != (longitude is None):
+        abort(400)
+
+    search_index.refresh_if_stale()
+    results = search_index.search(query, latitude, longitude, limit=limit, radius_miles=radius_miles)
+
+    # One query for the found bathrooms' details
+    bathrooms = (Bathroom.query.filter(Bathroom.bathroom_id.in_([result[0] for result in results]))
+                               .options(joinedload(Bathroom.stats)))
+    bathrooms_by_id = {bathroom.bathroom_id: bathroom for bathroom in bathrooms}
+
+    bathroom_dicts = []
+    for bathroom_id, score, distance in results:
+        bathroom = bathrooms_by_id.get(bathroom_id)
+        if bathroom is None:
+            # Deleted since the last refresh
+            continue
+        bathroom_dict = bathroom.to_dict(distance=distance)
+        bathroom_dict["score"] = round(score, 4)
+        bathroom_dicts.append(bathroom_dict)
+
+    return make_json_response(JsonPayload({"query": query, "results": bathroom_dicts}))
+
+@app.route('/busyness/<int:bathroom_id>.json')
+def show_busyness(bathroom_id):
+    """Show how busy a bathroom is now, its last day and week of checkins and its usual week."""
+
+    if Bathroom.query.get(bathroom_id) is None:
+        abort(404)
+
+    return make_json_response(JsonPayload(get_busyness(bathroom_id, datetime.now())))
+
+@app.route('/trending.json')
+def show_trending():
+    """Show bathrooms getting more checkins lately.
+
+    Optional query args: days compared (default 7, the last days days
+    against the days before) and limit.
+    """
+
+    days = request.args.get("days", 7, type=int)
+    limit = min(request.args.get("limit", 20, type=int), MAX_TRENDING_RESULTS)
+
+    payload = trending_cache.get(f"{days}:{limit}")
+    if payload is None:
+        trending = get_trending(datetime.now(), days=days, limit=limit)
+        bathrooms = (Bathroom.query.filter(Bathroom.bathroom_id.in_([row[0] for row in trending]))
+                                   .options(joinedload(Bathroom.stats)))
+        bathrooms_by_id = {bathroom.bathroom_id: bathroom for bathroom in bathrooms}
+
+        bathroom_dicts = []
+        for bathroom_id, recent, previous, score in trending:
+            bathroom = bathrooms_by_id.get(bathroom_id)
+            if bathroom is None:
+                # Deleted since its checkins were counted
+                continue
+            bathroom_dict = bathroom.to_dict()
+            bathroom_dict.update({"recent_checkins": recent,
+                                  "previous_checkins": previous,
+                                  "trend_score": round(score, 4)})
+            bathroom_dicts.append(bathroom_dict)
+
+        payload = JsonPayload({"days": days, "bathrooms": bathroom_dicts})
+        trending_cache.set(f"{days}:{limit}", payload, 60)
+
+    return make_json_response(payload)
+
+@app.route('/metrics.json')
+def show_metrics():
+    """Show cache, request coalescing, Refuge API and per-route metrics as JSON."""
+
+    return jsonify({"near_me_cache": near_me_cache.stats(),
+                    "near_me_single_flight": near_me_cache.single_flight.stats(),
+                    "near_me_payloads": near_me_payloads.stats(),
+                    "refuge_api": refuge_client.stats(),
+                    "checkin_queue": checkin_queue.stats(),
+                    "page_cache": page_cache.stats(),
+                    "search_index": search_index.stats(),
+                    "database": replica_router.stats(),
+                    "routes": request_metrics.to_dict()})
+
+@app.route('/metrics')
+def show_prometheus_metrics():
+    """Show per-route request and db pool metrics for Prometheus to scrape."""
+
+    return Response(request_metrics.to_prometheus() + replica_router.to_prometheus(),
+                    mimetype="text/plain; version=0.0.4")
+
+@app.route('/export/<table>.<export_format>')
+def export_table(table, export_format):
+    """Stream bathrooms, checkins or ratings as NDJSON or CSV for analytics.
+
+    Needs the export token in an "Authorization: Bearer <token>" header,
+    kept out of the URL so it doesn't end up in access logs or history.
+    Optional query args: start and end dates (YYYY-MM-DD), south, west,
+    north and east bounds, state, and gzip=1.
+    """
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    # Constant time compare, so the token can't be guessed a character at a time
+    if (EXPORT_TOKEN is None or scheme.lower() != "bearer"
+            or not secrets.compare_digest(token.strip().encode(), EXPORT_TOKEN.encode())):
+        abort(403)
+    if table not in EXPORT_TABLES or export_format not in EXPORT_FORMATS:
+        abort(404)
+
+    filters = {"state": request.args.get("state")}
+    try:
+        for name in ("start", "end"):
+            if request.args.get(name):
+                filters[name] = datetime.strptime(request.args[name], "%Y-%m-%d")
+    except ValueError:
+        abort(400)
+
+    bounds = [request.args.get(name, type=float) for name in ("south", "west", "north", "east")]
+    if any(bound is not None for bound in bounds):
+        if None in bounds:
+            abort(400)
+        filters["bounds"] = tuple(bounds)
+
+    use_gzip = request.args.get("gzip") == "1"
+    try:
+        chunks = generate_export(table, export_format, gzip=use_gzip, **filters)
+    except ValueError:
+        # Date range on a table without dates
+        abort(400)
 
-    current_lat = request.args.get("lat")
-    current_long = request.args.get("lng")
-    
-    # Makes request to refuge api by lat long
-    near_bathrooms_response = get_bathrooms_by_lat_long(current_lat, current_long)
-    near_bathrooms_list = near_bathrooms_response.json()
+    # Keep the request context (and db session) around while rows stream out
+    response = Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format])
+    response.headers["Content-Disposition"] = f"attachment; filename={table}.{export_format}"
+    if use_gzip:
+        response.headers["Content-Encoding"] = "gzip"
 
-    return jsonify(near_bathrooms_list)
+    return response
 
 @app.route('/users/<user_id>')
 def show_user_info(user_id):
     """Show user info"""
 
-    #Get/query user object with user id
-    user = User.query.get(user_id)
-
-    #Send particular attributes to template
-    return render_template('user_hub.html', user=user)
-
-@app.route('/lists/<list_id>')
+    # As a number, so "05" and "5" share cached pages and their invalidation
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        abort(404)
+
+    checkins_page = request.args.get("checkins_page", 1, type=int)
+    ratings_page = request.args.get("ratings_page", 1, type=int)
+
+    def render_content():
+        #Get/query user object with user id, loading lists in one more query
+        user = User.query.options(selectinload(User.lists)).get(user_id)
+
+        #Get one page of checkins and ratings, joined to the bathroom/rating the
+        #template shows so it doesn't lazy load them one at a time
+        checkins = (Checkin.query.filter_by(user_id=user_id)
+                                 .options(joinedload(Checkin.bathroom), joinedload(Checkin.rating))
+                                 .order_by(Checkin.checkin_datetime.desc(), Checkin.checkin_id.desc())
+                                 .paginate(page=checkins_page, per_page=HUB_PAGE_SIZE, error_out=False))
+        ratings = (Rating.query.filter_by(user_id=user_id)
+                               .options(joinedload(Rating.bathroom))
+                               .order_by(Rating.rating_id.desc())
+                               .paginate(page=ratings_page, per_page=HUB_PAGE_SIZE, error_out=False))
+
+        #Send particular attributes to template
+        return render_template('user_hub_content.html', user=user, checkins=checkins, ratings=ratings)
+
+    # Repeat views skip the queries and rendering until the user's data changes
+    content = get_or_render_page(f"user_hub:{user_id}:{checkins_page}:{ratings_page}",
+                                       [f"user:{user_id}"], render_content)
+    return render_template('user_hub.html', content=Markup(content))
+
+@app.route('/lists/<int:list_id>')
 def show_user_list(list_id):
     """Show User's lists."""
 
     if session.get('user_id'):
         user_id = session.get('user_id')
-        user = User.query.get(user_id)
-        named_list = NamedList.query.get(list_id)
-        checkins = user.checkins
-        bathrooms = db.session.query(Bathroom).join(Checkin).filter(Checkin.user_id == user_id).all()
-
-        return render_template('list_items.html', 
-                                user=user, 
-                                named_list=named_list, 
-                                bathrooms=bathrooms)
+
+        def render_content():
+            user = User.query.get(user_id)
+            named_list = NamedList.query.get(list_id)
+            bathrooms = db.session.query(Bathroom).join(Checkin).filter(Checkin.user_id == user_id).all()
+
+            return render_template('list_items_content.html', 
+                                    user=user, 
+                                    named_list=named_list, 
+                                    bathrooms=bathrooms)
+
+        # Shows the list's items and the bathrooms this user checked in to
+        content = get_or_render_page(f"list:{list_id}:{user_id}",
+                                           [f"list:{list_id}", f"user:{user_id}"], render_content)
+        return render_template('list_items.html', content=Markup(content))
     else:
         flash("You must be logged in to view your lists.")
         return redirect('/login')
@@ -155,6 +513,8 @@ def process_add_list_form():
         list_to_add = NamedList(list_name=form_list, user_id=user_id)
         db.session.add(list_to_add)
         db.session.commit()
+        # The user hub shows the new list
+        page_cache.invalidate(f"user:{user_id}")
         flash('Success! Your list has been created.')
 
         return redirect(url_for('show_user_info', user_id=user_id))
@@ -162,19 +522,27 @@ def process_add_list_form():
         flash("You must be logged in to add a list.")
         return redirect('/login')
 
-@app.route('/add_list_item/<bathroom_id>/<list_id>')
+@app.route('/add_list_item/<int:bathroom_id>/<int:list_id>')
+@use_primary
 def process_add_list_item(bathroom_id, list_id):
     """Adds specified bathroom to user's specified list."""
 
     if session.get('user_id'):
         user_id = session.get('user_id')
 
-        # Make ListItem object and add to db.
-        list_item = ListItem(user_id=user_id, list_id=list_id, bathroom_id=bathroom_id)
-        db.session.add(list_item)
-        db.session.commit()
+        # A user adds a bathroom to a list once
+        list_item = ListItem.query.filter_by(list_id=list_id, user_id=user_id,
+                                             bathroom_id=bathroom_id).first()
+        if list_item:
+            flash("That bathroom is already on your list.")
+        else:
+            # Make ListItem object and add to db.
+            list_item = ListItem(user_id=user_id, list_id=list_id, bathroom_id=bathroom_id)
+            db.session.add(list_item)
+            db.session.commit()
+            page_cache.invalidate(f"list:{list_id}")
+            flash("The bathroom has been added to your list. Cool!")
 
-        flash("The bathroom has been added to your list. Cool!")
         return redirect(url_for('show_user_list', list_id=list_id))
     else:
         flash("You must be logged in to add a list.")
@@ -182,20 +550,22 @@ def process_add_list_item(bathroom_id, list_id):
 
 
 
-@app.route('/checkin/<bathroom_id>')
+@app.route('/checkin/<int:bathroom_id>')
+@use_primary
 def show_checkin(bathroom_id):
     """Show checkin form."""
 
     if session.get('user_id'):
         user_id = session.get('user_id')
-
-        # Make checkin object, add it to the db
-        checkin = Checkin(user_id, bathroom_id)
-        db.session.add(checkin)
-        db.session.commit()
-
-        # Get checkin_id from the checkin just created
-        checkin_id = checkin.checkin_id
+        # Checked now, the insert is too late to refuse a checkin already given an id
+        if Bathroom.query.get(bathroom_id) is None:
+            abort(404)
+
+        # Queue the checkin, it's inserted with others in a moment but its
+        # checkin_id is already final
+        checkin_id = checkin_queue.add(user_id, bathroom_id)
+        # Read the rating form and hub from the primary, replicas won't have it yet
+        replica_router.record_write()
         return render_template('checkin.html', 
                                bathroom_id=bathroom_id, 
                                checkin_id=checkin_id)
@@ -203,14 +573,19 @@ def show_checkin(bathroom_id):
         flash("You must be logged in to checkin.")
         return redirect('/login')
 
-@app.route('/rate/<bathroom_id>/<checkin_id>', methods=["GET"])
+@app.route('/rate/<int:bathroom_id>/<int:checkin_id>', methods=["GET"])
 def show_rate_bathroom_form(bathroom_id, checkin_id):
     """Show form for user to rate a bathroom."""
 
     if session.get('user_id'):
         user_id = session.get('user_id')
+        # The checkin may still be queued, here or by another worker
+        checkin_queue.wait_for(checkin_id)
+        checkin = Checkin.query.filter_by(checkin_id=checkin_id, user_id=user_id,
+                                          bathroom_id=bathroom_id).first()
+        if checkin is None:
+            abort(404)
         bathroom = Bathroom.query.get(bathroom_id)
-        checkin = Checkin.query.get(checkin_id)
         return render_template('rating_form.html',
                                bathroom=bathroom,
                                checkin=checkin)
@@ -218,13 +593,31 @@ def show_rate_bathroom_form(bathroom_id, checkin_id):
         flash("You must be logged in to rate a bathroom.")
         return redirect('/login')
 
-@app.route('/rate/<bathroom_id>/<checkin_id>', methods=['POST'])
+@app.route('/rate/<int:bathroom_id>/<int:checkin_id>', methods=['POST'])
 def process_rate_bathroom(bathroom_id, checkin_id):
     """Process user rating and add to db."""
     
     if session.get('user_id'):
         user_id = session.get('user_id')
-        score = request.form.get('rating')
+        score = request.form.get('rating', type=int)
+        if score not in SCORES:
+            flash("Pick a rating from 1 to 5.")
+            return redirect(url_for('show_rate_bathroom_form', bathroom_id=bathroom_id,
+                                    checkin_id=checkin_id))
+
+        # Rating needs its checkin in the db, a missing one 404s below
+        checkin_queue.wait_for(checkin_id)
+
+        # Users only rate their own checkins, at the bathroom they checked in to
+        checkin = Checkin.query.filter_by(checkin_id=checkin_id, user_id=user_id,
+                                          bathroom_id=bathroom_id).first()
+        if checkin is None:
+            abort(404)
+
+        # One rating per checkin
+        if Rating.query.filter_by(checkin_id=checkin_id).first():
+            flash("You've already rated this checkin.")
+            return redirect('/')
         review_text = request.form.get('review_text')
 
         # Make Rating object and add to db
@@ -234,22 +627,50 @@ def process_rate_bathroom(bathroom_id, checkin_id):
                         score=score, 
                         review_text=review_text)
         db.session.add(rating)
-        db.session.commit()
+        try:
+            # Update bathroom's rating stats in the same transaction
+            record_rating(rating)
+            db.session.commit()
+        except IntegrityError:
+            # The form was submitted twice and the other submit rated it first
+            db.session.rollback()
+            flash("You've already rated this checkin.")
+            return redirect('/')
+        # The user hub shows the rating
+        page_cache.invalidate(f"user:{user_id}")
+        page_cache.invalidate(f"rating:{rating.rating_id}")
         flash("Rating submitted. Thanks!")
         return redirect('/')
     else:
         flash("You must be logged in to add a rating.")
         return redirect('/login')
 
-@app.route('/rating/<rating_id>')
+@app.route('/rating/<int:rating_id>')
 def show_user_bathroom_rating(rating_id):
     """Show User's rating for a bathroom."""
 
-    rating = Rating.query.filter_by(rating_id=rating_id).first()
-    return render_template('user_bathroom_rating.html', rating=rating)
+    # Looked up outside the cached render, so a missing rating isn't cached
+    rating = Rating.query.get(rating_id)
+    if rating is None:
+        abort(404)
+
+    def render_content():
+        return render_template('user_bathroom_rating_content.html', rating=rating)
+
+    # Ratings aren't edited, the page changes if its bathroom does (ex a dedupe merge)
+    content = get_or_render_page(f"rating:{rating_id}",
+                                 [f"rating:{rating_id}", f"bathroom:{rating.bathroom_id}"],
+                                 render_content)
+    return render_template('user_bathroom_rating.html', content=Markup(content))
 
 if __name__ == "__main__":
+    # Debug toolbar is only for local development, keep it out of worker startup
+    from flask_debugtoolbar import DebugToolbarExtension
+
     app.debug = True
-    connect_to_db(app)
+    connect_to_db(app, os.environ.get("DATABASE_URL", "postgresql:///crapp"),
+                  **get_connect_options(os.environ))
     DebugToolbarExtension(app)
+    search_index.start_refresh(app)
+    bathroom_clusters.start_refresh(app)
     app.run(host="0.0.0.0", port="5000")
@@ -0,0 +1,183 @@
+"""Coalesce concurrent identical lookups into a single upstream call."""
+
+import os
+import threading
+import zlib
+
+# Lock files keys are hashed into, so lock_dir doesn't gain a file for every
+# key ever looked up. Keys sharing a file only wait on each other briefly.
+LOCK_FILES = 256
+
+
+class _Call:
+    """A lookup in progress that other callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Registry of in-flight lookups, so callers asking for the same key share one call.
+
+    Within a process, the first caller for a key makes the call and later
+    callers wait for its result. With lock_dir set, processes also take turns
+    through a file lock for the key (one of LOCK_FILES), and a process that
+    had to wait checks the shared cache before making the call itself.
+    """
+
+    def __init__(self, lock_dir=None):
+        """Initialize a SingleFlight object.
+
+        lock_dir -- optional - directory for the lock files, set it to
+                    coalesce across processes on this machine
+
+        Returns: SingleFlight object
+        """
+
+        self.lock_dir = lock_dir
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fetch, recheck=None):
+        """Get value for key, sharing one call to fetch() with concurrent callers.
+
+        key -- lookups with the same key are coalesced
+        fetch -- function making the real call
+        recheck -- optional - function returning a cached value (or None),
+                   tried after waiting on another process
+
+        Returns value from fetch() (or recheck()). If fetch raises, every
+        caller waiting on it gets the same exception.
+        """
+
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is None:
+                call = _Call()
+                self._in_flight[key] = call
+                is_leader = True
+            else:
+                self.coalesced += 1
+                is_leader = False
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = self._call(key, fetch, recheck)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+        return call.value
+
+    def _call(self, key, fetch, recheck):
+        """Make the call for key, taking the cross-process lock if configured."""
+
+        if self.lock_dir is None:
+            return self._fetch(fetch)
+
+        # File locks are Unix only, so only import when they're used
+        import fcntl
+
+        # crc32 rather than hash(), which differs between processes
+        lock_number = zlib.crc32(str(key).encode()) % LOCK_FILES
+        lock_path = os.path.join(self.lock_dir, f"singleflight-{lock_number}.lock")
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is making this call, wait for it to finish
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                value = recheck() if recheck is not None else None
+                if value is not None:
+                    with self._lock:
+                        self.coalesced += 1
+                    return value
+
+            try:
+                return self._fetch(fetch)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _fetch(self, fetch):
+        """Count and make the real call."""
+
+        with self._lock:
+            self.calls += 1
+
+        return fetch()
+
+    def stats(self):
+        """Returns dictionary of calls made and calls coalesced."""
+
+        return {"calls": self.calls,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._in_flight)}
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on one event loop.
+
+    The first caller for a key awaits the fetch, later callers await the same
+    future instead of making their own call.
+    """
+
+    def __init__(self):
+        """Initialize an AsyncSingleFlight object.
+
+        Returns: AsyncSingleFlight object
+        """
+
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+
+    async def do(self, key, fetch):
+        """Get value for key, sharing one await of fetch() with concurrent callers.
+
+        key -- lookups with the same key are coalesced
+        fetch -- coroutine function making the real call
+
+        Returns value from fetch(). If fetch raises, every caller waiting on
+        it gets the same exception.
+        """
+
+        # Imported here so the sync app doesn't pay for asyncio
+        import asyncio
+
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # shield so one waiter being cancelled doesn't cancel the others' call
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(fetch())
+        self._in_flight[key] = future
+        self.calls += 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                del self._in_flight[key]
+            else:
+                # Leader was cancelled, let the call finish for the others
+                future.add_done_callback(lambda done: self._in_flight.pop(key, None))
+
+    def stats(self):
+        """Returns dictionary of calls made and calls coalesced."""
+
+        return {"calls": self.calls,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._in_flight)}
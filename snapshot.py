@@ -0,0 +1,272 @@
+"""Columnar in-memory snapshot of bathrooms for fast nearby ranking.
+
+Bathroom locations, yes/no features and rating stats are kept as NumPy
+arrays, so distances, filters and top-k picks for a search run over whole
+arrays at once instead of row by row over Bathroom objects. The snapshot
+refreshes incrementally, only reading bathrooms added or changed since the
+last refresh.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from geo import EARTH_RADIUS_MILES, bearing_degrees
+from model import Bathroom, BathroomStats, db, get_bathrooms_deleted_at
+from sqlalchemy.orm import joinedload
+
+# Bits in the flags array
+ACCESSIBLE = 1
+UNISEX = 2
+CHANGING_TABLE = 4
+
+# Miles per degree of latitude
+MILES_PER_DEGREE = 69.0
+
+
+def get_snapshot_query():
+    """Returns query of every column the snapshot keeps, one row per bathroom."""
+
+    return (db.session.query(Bathroom.bathroom_id, Bathroom.latitude, Bathroom.longitude,
+                             Bathroom.accessible, Bathroom.unisex, Bathroom.changing_table,
+                             Bathroom.refuge_updated_at, BathroomStats.rating_count,
+                             BathroomStats.score_sum, BathroomStats.last_rated_at)
+                      .outerjoin(BathroomStats, BathroomStats.bathroom_id == Bathroom.bathroom_id)
+                      .order_by(Bathroom.bathroom_id))
+
+
+def haversine_miles_array(latitude, longitude, latitudes, longitudes):
+    """Great-circle distance from one lat-long to arrays of lat-longs.
+
+    Returns array of distances in miles.
+    """
+
+    lat1 = np.radians(latitude)
+    lat2 = np.radians(latitudes)
+    dlat = lat2 - lat1
+    dlong = np.radians(longitudes - longitude)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlong / 2) ** 2
+
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+
+class BathroomSnapshot:
+    """Every bathroom's location, flags and rating stats as NumPy arrays.
+
+    arrays holds ids, latitudes, longitudes, flags, rating_counts and
+    mean_scores ordered by bathroom_id (new bathrooms always have higher ids,
+    so they're appended), plus by_latitude, positions sorted by latitude,
+    and sorted_latitudes, so a search only looks at the band of latitudes
+    within its radius. Refreshes build a new arrays dictionary and swap it
+    in, so searches running at the same time see one version or the other.
+    """
+
+    def __init__(self, max_age=30):
+        """Initialize a BathroomSnapshot object.
+
+        max_age -- seconds before searches trigger an incremental refresh
+
+        Returns: BathroomSnapshot object
+        """
+
+        self.max_age = max_age
+        self.refreshed_at = None
+        self.max_bathroom_id = 0
+        self.updated_watermark = None
+        self.rated_watermark = None
+        self.deleted_at = None
+        self._lock = threading.Lock()
+        self.set_rows([])
+
+    def __len__(self):
+        return len(self.arrays["ids"])
+
+    def set_rows(self, rows):
+        """Replace the whole snapshot with rows from get_snapshot_query."""
+
+        self.max_bathroom_id = 0
+        self.updated_watermark = None
+        self.rated_watermark = None
+        self.arrays = self.make_arrays(rows)
+        self.update_watermarks(rows)
+
+    def apply_rows(self, rows):
+        """Update bathrooms already in the snapshot and append new ones.
+
+        rows -- rows from get_snapshot_query, sorted by bathroom_id
+        """
+
+        if not rows:
+            return
+
+        current = self.arrays
+        changes = self.make_arrays(rows)
+        positions = np.minimum(np.searchsorted(current["ids"], changes["ids"]),
+                               max(len(current["ids"]) - 1, 0))
+        if len(current["ids"]):
+            existing = current["ids"][positions] == changes["ids"]
+        else:
+            existing = np.zeros(len(rows), dtype=bool)
+
+        # Bathrooms already in the snapshot are overwritten, the rest appended
+        columns = {}
+        for name in ("ids", "latitudes", "longitudes", "flags", "rating_counts", "mean_scores"):
+            values = current[name].copy()
+            values[positions[existing]] = changes[name][existing]
+            columns[name] = np.concatenate([values, changes[name][~existing]])
+
+        self.arrays = self.sort_by_latitude(columns)
+        self.update_watermarks(rows)
+
+    def make_arrays(self, rows):
+        """Returns arrays dictionary for rows from get_snapshot_query."""
+
+        columns = {
+            "ids": np.array([row[0] for row in rows], dtype=np.int64),
+            "latitudes": np.array([float(row[1]) for row in rows], dtype=np.float64),
+            "longitudes": np.array([float(row[2]) for row in rows], dtype=np.float64),
+            "flags": np.array([(ACCESSIBLE if row[3] else 0) | (UNISEX if row[4] else 0)
+                               | (CHANGING_TABLE if row[5] else 0) for row in rows],
+                              dtype=np.uint8),
+            "rating_counts": np.array([row[7] or 0 for row in rows], dtype=np.int32),
+            "mean_scores": np.array([row[8] / row[7] if row[7] else np.nan for row in rows],
+                                    dtype=np.float32)}
+
+        return self.sort_by_latitude(columns)
+
+    def sort_by_latitude(self, columns):
+        """Returns columns with by_latitude and sorted_latitudes added."""
+
+        columns["by_latitude"] = np.argsort(columns["latitudes"], kind="mergesort")
+        columns["sorted_latitudes"] = columns["latitudes"][columns["by_latitude"]]
+
+        return columns
+
+    def update_watermarks(self, rows):
+        """Move max_bathroom_id and the change watermarks past rows."""
+
+        for row in rows:
+            self.max_bathroom_id = max(self.max_bathroom_id, row[0])
+            if row[6] is not None:
+                self.updated_watermark = max(row[6], self.updated_watermark or row[6])
+            if row[9] is not None:
+                self.rated_watermark = max(row[9], self.rated_watermark or row[9])
+
+    def refresh(self):
+        """Read bathrooms added or changed since the last refresh.
+
+        Added means a higher bathroom_id, changed means a newer Refuge
+        update or a newer rating. If bathrooms were deleted (ex by a dedupe
+        merge, see model.record_bathroom_deletions), the whole snapshot is
+        rebuilt.
+
+        Rows are read into a list, make_arrays goes over them once per column.
+        """
+
+        # Read first, so bathrooms deleted during a rebuild are caught next time
+        deleted_at = get_bathrooms_deleted_at()
+
+        if self.refreshed_at is None or deleted_at != self.deleted_at:
+            self.set_rows(get_snapshot_query().all())
+        else:
+            # >= so changes committed in the same instant as the last refresh aren't missed
+            changed = [Bathroom.bathroom_id > self.max_bathroom_id]
+            if self.updated_watermark is None:
+                changed.append(Bathroom.refuge_updated_at.isnot(None))
+            else:
+                changed.append(Bathroom.refuge_updated_at >= self.updated_watermark)
+            if self.rated_watermark is None:
+                changed.append(BathroomStats.last_rated_at.isnot(None))
+            else:
+                changed.append(BathroomStats.last_rated_at >= self.rated_watermark)
+            self.apply_rows(get_snapshot_query().filter(db.or_(*changed)).all())
+
+        self.deleted_at = deleted_at
+        self.refreshed_at = time.monotonic()
+
+    def refresh_if_stale(self):
+        """Refresh from the database if older than max_age."""
+
+        with self._lock:
+            if self.refreshed_at is None or time.monotonic() - self.refreshed_at > self.max_age:
+                self.refresh()
+
+    def find_nearest(self, latitude, longitude, limit=30, radius_miles=1.0, accessible=False,
+                     unisex=False, changing_table=False, min_score=None, sort="distance"):
+        """Rank bathrooms near a lat-long.
+
+        accessible, unisex, changing_table -- only bathrooms with these
+        min_score -- optional - only bathrooms with at least this average score
+        sort -- distance (closest first) or rating (best average score
+                first, then closest)
+
+        Returns list of (bathroom_id, distance in miles) tuples.
+        """
+
+        arrays = self.arrays
+        latitude = float(latitude)
+        longitude = float(longitude)
+
+        # Only the band of latitudes within the radius, found by binary search
+        lat_margin = radius_miles / MILES_PER_DEGREE
+        start, end = np.searchsorted(arrays["sorted_latitudes"],
+                                     [latitude - lat_margin, latitude + lat_margin])
+        candidates = arrays["by_latitude"][start:end]
+
+        required = ((ACCESSIBLE if accessible else 0) | (UNISEX if unisex else 0)
+                    | (CHANGING_TABLE if changing_table else 0))
+        keep = (arrays["flags"][candidates] & required) == required
+        if min_score is not None:
+            keep &= arrays["mean_scores"][candidates] >= min_score
+        candidates = candidates[keep]
+
+        distances = haversine_miles_array(latitude, longitude, arrays["latitudes"][candidates],
+                                          arrays["longitudes"][candidates])
+        within = distances <= radius_miles
+        candidates = candidates[within]
+        distances = distances[within]
+
+        if sort == "rating":
+            # Unrated bathrooms last, lexsort sorts by its last key first
+            scores = arrays["mean_scores"][candidates]
+            scores = np.where(np.isnan(scores), 0, scores)
+            order = np.lexsort((distances, -scores))[:limit]
+        elif len(distances) > limit:
+            # Pick the closest limit without sorting everything, then sort those
+            order = np.argpartition(distances, limit)[:limit]
+            order = order[np.argsort(distances[order])]
+        else:
+            order = np.argsort(distances)
+
+        return [(int(arrays["ids"][position]), float(distance))
+                for position, distance in zip(candidates[order], distances[order])]
+
+    def get_ranked_bathrooms(self, latitude, longitude, limit=30, radius_miles=1.0, **filters):
+        """Find bathrooms near a lat-long, filtered and ranked (see find_nearest).
+
+        Returns list of bathroom dictionaries (see Bathroom.to_dict) with
+        distance and bearing, in ranked order.
+        """
+
+        self.refresh_if_stale()
+        ranked = self.find_nearest(latitude, longitude, limit, radius_miles, **filters)
+        if not ranked:
+            return []
+
+        # One query for the ranked bathrooms' details
+        ranked_ids = [bathroom_id for bathroom_id, distance in ranked]
+        bathrooms = (Bathroom.query.filter(Bathroom.bathroom_id.in_(ranked_ids))
+                                   .options(joinedload(Bathroom.stats)))
+        bathrooms_by_id = {bathroom.bathroom_id: bathroom for bathroom in bathrooms}
+
+        bathroom_dicts = []
+        for bathroom_id, distance in ranked:
+            bathroom = bathrooms_by_id.get(bathroom_id)
+            if bathroom is None:
+                # Deleted since the last refresh
+                continue
+            bearing = bearing_degrees(latitude, longitude, bathroom.latitude, bathroom.longitude)
+            bathroom_dicts.append(bathroom.to_dict(distance=distance, bearing=bearing))
+
+        return bathroom_dicts
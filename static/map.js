@@ -3,6 +3,8 @@
 // Global variable for map
 var map;
 let markers = [];
+// Markers for bathrooms/clusters in the current viewport
+let view_markers = [];
 var icon;
 var user_location_icon;
 var user_marker;
@@ -235,6 +237,9 @@ function initMap() {
 
     const infoWindow = new google.maps.InfoWindow;
 
+    // Show bathrooms in view whenever the map stops moving
+    map.addListener('idle', showBathroomsInView);
+
     // Try HTML5 geolocation.
     if (navigator.geolocation) {
       navigator.geolocation.getCurrentPosition(function(position) {
@@ -351,6 +356,59 @@ function getNearBathrooms(response) {
     }
 }
 
+// Gets bathrooms (or clusters of them when zoomed out) in the map's viewport
+function showBathroomsInView() {
+    const bounds = map.getBounds();
+    if (!bounds) {
+        return;
+    }
+    const view = {
+        south: bounds.getSouthWest().lat(),
+        west: bounds.getSouthWest().lng(),
+        north: bounds.getNorthEast().lat(),
+        east: bounds.getNorthEast().lng(),
+        zoom: map.getZoom()
+    };
+
+    $.get('/bathrooms_in_view.json', view, drawBathroomsInView);
+}
+
+// Replaces viewport markers with the clusters and bathrooms from response
+function drawBathroomsInView(response) {
+    for (const marker of view_markers) {
+        marker.setMap(null);
+    }
+    view_markers = [];
+
+    for (const cluster of response.clusters) {
+        const position = { lat: cluster.latitude, lng: cluster.longitude };
+        let marker;
+        if (cluster.count === 1) {
+            marker = addMarker(icon, position, 'Bathroom', map);
+        } else {
+            // Zoom in on cluster when it's clicked
+            marker = new google.maps.Marker({
+                position: position,
+                map: map,
+                label: String(cluster.count),
+                title: `${cluster.count} bathrooms`
+            });
+            marker.addListener('click', () => {
+                map.setZoom(map.getZoom() + 2);
+                map.panTo(position);
+            });
+        }
+        view_markers.push(marker);
+    }
+
+    for (const bathroom of response.bathrooms) {
+        const position = { lat: bathroom.latitude, lng: bathroom.longitude };
+        const marker = addMarker(icon, position, bathroom.name, map);
+        addInfoWindowToMarker(marker, map);
+        view_markers.push(marker);
+    }
+}
+
 function handleGetBathrooms(evt) {
     evt.preventDefault();
     user_coords = geolocateUser();
@@ -0,0 +1,228 @@
+"""Incremental sync of bathrooms from the Refuge API.
+
+Each run asks Refuge for bathrooms created or updated since the watermark
+saved by the last run and upserts just those, matched on Refuge's id, so a
+refresh costs the size of the change instead of reloading every bathroom.
+Run it on a schedule (ex cron) with python manage.py sync.
+"""
+
+from datetime import datetime, timedelta
+
+from dedupe import get_grid_entry
+from model import (Bathroom, SyncState, db, get_bathroom_obj_from_dict,
+                   get_duplicate_grid, get_lat_long_key, insert_bathroom_rows)
+from refuge import refuge_client
+
+SYNC_NAME = "refuge_bathrooms"
+
+# Bathrooms per Refuge API page during a sync
+SYNC_PAGE_SIZE = 100
+
+# Refuge's by_date endpoint only takes a day, start a day early so records
+# updated late on the watermark's day (in any timezone) aren't missed
+WATERMARK_OVERLAP = timedelta(days=1)
+
+# Columns a sync overwrites on bathrooms that already exist
+SYNCED_COLUMNS = ("name", "directions", "notes", "city", "state", "country", "latitude",
+                  "longitude", "geohash", "unisex", "accessible", "changing_table",
+                  "approved", "refuge_id", "refuge_updated_at", "upvotes", "downvotes")
+
+
+def fetch_changed_bathrooms(since, page, per_page=SYNC_PAGE_SIZE):
+    """Get one page of bathrooms the Refuge API created or updated since a date.
+
+    Returns list of bathroom dictionaries, raises refuge.RefugeUnavailable if
+    the call fails.
+    """
+
+    params = {"page": page, "per_page": per_page, "offset": 0, "updated": "true",
+              "day": since.day, "month": since.month, "year": since.year}
+
+    return refuge_client.get("/restrooms/by_date", params=params, timeout=(3.05, 30)).json()
+
+
+def is_newer(updated_at, other_updated_at):
+    """Returns True if updated_at is later than other_updated_at (None is oldest)."""
+
+    return (updated_at or datetime.min) > (other_updated_at or datetime.min)
+
+
+def keep_taken_locations(changed_rows):
+    """Leave bathrooms where they are if Refuge moved them onto another bathroom's lat-long.
+
+    The lat-long is a unique key, so moving one there would fail the whole
+    sync batch. The rest of the update still applies.
+
+    changed_rows -- update dictionaries with bathroom_id and SYNCED_COLUMNS,
+                    latitude, longitude and geohash are removed from ones that
+                    can't move
+    """
+
+    owners = {}
+    latitudes = sorted({get_lat_long_key(row["latitude"], row["longitude"])[0]
+                        for row in changed_rows})
+    for start in range(0, len(latitudes), 500):
+        query = (db.session.query(Bathroom.latitude, Bathroom.longitude, Bathroom.bathroom_id)
+                           .filter(Bathroom.latitude.in_(latitudes[start:start + 500])))
+        for latitude, longitude, bathroom_id in query:
+            owners[get_lat_long_key(latitude, longitude)] = bathroom_id
+
+    for row in changed_rows:
+        lat_long = get_lat_long_key(row["latitude"], row["longitude"])
+        if owners.setdefault(lat_long, row["bathroom_id"]) != row["bathroom_id"]:
+            for column in ("latitude", "longitude", "geohash"):
+                del row[column]
+
+
+def upsert_bathrooms(bathrooms, on_change=None):
+    """Insert new bathrooms and update ones Refuge has changed since we stored them.
+
+    Bathrooms are matched on refuge_id, falling back to lat-long for rows
+    stored before refuge_id existed. New bathrooms that are near-duplicates
+    (see dedupe.py) of one we have aren't inserted, ex ones
+    merge_duplicate_bathrooms merged away, the bathroom kept takes their
+    refuge_id if it doesn't have one. Updates that would move a bathroom
+    onto another's lat-long leave it where it is (see keep_taken_locations).
+    Rows that are already up to date are left alone, so re-applying a page
+    is harmless.
+
+    bathrooms -- list of Bathroom objects from Refuge API dictionaries
+    on_change -- optional - called with the list of updated bathroom ids,
+                 once they're committed (ex to forget cached pages)
+
+    Returns dictionary with counts of inserted, updated, unchanged and
+    skipped (duplicate) bathrooms.
+    """
+
+    # Keep the newest version of each bathroom in the batch
+    rows_by_refuge_id = {}
+    for bathroom in bathrooms:
+        if bathroom.refuge_id is None or bathroom.latitude is None or bathroom.longitude is None:
+            continue
+        row = bathroom.to_row()
+        current = rows_by_refuge_id.get(row["refuge_id"])
+        if current is None or is_newer(row["refuge_updated_at"], current["refuge_updated_at"]):
+            rows_by_refuge_id[row["refuge_id"]] = row
+
+    # One query for bathrooms we already have by refuge id...
+    existing = {}
+    refuge_ids = list(rows_by_refuge_id)
+    for start in range(0, len(refuge_ids), 500):
+        query = (db.session.query(Bathroom.refuge_id, Bathroom.bathroom_id, Bathroom.refuge_updated_at)
+                           .filter(Bathroom.refuge_id.in_(refuge_ids[start:start + 500])))
+        for refuge_id, bathroom_id, updated_at in query:
+            existing[refuge_id] = (bathroom_id, updated_at)
+
+    # ...and one for older rows at the same lat-long that don't have one yet
+    unmatched = {get_lat_long_key(row["latitude"], row["longitude"]): refuge_id
+                 for refuge_id, row in rows_by_refuge_id.items() if refuge_id not in existing}
+    latitudes = sorted({key[0] for key in unmatched})
+    for start in range(0, len(latitudes), 500):
+        query = (db.session.query(Bathroom.latitude, Bathroom.longitude, Bathroom.bathroom_id)
+                           .filter(Bathroom.latitude.in_(latitudes[start:start + 500]),
+                                   Bathroom.refuge_id.is_(None)))
+        for latitude, longitude, bathroom_id in query:
+            refuge_id = unmatched.get(get_lat_long_key(latitude, longitude))
+            if refuge_id is not None:
+                existing[refuge_id] = (bathroom_id, None)
+
+    # The rest go through a DuplicateGrid like in add_bathrooms_to_db, each
+    # new one is added to it so the batch is deduped against itself too
+    unmatched_rows = [row for refuge_id, row in rows_by_refuge_id.items() if refuge_id not in existing]
+    grid = get_duplicate_grid(unmatched_rows)
+    claimed_ids = {bathroom_id for bathroom_id, updated_at in existing.values()}
+    new_rows = []
+    duplicate_refuge_ids = {}
+    for row in unmatched_rows:
+        entry = get_grid_entry(None, row["latitude"], row["longitude"], row["name"], row["city"])
+        duplicate = grid.find_duplicate(entry)
+        if duplicate is None:
+            grid.add(entry)
+            new_rows.append(row)
+        elif duplicate[0] is not None and duplicate[0] not in claimed_ids:
+            duplicate_refuge_ids.setdefault(duplicate[0], row["refuge_id"])
+
+    # Duplicates without a refuge id are adopted like rows matched on lat-long
+    duplicate_ids = list(duplicate_refuge_ids)
+    for start in range(0, len(duplicate_ids), 500):
+        query = (db.session.query(Bathroom.bathroom_id)
+                           .filter(Bathroom.bathroom_id.in_(duplicate_ids[start:start + 500]),
+                                   Bathroom.refuge_id.is_(None)))
+        for bathroom_id, in query:
+            existing[duplicate_refuge_ids[bathroom_id]] = (bathroom_id, None)
+
+    changed_rows = []
+    for refuge_id, row in rows_by_refuge_id.items():
+        if refuge_id not in existing:
+            continue
+        bathroom_id, updated_at = existing[refuge_id]
+        if updated_at is None or is_newer(row["refuge_updated_at"], updated_at):
+            changed = {column: row[column] for column in SYNCED_COLUMNS}
+            changed["bathroom_id"] = bathroom_id
+            changed_rows.append(changed)
+
+    # Ones inserted elsewhere since we looked (ex by a concurrent sync) are skipped
+    inserted = insert_bathroom_rows(new_rows)
+    if changed_rows:
+        keep_taken_locations(changed_rows)
+        # One executemany UPDATE ... WHERE bathroom_id = ? for the batch
+        db.session.bulk_update_mappings(Bathroom, changed_rows)
+    db.session.commit()
+    if on_change is not None and changed_rows:
+        on_change([row["bathroom_id"] for row in changed_rows])
+
+    return {"inserted": inserted,
+            "updated": len(changed_rows),
+            "unchanged": len(existing) - len(changed_rows),
+            "skipped": len(rows_by_refuge_id) - len(existing) - inserted}
+
+
+def sync_bathrooms(since=None, per_page=SYNC_PAGE_SIZE, on_change=None):
+    """Apply every Refuge API bathroom change since the last sync.
+
+    since -- optional - datetime to sync from instead of the saved watermark
+    on_change -- optional - called with each page's updated bathroom ids
+
+    Returns dictionary with counts of inserted, updated, unchanged and
+    skipped bathrooms and the new watermark. Raises refuge.RefugeUnavailable
+    if a call fails, pages already applied stay applied and the next run
+    redoes the rest.
+    """
+
+    state = SyncState.query.get(SYNC_NAME)
+    if state is None:
+        state = SyncState(name=SYNC_NAME, last_changed_count=0)
+        db.session.add(state)
+
+    if since is None:
+        since = state.watermark - WATERMARK_OVERLAP if state.watermark else datetime(2000, 1, 1)
+
+    totals = {"inserted": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+    watermark = state.watermark
+    page = 1
+    while True:
+        bathroom_dicts = fetch_changed_bathrooms(since, page, per_page)
+        if not bathroom_dicts:
+            break
+
+        bathrooms = [get_bathroom_obj_from_dict(bathroom) for bathroom in bathroom_dicts]
+        for name, count in upsert_bathrooms(bathrooms, on_change).items():
+            totals[name] += count
+        for bathroom in bathrooms:
+            if watermark is None or is_newer(bathroom.refuge_updated_at, watermark):
+                watermark = bathroom.refuge_updated_at
+
+        if len(bathroom_dicts) < per_page:
+            break
+        page += 1
+
+    # Only move the watermark once every page is in
+    state = SyncState.query.get(SYNC_NAME)
+    state.watermark = watermark
+    state.last_run_at = datetime.now()
+    state.last_changed_count = totals["inserted"] + totals["updated"]
+    db.session.commit()
+
+    totals["watermark"] = watermark
+
+    return totals
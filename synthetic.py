@@ -0,0 +1,328 @@
+"""Deterministic synthetic data generator for production-size crapp databases.
+
+Rows are generated in chunks by worker processes and bulk loaded as they
+arrive, with COPY on PostgreSQL. Every chunk has its own random seed and id
+range, so the same seed always gives the same data no matter how many workers
+run. Bathroom popularity and user activity are skewed the way real usage is:
+a few hot bathrooms get most checkins and a few power users make most of them.
+"""
+
+import csv
+import io
+import math
+import random
+
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+from geo import geohash_encode
+from model import (Bathroom, Checkin, ListItem, NamedList, Rating, User, db,
+                   rebuild_bathroom_stats, rebuild_checkin_counters)
+
+# Bathrooms are scattered over San Francisco by default
+SOUTH, NORTH = 37.70, 37.81
+WEST, EAST = -122.51, -122.37
+
+# Rows generated per worker task
+CHUNK_SIZE = 10000
+
+# Bathrooms are placed on a grid this fine, the database keeps 7 decimal places
+COORDINATE_STEP = 1e-7
+
+# Most checkins one user can have, keeps power users from running away
+MAX_CHECKINS_PER_USER = 2000
+
+# Share of checkins that get rated
+RATED_SHARE = 0.4
+
+FIRST_NAMES = ("Ada", "Ben", "Cam", "Dee", "Eli", "Fay", "Gus", "Hal", "Ivy", "Jo",
+               "Kai", "Lu", "Max", "Nia", "Oz", "Pat", "Quin", "Rae", "Sam", "Tia")
+LAST_NAMES = ("Alvarez", "Brown", "Chen", "Diaz", "Evans", "Fong", "Garcia", "Hill",
+              "Ito", "Jones", "Kim", "Lee", "Moore", "Nguyen", "Ortiz", "Patel")
+
+# Columns written for each table, in COPY order
+COLUMNS = {
+    "users": ("user_id", "full_name", "password", "email", "created_at", "is_premium"),
+    "bathrooms": ("bathroom_id", "name", "city", "state", "country", "latitude", "longitude",
+                  "geohash", "unisex", "accessible", "changing_table", "approved", "is_premium",
+                  "upvotes", "downvotes"),
+    "lists": ("list_id", "list_name", "user_id"),
+    "list_items": ("list_id", "user_id", "bathroom_id", "datetime_added"),
+    "checkins": ("checkin_id", "user_id", "bathroom_id", "checkin_datetime"),
+    "ratings": ("rating_id", "user_id", "bathroom_id", "checkin_id", "score", "review_text"),
+}
+
+MODELS = {"users": User, "bathrooms": Bathroom, "lists": NamedList,
+          "list_items": ListItem, "checkins": Checkin, "ratings": Rating}
+
+START_DATE = datetime(2019, 1, 1)
+DAYS_OF_HISTORY = 365
+
+
+def get_chunk_random(seed, table, chunk_index):
+    """Returns random.Random seeded for one chunk of one table."""
+
+    return random.Random(f"{seed}-{table}-{chunk_index}")
+
+
+def choose_hot(rand, first_id, count, skew=3.0):
+    """Pick an id between first_id and first_id + count - 1, favoring low ids.
+
+    Higher skew concentrates picks on fewer ids (skew 3 gives the first 10%
+    of ids about half the picks).
+
+    Returns id.
+    """
+
+    return first_id + int(count * rand.random() ** skew)
+
+
+def get_checkin_counts(seed, chunk_index, user_count, mean_checkins):
+    """Pick how many checkins each user in a chunk has, most few and a few very many.
+
+    Has its own random stream, so the loader can work out each chunk's
+    checkin ids before the chunk is generated.
+
+    Returns list of checkin counts, one per user.
+    """
+
+    rand = get_chunk_random(seed, "checkin_counts", chunk_index)
+
+    # Pareto with alpha 1.5 has mean 3, scale it to mean_checkins
+    return [min(MAX_CHECKINS_PER_USER, int(rand.paretovariate(1.5) * mean_checkins / 3))
+            for i in range(user_count)]
+
+
+def generate_users(seed, chunk_index, first_id, count):
+    """Generate user rows for ids first_id to first_id + count - 1.
+
+    Returns dictionary of table name to list of row tuples.
+    """
+
+    rand = get_chunk_random(seed, "users", chunk_index)
+    rows = []
+    for user_id in range(first_id, first_id + count):
+        name = f"{rand.choice(FIRST_NAMES)} {rand.choice(LAST_NAMES)}"
+        created_at = START_DATE + timedelta(seconds=rand.randrange(DAYS_OF_HISTORY * 86400))
+        rows.append((user_id, name, f"{rand.getrandbits(48):012x}",
+                     f"user{user_id}@example.com", created_at, rand.random() < 0.05))
+
+    return {"users": rows}
+
+
+def get_grid_points(seed, bounds):
+    """Number the COORDINATE_STEP grid points in bounds for placing bathrooms.
+
+    A bathroom goes on point (bathroom_id * step + offset) % points. step
+    shares no factor with points, so no two bathroom ids get the same point
+    (random lat-longs would, about once in 2M bathrooms, and the repeat
+    aborts a COPY into the unique lat-long key), and consecutive ids are
+    spread over the whole area.
+
+    Returns tuple (columns, points, step, offset).
+    """
+
+    south, west, north, east = bounds
+    columns = int(round((east - west) / COORDINATE_STEP))
+    points = int(round((north - south) / COORDINATE_STEP)) * columns
+    step = int(points * 0.6180339887) | 1
+    while math.gcd(step, points) != 1:
+        step += 2
+
+    return columns, points, step, random.Random(f"{seed}-grid").randrange(points)
+
+
+def generate_bathrooms(seed, chunk_index, first_id, count, bounds):
+    """Generate bathroom rows for ids first_id to first_id + count - 1.
+
+    bounds -- tuple (south, west, north, east) bathrooms are placed in, each
+              bathroom_id at its own lat-long (see get_grid_points)
+
+    Returns dictionary of table name to list of row tuples.
+    """
+
+    south, west, north, east = bounds
+    columns, points, step, offset = get_grid_points(seed, bounds)
+    rand = get_chunk_random(seed, "bathrooms", chunk_index)
+    rows = []
+    for bathroom_id in range(first_id, first_id + count):
+        point = (bathroom_id * step + offset) % points
+        latitude = round(south + point // columns * COORDINATE_STEP, 7)
+        longitude = round(west + point % columns * COORDINATE_STEP, 7)
+        rows.append((bathroom_id, f"Bathroom {bathroom_id}", "San Francisco", "CA", "US",
+                     latitude, longitude, geohash_encode(latitude, longitude, 12),
+                     rand.random() < 0.4, rand.random() < 0.6, rand.random() < 0.2,
+                     True, False, 0, 0))
+
+    return {"bathrooms": rows}
+
+
+def generate_activity(seed, chunk_index, first_user_id, user_count, first_bathroom_id,
+                      bathroom_count, mean_checkins, first_list_id, first_checkin_id,
+                      rating_id_offset):
+    """Generate lists, list items, checkins and ratings for a chunk of users.
+
+    first_list_id, first_checkin_id -- first ids of this chunk's block of ids,
+                                       so workers never collide
+    rating_id_offset -- added to a checkin's id to get its rating's id
+
+    Returns dictionary of table name to list of row tuples.
+    """
+
+    rand = get_chunk_random(seed, "activity", chunk_index)
+    checkin_counts = get_checkin_counts(seed, chunk_index, user_count, mean_checkins)
+    rows = {"lists": [], "list_items": [], "checkins": [], "ratings": []}
+
+    list_id = first_list_id
+    checkin_id = first_checkin_id
+
+    for user_id, checkin_count in zip(range(first_user_id, first_user_id + user_count),
+                                      checkin_counts):
+        for list_name in ("Favorites", "Shit List"):
+            rows["lists"].append((list_id, list_name, user_id))
+            for bathroom_id in {choose_hot(rand, first_bathroom_id, bathroom_count)
+                                for i in range(rand.randint(0, 8))}:
+                rows["list_items"].append((list_id, user_id, bathroom_id, START_DATE))
+            list_id += 1
+
+        for i in range(checkin_count):
+            bathroom_id = choose_hot(rand, first_bathroom_id, bathroom_count)
+            checkin_datetime = START_DATE + timedelta(seconds=rand.randrange(DAYS_OF_HISTORY * 86400))
+            rows["checkins"].append((checkin_id, user_id, bathroom_id, checkin_datetime))
+            if rand.random() < RATED_SHARE:
+                # Hot bathrooms are hot for a reason, skew their scores up
+                is_hot = bathroom_id - first_bathroom_id < bathroom_count // 10
+                score = min(5, max(1, round(rand.gauss(4.2 if is_hot else 3.0, 1))))
+                rows["ratings"].append((checkin_id + rating_id_offset, user_id, bathroom_id,
+                                        checkin_id, score, None))
+            checkin_id += 1
+
+    return rows
+
+
+def generate_chunk(task):
+    """Run one generate_* function for a worker process.
+
+    task -- tuple (as_csv, generate function, arguments)
+
+    Returns dictionary of table name to CSV text (if as_csv) or row tuples.
+    """
+
+    as_csv, generate, args = task
+    tables = generate(*args)
+    if not as_csv:
+        return tables
+
+    csv_tables = {}
+    for table, rows in tables.items():
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        csv_tables[table] = buffer.getvalue()
+
+    return csv_tables
+
+
+def copy_chunk(tables):
+    """Bulk load one generated chunk into the database."""
+
+    for table in ("users", "bathrooms", "lists", "list_items", "checkins", "ratings"):
+        data = tables.get(table)
+        if not data:
+            continue
+
+        if isinstance(data, str):
+            # CSV text from worker, stream it straight into COPY
+            cursor = db.session.connection().connection.cursor()
+            cursor.copy_expert(f"COPY {table} ({', '.join(COLUMNS[table])}) FROM STDIN WITH CSV",
+                               io.StringIO(data))
+        else:
+            rows = [dict(zip(COLUMNS[table], row)) for row in data]
+            db.session.execute(MODELS[table].__table__.insert(), rows)
+
+    db.session.commit()
+
+
+def get_first_free_ids():
+    """Returns dictionary of first id after the current max in each table."""
+
+    first_ids = {}
+    for table, model in MODELS.items():
+        if table == "list_items":
+            continue
+        id_column = list(model.__table__.primary_key.columns)[0]
+        first_ids[table] = (db.session.query(db.func.max(id_column)).scalar() or 0) + 1
+
+    return first_ids
+
+
+def reset_sequences():
+    """Move PostgreSQL id sequences past the explicit ids loaded."""
+
+    for table, model in MODELS.items():
+        id_column = list(model.__table__.primary_key.columns)[0]
+        db.session.execute(f"SELECT setval(pg_get_serial_sequence('{table}', '{id_column.name}'), "
+                           f"(SELECT COALESCE(MAX({id_column.name}), 1) FROM {table}))")
+    db.session.commit()
+
+
+def load_synthetic_data(users, bathrooms, mean_checkins=20, seed=0, workers=4,
+                        bounds=(SOUTH, WEST, NORTH, EAST)):
+    """Generate and bulk load users, bathrooms and their activity.
+
+    Adds to whatever is already in the database, with ids after the current
+    max ids. Same arguments always generate the same rows.
+
+    users -- number of users to add
+    bathrooms -- number of bathrooms to add
+    mean_checkins -- average checkins per user
+    seed -- random seed
+    workers -- worker processes generating rows
+    bounds -- tuple (south, west, north, east) bathrooms are placed in
+
+    Returns dictionary of rows loaded per table.
+    """
+
+    as_csv = db.engine.dialect.name == "postgresql"
+    first_ids = get_first_free_ids()
+    first_user_id = first_ids["users"]
+    first_bathroom_id = first_ids["bathrooms"]
+
+    def chunks(count):
+        for chunk_index, start in enumerate(range(0, count, CHUNK_SIZE)):
+            yield chunk_index, start, min(CHUNK_SIZE, count - start)
+
+    base_tasks = [(as_csv, generate_users, (seed, chunk_index, first_user_id + start, count))
+                  for chunk_index, start, count in chunks(users)]
+    base_tasks += [(as_csv, generate_bathrooms,
+                    (seed, chunk_index, first_bathroom_id + start, count, bounds))
+                   for chunk_index, start, count in chunks(bathrooms)]
+
+    # Each activity chunk's ids start where the previous chunk's end, and a
+    # rating's id is its checkin's id shifted into the free rating ids
+    activity_tasks = []
+    first_checkin_id = first_ids["checkins"]
+    rating_id_offset = first_ids["ratings"] - first_ids["checkins"]
+    for chunk_index, start, count in chunks(users):
+        activity_tasks.append((as_csv, generate_activity,
+                               (seed, chunk_index, first_user_id + start, count,
+                                first_bathroom_id, bathrooms, mean_checkins,
+                                first_ids["lists"] + start * 2, first_checkin_id,
+                                rating_id_offset)))
+        first_checkin_id += sum(get_checkin_counts(seed, chunk_index, count, mean_checkins))
+
+    loaded = {table: 0 for table in COLUMNS}
+    with Pool(workers) as pool:
+        # Users and bathrooms first, activity rows point at them
+        for tasks in (base_tasks, activity_tasks):
+            # Load each chunk as soon as a worker finishes it
+            for tables in pool.imap_unordered(generate_chunk, tasks):
+                copy_chunk(tables)
+                for table, data in tables.items():
+                    loaded[table] += data.count("\n") if isinstance(data, str) else len(data)
+
+    if as_csv:
+        reset_sequences()
+    rebuild_bathroom_stats()
+    rebuild_checkin_counters()
+
+    return loaded
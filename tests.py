@@ -1,10 +1,51 @@
+import asgi
+import asyncio
+import gzip
+import json
+import os
+import requests
+import seed
 import server
+import singleflight
+import sync
+import synthetic
+import tempfile
+import threading
+import time
 
-from sqlalchemy import MetaData
+from cache import FragmentCache, LocalBackend, SharedBackend
+from checkin_queue import CheckinQueue, get_log_line, reserve_checkin_ids
+from migrate import get_migrations, split_statements
+from payloads import choose_encoding
+from datetime import datetime, timedelta
+from geo import GEOHASH_ALPHABET, geohash_prefix_end
+from search import SearchIndex
+from trending import get_busyness
+from refuge import CircuitBreaker, CircuitOpen, RefugeClient, RefugeRequestError, RefugeUnavailable
+from replicas import get_connect_options
+from singleflight import SingleFlight
+from sqlalchemy import MetaData, event
 from unittest import TestCase
-from unittest.mock import patch, Mock
+from unittest.mock import patch, AsyncMock, Mock
 from model import (db, connect_to_db, get_bathrooms_by_lat_long, 
-                   get_bathroom_objs_from_request, Bathroom)
+                   get_bathroom_objs_from_request, find_nearby_bathrooms,
+                   add_bathrooms_to_db, merge_duplicate_bathrooms, record_bathroom_deletions,
+                   record_checkins, record_rating, rebuild_bathroom_stats, rebuild_checkin_counters, Bathroom,
+                   BathroomStats, Checkin, CheckinCounter, ListItem, NamedList, Rating, SyncState, User,
+                   PASSWORD_CHARACTER_SETS)
+
+class TestUser(TestCase):
+
+    def test_generated_password(self):
+        """Test that a user without a password gets a random one with every character type."""
+
+        password = User(full_name="Jane Doe", email="jane@example.com").password
+
+        self.assertEqual(len(password), 10)
+        for character_set in PASSWORD_CHARACTER_SETS:
+            self.assertTrue(any(character in character_set for character in password))
+        self.assertNotEqual(password, User(full_name="Jane Doe", email="jane@example.com").password)
+
 
 class TestBathroomHelpers(TestCase):
     
@@ -22,7 +63,7 @@ class TestBathroomHelpers(TestCase):
         # db.create_all()
 
         
-    @patch('model.requests.get')
+    @patch('refuge.requests.Session.get')
     def test_get_bathroom_objs_from_request(self, mock_get):
         """Test that when a Response is input, returns list of Bathroom objects."""
 
@@ -91,6 +132,1599 @@ class TestBathroomHelpers(TestCase):
                          response_json_bathrooms[1]["longitude"])
 
 
+class TestTileCache(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+        server.near_me_cache.backend.clear()
+
+        # Connect to empty in-memory database so lookups go to Refuge API
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+    def tearDown(self):
+        """Remove session after each test."""
+
+        db.session.remove()
+
+    def test_local_backend_evicts_least_recently_used(self):
+        """Test that LocalBackend drops the oldest unused entry when full."""
+
+        backend = LocalBackend(max_entries=2)
+        backend.set("a", 1, ttl=60)
+        backend.set("b", 2, ttl=60)
+        backend.get("a")
+        backend.set("c", 3, ttl=60)
+
+        self.assertEqual(backend.get("a"), 1)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.evictions, 1)
+
+    def test_local_backend_expires_entries(self):
+        """Test that entries past their ttl are not returned."""
+
+        backend = LocalBackend()
+        backend.set("a", 1, ttl=-1)
+
+        self.assertIsNone(backend.get("a"))
+
+    @patch('refuge.requests.Session.get')
+    def test_nearby_lookups_share_one_api_call(self, mock_get):
+        """Test that two lookups in the same tile only call Refuge API once."""
+
+        mock_get.return_value.json.return_value = [{"id": 1, "name": "Quizno's"}]
+        hits_before = server.near_me_cache.hits
+
+        first = self.client.get('/get_near_me.json?lat=37.7872185&lng=-122.4104286')
+        second = self.client.get('/get_near_me.json?lat=37.7872190&lng=-122.4104290')
+
+        self.assertEqual(first.get_json(), second.get_json())
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(server.near_me_cache.hits - hits_before, 1)
+
+    @patch('refuge.requests.Session.get')
+    def test_near_me_conditional_and_compressed(self, mock_get):
+        """Test that a repeat near me lookup with the ETag gets a 304, and gzip is sent when accepted."""
+
+        mock_get.return_value.json.return_value = [{"id": i, "name": "Quizno's"} for i in range(50)]
+        misses_before = server.near_me_payloads.misses
+
+        first = self.client.get('/get_near_me.json?lat=37.7872185&lng=-122.4104286',
+                                headers={"Accept-Encoding": "gzip"})
+        second = self.client.get('/get_near_me.json?lat=37.7872185&lng=-122.4104286',
+                                 headers={"If-None-Match": first.headers["ETag"]})
+
+        self.assertEqual(first.headers["Content-Encoding"], "gzip")
+        self.assertEqual(len(json.loads(gzip.decompress(first.get_data()))), 50)
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.get_data(), b"")
+        # Serialized for the first request only
+        self.assertEqual(server.near_me_payloads.misses - misses_before, 1)
+
+    def test_choose_encoding(self):
+        """Test that Accept-Encoding q-values are honored."""
+
+        self.assertEqual(choose_encoding("gzip, deflate"), "gzip")
+        self.assertEqual(choose_encoding("gzip;q=0, deflate"), None)
+        self.assertEqual(choose_encoding("*;q=0.5"), choose_encoding("gzip, br"))
+        self.assertEqual(choose_encoding(None), None)
+
+
+class TestFragmentCache(TestCase):
+
+    def test_invalidate_and_evicted_versions(self):
+        """Test that invalidating a tag, or losing its version to eviction, re-renders."""
+
+        cache = FragmentCache(LocalBackend(max_entries=3), ttl=60)
+        renders = []
+        render = lambda: renders.append(1) or f"<p>{len(renders)}</p>"
+
+        self.assertEqual(cache.get_or_render("hub:1", ["user:1"], render), "<p>1</p>")
+        self.assertEqual(cache.get_or_render("hub:1", ["user:1"], render), "<p>1</p>")
+        cache.invalidate("user:1")
+        self.assertEqual(cache.get_or_render("hub:1", ["user:1"], render), "<p>2</p>")
+
+        # Other tags push user:1's version out of the LRU
+        cache.get_or_render("hub:2", ["user:2"], render)
+        self.assertIsNone(cache.backend.get("tag:user:1"))
+        self.assertEqual(cache.get_or_render("hub:1", ["user:1"], render), "<p>4</p>")
+
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 4)
+        self.assertEqual(cache.stats()["hit_rate"], 0.2)
+
+    def test_invalidation_reaches_other_workers(self):
+        """Test that workers sharing tag versions stop serving a page either one invalidates."""
+
+        # Stand-in for a redis server, storing what SharedBackend sends it
+        server_data = {}
+        client = Mock()
+        client.get.side_effect = server_data.get
+        client.setex.side_effect = lambda key, ttl, value: server_data.__setitem__(key, value)
+        workers = [FragmentCache(LocalBackend(), ttl=60, tag_backend=SharedBackend(client))
+                   for i in range(2)]
+
+        for worker in workers:
+            worker.get_or_render("hub:1", ["user:1"], lambda: "<p>old</p>")
+        workers[0].invalidate("user:1")
+
+        self.assertEqual(workers[1].get_or_render("hub:1", ["user:1"], lambda: "<p>new</p>"),
+                         "<p>new</p>")
+
+
+class TestNearbyBathrooms(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+        server.near_me_cache.backend.clear()
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        # Bathrooms about 0.13 miles, 0.18 miles and 5 miles from search point
+        db.session.add_all([Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286, approved=True),
+                            Bathroom(name="Academy of Art", latitude=37.789732, longitude=-122.408567, approved=True),
+                            Bathroom(name="Far Away", latitude=37.86, longitude=-122.41, approved=True)])
+        db.session.commit()
+
+    def tearDown(self):
+        """Remove session after each test."""
+
+        db.session.remove()
+
+    def test_find_nearby_bathrooms_sorted_within_radius(self):
+        """Test that only bathrooms within radius come back, closest first."""
+
+        bathrooms = find_nearby_bathrooms(37.7887, -122.4116, radius_miles=1.0)
+
+        self.assertEqual([b["name"] for b in bathrooms], ["Quizno's", "Academy of Art"])
+        self.assertLess(bathrooms[0]["distance"], bathrooms[1]["distance"])
+        self.assertIn("bearing", bathrooms[0])
+
+    @patch('model.MIN_LOCAL_RESULTS', 2)
+    @patch('refuge.requests.Session.get')
+    def test_get_near_me_uses_local_bathrooms(self, mock_get):
+        """Test that Refuge API isn't called when enough bathrooms are local."""
+
+        response = self.client.get('/get_near_me.json?lat=37.7887&lng=-122.4116')
+
+        self.assertEqual(len(response.get_json()), 2)
+        mock_get.assert_not_called()
+
+    @patch('refuge.requests.Session.get')
+    def test_get_near_me_falls_back_to_local_when_refuge_down(self, mock_get):
+        """Test that local bathrooms are served when the Refuge API call fails."""
+
+        mock_get.side_effect = requests.ConnectionError("Refuge API down")
+
+        response = self.client.get('/get_near_me.json?lat=37.7887&lng=-122.4116')
+        server.refuge_client.breaker.record_success()
+
+        self.assertEqual([b["name"] for b in response.get_json()], ["Quizno's", "Academy of Art"])
+
+    def test_geohash_prefix_end_is_a_geohash(self):
+        """Test that prefix ranges end at the next geohash, not a symbol collations may ignore."""
+
+        self.assertEqual(geohash_prefix_end("9q8yy"), "9q8yz")
+        self.assertEqual(geohash_prefix_end("9q8yz"), "9q8z")
+        self.assertEqual(geohash_prefix_end("9q8zz"), "9q9")
+        self.assertIsNone(geohash_prefix_end("zz"))
+
+        # Every longer geohash in the cell sorts between the cell and its end, by
+        # character class alone (digits before letters, letters alphabetical)
+        cell = "9q8yy"
+        for geohash in (cell + "0", cell + "zzzz", cell + "b7"):
+            self.assertTrue(cell <= geohash < geohash_prefix_end(cell))
+        self.assertTrue(set(geohash_prefix_end("9q8y")) <= set(GEOHASH_ALPHABET))
+
+    def test_get_near_me_needs_lat_long(self):
+        """Test that a missing or non-numeric lat-long is a bad request, not an error."""
+
+        self.assertEqual(self.client.get('/get_near_me.json?lat=37.7887').status_code, 400)
+        self.assertEqual(self.client.get('/get_near_me.json?lat=north&lng=-122.4116').status_code, 400)
+
+
+class TestAddBathroomsToDb(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+    def tearDown(self):
+        """Remove session after each test."""
+
+        db.session.remove()
+
+    def test_add_bathrooms_skips_existing_and_repeated(self):
+        """Test that bathrooms already in db or repeated in batch aren't added."""
+
+        add_bathrooms_to_db([Bathroom(latitude=37.7872185, longitude=-122.4104286, approved=True)])
+
+        counts = add_bathrooms_to_db([
+            Bathroom(latitude=37.7872185, longitude=-122.4104286, approved=True),
+            Bathroom(latitude=37.789732, longitude=-122.408567, approved=True),
+            Bathroom(latitude=37.789732, longitude=-122.408567, approved=True)])
+
+        self.assertEqual(counts, {"inserted": 1, "skipped": 2})
+        self.assertEqual(Bathroom.query.count(), 2)
+
+    def test_add_bathrooms_skips_taken_refuge_ids(self):
+        """Test that a bathroom whose refuge id is already stored is skipped instead of failing the batch."""
+
+        add_bathrooms_to_db([Bathroom(latitude=37.7872185, longitude=-122.4104286, refuge_id=7, approved=True)])
+
+        counts = add_bathrooms_to_db([
+            Bathroom(latitude=37.8, longitude=-122.4, refuge_id=7, approved=True),
+            Bathroom(latitude=37.81, longitude=-122.4, refuge_id=8, approved=True),
+            Bathroom(latitude=37.82, longitude=-122.4, refuge_id=8, approved=True)])
+
+        self.assertEqual(counts, {"inserted": 1, "skipped": 2})
+        self.assertEqual(sorted(refuge_id for refuge_id, in db.session.query(Bathroom.refuge_id)), [7, 8])
+
+
+class TestLoadBathrooms(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+        self.checkpoint_path = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
+
+    def tearDown(self):
+        """Remove session after each test."""
+
+        db.session.remove()
+
+    def fake_search(self, url, params, timeout):
+        """Refuge search with 2 full pages and 1 short page of bathrooms per region."""
+
+        page = params["page"]
+        response = Mock()
+        response.json.return_value = [
+            {"name": f"{params['query']} {page}-{i}", "latitude": 37 + page / 100 + i / 1000,
+             "longitude": -122 - len(params["query"]) / 100, "approved": True}
+            for i in range(2 if page < 3 else 1 if page == 3 else 0)]
+        return response
+
+    @patch('refuge.requests.Session.get')
+    def test_load_bathrooms_fetches_every_page(self, mock_get):
+        """Test that all pages for all regions are loaded, then checkpoint removed."""
+
+        mock_get.side_effect = self.fake_search
+
+        seed.load_bathrooms(regions=["California", "Oregon"], workers=3, per_page=2,
+                            batch_size=3, checkpoint_path=self.checkpoint_path)
+
+        self.assertEqual(Bathroom.query.count(), 10)
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    @patch('refuge.requests.Session.get')
+    def test_load_bathrooms_resumes_from_checkpoint(self, mock_get):
+        """Test that pages recorded in checkpoint aren't fetched again."""
+
+        mock_get.side_effect = self.fake_search
+        seed.save_checkpoint({"California": {"pages": [1, 2], "last_page": None}},
+                             self.checkpoint_path)
+
+        seed.load_bathrooms(regions=["California"], workers=2, per_page=2,
+                            checkpoint_path=self.checkpoint_path)
+
+        fetched_pages = {call[1]["params"]["page"] for call in mock_get.call_args_list}
+        self.assertNotIn(1, fetched_pages)
+        self.assertNotIn(2, fetched_pages)
+        self.assertEqual(Bathroom.query.count(), 1)
+
+
+class TestUserHub(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+        server.page_cache.backend.clear()
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        user = User(full_name="Jane Doe", email="jane@example.com", password="pw")
+        bathroom = Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286, approved=True)
+        db.session.add_all([user, bathroom])
+        db.session.commit()
+
+        # Heavy user with more checkins and ratings than fit on one page
+        for i in range(40):
+            checkin = Checkin(user.user_id, bathroom.bathroom_id)
+            db.session.add(checkin)
+            db.session.flush()
+            db.session.add(Rating(user.user_id, bathroom.bathroom_id, checkin.checkin_id, score=5))
+        db.session.commit()
+        self.user_id = user.user_id
+        db.session.remove()
+
+        self.statements = []
+        event.listen(db.engine, "before_cursor_execute", self.count_statement)
+
+    def tearDown(self):
+        """Remove session and statement counter after each test."""
+
+        event.remove(db.engine, "before_cursor_execute", self.count_statement)
+        db.session.remove()
+
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_rating_page_404s_uncached_and_follows_bathroom_changes(self):
+        """Test that a missing rating 404s without being cached, and bathroom changes re-render its page."""
+
+        self.assertEqual(self.client.get('/rating/41').status_code, 404)
+        checkin = Checkin(self.user_id, 1)
+        db.session.add(checkin)
+        db.session.flush()
+        db.session.add(Rating(self.user_id, 1, checkin.checkin_id, score=4))
+        db.session.commit()
+        self.assertIn(b"Quizno&#39;s", self.client.get('/rating/41').data)
+
+        # The rating's bathroom is renamed by a sync
+        bathroom = Bathroom.query.get(1)
+        sync.upsert_bathrooms([Bathroom(name="Quiznos Restroom", latitude=bathroom.latitude,
+                                        longitude=bathroom.longitude, approved=True, refuge_id=7)],
+                              on_change=server.forget_bathroom_pages)
+        self.assertIn(b"Quiznos Restroom", self.client.get('/rating/41').data)
+
+        # Then merged into an older copy of it
+        older = Bathroom(name="Quizno's Restroom", latitude=37.7872285, longitude=-122.4104286,
+                         approved=True)
+        older.bathroom_id = 0
+        db.session.add(older)
+        db.session.commit()
+        merge_duplicate_bathrooms(on_merge=server.forget_bathroom_pages)
+
+        self.assertIn(b"Quizno&#39;s Restroom", self.client.get('/rating/41').data)
+
+    def test_user_hub_uses_fixed_number_of_queries(self):
+        """Test that the hub doesn't run a query per checkin or rating."""
+
+        response = self.client.get(f'/users/{self.user_id}')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.count(b"View Rating"), 2 * server.HUB_PAGE_SIZE)
+        self.assertLessEqual(len(self.statements), 6)
+
+    def test_repeat_hub_views_cached_until_rating(self):
+        """Test that a repeat hub view runs no queries and a new rating shows up."""
+
+        self.client.get(f'/users/{self.user_id}')
+        self.statements.clear()
+        self.client.get(f'/users/{self.user_id}')
+        self.assertEqual(self.statements, [])
+
+        bathroom = Bathroom(name="New Cafe", latitude=37.7888, longitude=-122.4117, approved=True)
+        db.session.add(bathroom)
+        db.session.commit()
+        checkin = Checkin(self.user_id, bathroom.bathroom_id, checkin_datetime=datetime(2100, 1, 1))
+        db.session.add(checkin)
+        db.session.commit()
+        bathroom_id, checkin_id = bathroom.bathroom_id, checkin.checkin_id
+        db.session.remove()
+
+        # Queued checkins are shown once inserted
+        server.forget_checkin_pages([{"user_id": self.user_id}])
+        response = self.client.get(f'/users/{self.user_id}')
+        self.assertIn(b"New Cafe - 2100-01-01", response.data)
+        self.assertIn(f'id="checkin{checkin_id}">Add Rating'.encode(), response.data)
+
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+        self.client.post(f'/rate/{bathroom_id}/{checkin_id}', data={"rating": 5})
+        response = self.client.get(f'/users/{self.user_id}')
+
+        self.assertIn(f'id="{checkin_id}">View Rating'.encode(), response.data)
+        self.assertGreaterEqual(server.page_cache.stats()["hits"], 1)
+
+    def test_user_hub_request_metrics_recorded(self):
+        """Test that the hub's query count and timings are recorded per route."""
+
+        self.client.get(f'/users/{self.user_id}')
+
+        route = server.request_metrics.to_dict()["GET /users/<user_id>"]
+        self.assertGreaterEqual(route["queries"]["count"], 1)
+        self.assertIsNotNone(route["render_ms"]["mean"])
+        self.assertIn('crapp_request_queries_bucket{method="GET",route="/users/<user_id>",le="10"}',
+                      self.client.get('/metrics').get_data(as_text=True))
+
+    def test_failed_request_and_query_recorded(self):
+        """Test that a request raising after a failed query still has its timings recorded."""
+
+        def broken_page():
+            db.session.execute("SELECT * FROM no_such_table")
+
+        def get_query_counts():
+            """Returns (requests, requests with no queries) recorded for /about."""
+
+            queries = server.request_metrics.to_dict().get("GET /about", {}).get("queries")
+            return (queries["count"], queries["buckets"]["0"]) if queries else (0, 0)
+
+        requests_before, no_queries_before = get_query_counts()
+        server.app.config['PROPAGATE_EXCEPTIONS'] = False
+        try:
+            with patch.dict(server.app.view_functions, {"display_about_page": broken_page}):
+                response = self.client.get('/about')
+        finally:
+            server.app.config['PROPAGATE_EXCEPTIONS'] = None
+
+        self.assertEqual(response.status_code, 500)
+        # Recorded, with the failed query counted
+        self.assertEqual(get_query_counts(), (requests_before + 1, no_queries_before))
+
+    def test_slow_request_logged_with_queries(self):
+        """Test that requests over the slow threshold are logged with their SQL."""
+
+        with patch.object(server.request_metrics, 'slow_request_ms', 0):
+            with self.assertLogs('crapp.slow_requests', level='WARNING') as logs:
+                self.client.get(f'/users/{self.user_id}')
+
+        self.assertIn("SELECT", logs.output[0])
+
+    def test_user_hub_pages_checkins(self):
+        """Test that later checkins are on the next page."""
+
+        response = self.client.get(f'/users/{self.user_id}?checkins_page=2')
+
+        self.assertEqual(response.data.count(b'id="rating'), server.HUB_PAGE_SIZE)
+        self.assertIn(b"Newer", response.data)
+
+
+class TestBathroomStats(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        user = User(full_name="Jane Doe", email="jane@example.com", password="pw")
+        bathroom = Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286, approved=True)
+        db.session.add_all([user, bathroom])
+        db.session.commit()
+        self.user_id = user.user_id
+        self.bathroom_id = bathroom.bathroom_id
+
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+
+    def tearDown(self):
+        """Remove session after each test."""
+
+        db.session.remove()
+
+    def rate(self, score):
+        """Check in to the test bathroom and rate it through the app."""
+
+        checkin = Checkin(self.user_id, self.bathroom_id)
+        db.session.add(checkin)
+        db.session.commit()
+        self.client.post(f'/rate/{self.bathroom_id}/{checkin.checkin_id}', data={"rating": score})
+
+    def test_rating_updates_stats(self):
+        """Test that each rating submitted updates the bathroom's stats."""
+
+        self.rate(5)
+        self.rate(2)
+
+        stats = BathroomStats.query.get(self.bathroom_id)
+        self.assertEqual(stats.rating_count, 2)
+        self.assertEqual(stats.mean_score, 3.5)
+        self.assertEqual(stats.histogram, [0, 1, 0, 0, 1])
+
+    def test_rebuild_matches_incremental_stats(self):
+        """Test that rebuilding stats from ratings gives the same numbers."""
+
+        for score in (1, 4, 4):
+            self.rate(score)
+        incremental = BathroomStats.query.get(self.bathroom_id).to_dict()
+
+        rebuild_bathroom_stats()
+        rebuilt = BathroomStats.query.get(self.bathroom_id).to_dict()
+
+        self.assertEqual(rebuilt["histogram"], incremental["histogram"])
+        self.assertEqual(rebuilt["average_score"], incremental["average_score"])
+
+    def test_rating_outside_scores_rejected(self):
+        """Test that a missing or out of range rating isn't saved or counted."""
+
+        for score in ("", 9, "five"):
+            self.rate(score)
+
+        self.assertEqual(Rating.query.count(), 0)
+        self.assertIsNone(BathroomStats.query.get(self.bathroom_id))
+
+
+class TestBathroomsInView(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        # Two bathrooms a block apart in SF, one in Oakland
+        db.session.add_all([Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286, approved=True),
+                            Bathroom(name="Academy of Art", latitude=37.789732, longitude=-122.408567, approved=True),
+                            Bathroom(name="Oakland", latitude=37.8044, longitude=-122.2712, approved=True)])
+        db.session.commit()
+        server.bathroom_clusters.built_at = None
+
+    def tearDown(self):
+        """Remove session after each test."""
+
+        db.session.remove()
+
+    def test_zoomed_out_view_is_clustered(self):
+        """Test that nearby bathrooms come back as one cluster when zoomed out."""
+
+        response = self.client.get('/bathrooms_in_view.json?south=37.6&west=-122.6&north=38.0&east=-122.0&zoom=9')
+        clusters = response.get_json()["clusters"]
+
+        self.assertEqual(sorted(cluster["count"] for cluster in clusters), [1, 2])
+        self.assertEqual(response.get_json()["bathrooms"], [])
+
+    def test_zoomed_in_view_has_single_bathrooms(self):
+        """Test that only bathrooms in the viewport come back when zoomed in."""
+
+        response = self.client.get('/bathrooms_in_view.json?south=37.78&west=-122.42&north=37.80&east=-122.40&zoom=17')
+        bathrooms = response.get_json()["bathrooms"]
+
+        self.assertEqual(sorted(b["name"] for b in bathrooms), ["Academy of Art", "Quizno's"])
+
+    def test_stale_clusters_rebuilt_in_background(self):
+        """Test that viewport lookups keep the old clusters until a background rebuild swaps in."""
+
+        url = '/bathrooms_in_view.json?south=37.0&west=-122.6&north=38.0&east=-121.0&zoom=9'
+        self.assertEqual(len(self.client.get(url).get_json()["clusters"]), 2)
+        db.session.add(Bathroom(name="San Jose", latitude=37.3382, longitude=-121.8863, approved=True))
+        db.session.commit()
+
+        clusters = server.bathroom_clusters
+        started = threading.Event()
+        finish = threading.Event()
+        build_from_db = clusters.build_from_db
+
+        def slow_build_from_db():
+            started.set()
+            finish.wait(5)
+            build_from_db()
+
+        clusters.build_from_db = slow_build_from_db
+        clusters.built_at -= 601
+
+        # Answered from the old clusters while the rebuild runs
+        self.assertEqual(len(self.client.get(url).get_json()["clusters"]), 2)
+        self.assertTrue(started.wait(5))
+
+        finish.set()
+        clusters.start_refresh(server.app).join(5)
+        self.assertEqual(len(self.client.get(url).get_json()["clusters"]), 3)
+        del clusters.build_from_db
+
+
+class TestSingleFlight(TestCase):
+
+    def test_concurrent_callers_share_one_call(self):
+        """Test that callers asking for the same key at once share one fetch."""
+
+        single_flight = SingleFlight()
+        fetches = []
+        results = []
+
+        def fetch():
+            fetches.append(1)
+            time.sleep(0.2)
+            return "bathrooms"
+
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do("9q8yy", fetch)))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ["bathrooms"] * 5)
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(single_flight.stats()["coalesced"], 4)
+
+    def test_waiting_process_uses_cached_value(self):
+        """Test that a process that waited on another's lock rechecks the cache."""
+
+        lock_dir = tempfile.mkdtemp()
+        first = SingleFlight(lock_dir=lock_dir)
+        second = SingleFlight(lock_dir=lock_dir)
+        cache = {}
+
+        def slow_fetch():
+            time.sleep(0.2)
+            cache["9q8yy"] = "bathrooms"
+            return "bathrooms"
+
+        leader = threading.Thread(target=first.do, args=("9q8yy", slow_fetch))
+        leader.start()
+        time.sleep(0.05)
+        value = second.do("9q8yy", lambda: "fetched again", recheck=lambda: cache.get("9q8yy"))
+        leader.join()
+
+        self.assertEqual(value, "bathrooms")
+        self.assertEqual(second.calls, 0)
+
+    def test_lock_files_are_bounded(self):
+        """Test that keys share a fixed number of lock files."""
+
+        lock_dir = tempfile.mkdtemp()
+        single_flight = SingleFlight(lock_dir=lock_dir)
+        for i in range(1000):
+            single_flight.do(f"tile{i}", lambda: "bathrooms")
+
+        self.assertLessEqual(len(os.listdir(lock_dir)), singleflight.LOCK_FILES)
+
+
+class TestRefugeClient(TestCase):
+
+    def test_circuit_opens_after_repeated_failures(self):
+        """Test that calls fail fast without going upstream once circuit opens."""
+
+        client = RefugeClient(breaker=CircuitBreaker(failure_threshold=2, reset_after=60))
+
+        with patch.object(client.session, 'get', side_effect=requests.ConnectionError("down")) as mock_get:
+            for i in range(2):
+                with self.assertRaises(RefugeUnavailable):
+                    client.get("/restrooms")
+            with self.assertRaises(CircuitOpen):
+                client.get("/restrooms")
+
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(client.stats()["circuit"], "open")
+        self.assertEqual(client.stats()["latency_ms"]["count"], 2)
+
+    def test_circuit_closes_after_successful_trial(self):
+        """Test that a successful call after the reset time closes the circuit."""
+
+        client = RefugeClient(breaker=CircuitBreaker(failure_threshold=1, reset_after=0))
+        client.breaker.record_failure()
+
+        with patch.object(client.session, 'get'):
+            client.get("/restrooms")
+
+        self.assertEqual(client.breaker.state, "closed")
+
+    def test_client_errors_dont_open_circuit(self):
+        """Test that 4xx responses are raised without counting against the breaker."""
+
+        client = RefugeClient(breaker=CircuitBreaker(failure_threshold=2, reset_after=60))
+        response = requests.Response()
+        response.status_code = 422
+
+        with patch.object(client.session, 'get', return_value=response):
+            for i in range(3):
+                with self.assertRaises(RefugeRequestError):
+                    client.get("/restrooms/by_location", params={"lat": "north"})
+
+        self.assertEqual(client.breaker.state, "closed")
+        self.assertEqual(client.stats()["errors"], 3)
+
+        response.status_code = 503
+        with patch.object(client.session, 'get', return_value=response):
+            for i in range(2):
+                with self.assertRaises(RefugeUnavailable):
+                    client.get("/restrooms")
+
+        self.assertEqual(client.breaker.state, "open")
+
+class TestSyntheticData(TestCase):
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def load(self):
+        """Load a small synthetic dataset into a fresh database, returns all checkin rows."""
+
+        connect_to_db(server.app, "sqlite://")
+        db.drop_all()
+        db.create_all()
+        with patch('synthetic.CHUNK_SIZE', 7):
+            counts = synthetic.load_synthetic_data(30, 50, mean_checkins=5, seed=3, workers=2)
+        rows = db.session.query(Checkin.checkin_id, Checkin.user_id, Checkin.bathroom_id,
+                                Checkin.checkin_datetime).order_by(Checkin.checkin_id).all()
+        db.session.remove()
+
+        return counts, rows
+
+    def test_same_seed_gives_same_rows(self):
+        """Test that chunks loaded out of order still give identical, contiguous ids."""
+
+        counts, rows = self.load()
+        counts_again, rows_again = self.load()
+
+        self.assertEqual(counts, counts_again)
+        self.assertEqual(rows, rows_again)
+        self.assertEqual([row[0] for row in rows], list(range(1, counts["checkins"] + 1)))
+
+    def test_bathroom_lat_longs_never_repeat(self):
+        """Test that every bathroom id gets its own lat-long, even packed into a tiny area."""
+
+        # 100 x 100 points of 7 decimal places
+        bounds = (37.78, -122.41, 37.78001, -122.40999)
+        rows = synthetic.generate_bathrooms(3, 0, 1, 10000, bounds)["bathrooms"]
+        lat_longs = {(row[5], row[6]) for row in rows}
+
+        self.assertEqual(len(lat_longs), 10000)
+        self.assertTrue(all(37.78 <= latitude < 37.78001 and -122.41 <= longitude < -122.40999
+                            for latitude, longitude in lat_longs))
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+        server.EXPORT_TOKEN = "secret"
+        self.auth = {"Authorization": "Bearer secret"}
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        user = User(full_name="Jane Doe", email="jane@example.com", password="pw")
+        quiznos = Bathroom(name="Quizno's", state="CA", latitude=37.7872185,
+                           longitude=-122.4104286, approved=True)
+        deli = Bathroom(name="Deli", state="NY", latitude=40.7484, longitude=-73.9857, approved=True)
+        db.session.add_all([user, quiznos, deli])
+        db.session.commit()
+
+        for bathroom in (quiznos, deli, quiznos):
+            checkin = Checkin(user.user_id, bathroom.bathroom_id)
+            db.session.add(checkin)
+            db.session.flush()
+            db.session.add(Rating(user.user_id, bathroom.bathroom_id, checkin.checkin_id, score=4))
+        db.session.commit()
+        db.session.remove()
+
+    def tearDown(self):
+        server.EXPORT_TOKEN = None
+        db.session.remove()
+        db.drop_all()
+
+    def test_export_ratings_gzipped_ndjson_by_state(self):
+        """Test that ratings stream as gzipped NDJSON, filtered to one state."""
+
+        response = self.client.get('/export/ratings.ndjson?state=CA&gzip=1',
+                                   headers=self.auth)
+
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        rows = [json.loads(line) for line in gzip.decompress(response.data).splitlines()]
+        self.assertEqual([row["checkin_id"] for row in rows], [1, 3])
+        self.assertEqual(rows[0]["score"], 4)
+
+    def test_export_checkins_csv_by_date(self):
+        """Test that checkins export as CSV with a header, filtered by date range."""
+
+        response = self.client.get('/export/checkins.csv?start=2000-01-01', headers=self.auth)
+        lines = response.data.decode().splitlines()
+        self.assertEqual(lines[0], "checkin_id,user_id,bathroom_id,checkin_datetime,rating_id")
+        self.assertEqual(len(lines), 4)
+
+        response = self.client.get('/export/checkins.csv?end=2000-01-01', headers=self.auth)
+        self.assertEqual(len(response.data.decode().splitlines()), 1)
+
+    def test_export_needs_token(self):
+        """Test that exports are refused without the export token."""
+
+        self.assertEqual(self.client.get('/export/checkins.csv').status_code, 403)
+        self.assertEqual(self.client.get('/export/checkins.csv?token=secret').status_code, 403)
+        self.assertEqual(self.client.get('/export/checkins.csv',
+                                         headers={"Authorization": "Bearer wrong"}).status_code, 403)
+        self.assertEqual(self.client.get('/export/users.csv', headers=self.auth).status_code, 404)
+
+class TestRefugeSync(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        # Bathroom stored before refuge ids were kept
+        db.session.add(Bathroom(name="Old Quizno's", latitude=37.7872185,
+                                longitude=-122.4104286, approved=True))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def make_page(self, *bathrooms):
+        """Returns Mock Refuge API response for a page of (id, name, lat, updated_at)."""
+
+        response = Mock()
+        response.json.return_value = [{"id": refuge_id, "name": name, "latitude": latitude,
+                                       "longitude": -122.4104286, "approved": True,
+                                       "upvote": 2, "downvote": 0, "updated_at": updated_at}
+                                      for refuge_id, name, latitude, updated_at in bathrooms]
+        return response
+
+    @patch('sync.refuge_client.get')
+    def test_sync_upserts_changes_since_watermark(self, mock_get):
+        """Test that a sync adopts old rows, inserts new ones and resumes from its watermark."""
+
+        mock_get.side_effect = [self.make_page((7, "Quizno's", 37.7872185, "2019-03-04T18:21:41.409Z"),
+                                               (8, "Deli", 37.79, "2019-03-05T09:00:00.000Z")),
+                                self.make_page()]
+        totals = sync.sync_bathrooms(per_page=2)
+
+        self.assertEqual((totals["inserted"], totals["updated"]), (1, 1))
+        self.assertEqual(Bathroom.query.count(), 2)
+        self.assertEqual(Bathroom.query.filter_by(refuge_id=7).one().name, "Quizno's")
+
+        # Next run starts a day before the watermark and only applies real changes
+        mock_get.side_effect = [self.make_page((7, "Quizno's", 37.7872185, "2019-03-04T18:21:41.409Z"),
+                                               (8, "Deli & Bar", 37.79, "2019-04-01T12:00:00.000Z"))]
+        totals = sync.sync_bathrooms()
+
+        self.assertEqual(mock_get.call_args[1]["params"]["day"], 4)
+        self.assertEqual((totals["inserted"], totals["updated"], totals["unchanged"]), (0, 1, 1))
+        self.assertEqual(Bathroom.query.filter_by(refuge_id=8).one().name, "Deli & Bar")
+        self.assertEqual(SyncState.query.get(sync.SYNC_NAME).watermark, datetime(2019, 4, 1, 12))
+
+    @patch('sync.refuge_client.get')
+    def test_sync_skips_merged_duplicates(self, mock_get):
+        """Test that a sync doesn't reinsert a bathroom dedupe merged away, the one kept takes its id."""
+
+        # Refuge's copy is a couple meters from the bathroom we kept
+        mock_get.side_effect = [self.make_page((7, "Quiznos", 37.7872385, "2019-03-04T18:21:41.409Z"))]
+        totals = sync.sync_bathrooms()
+
+        self.assertEqual((totals["inserted"], totals["updated"]), (0, 1))
+        self.assertEqual(Bathroom.query.one().refuge_id, 7)
+
+        # Another Refuge id for the same bathroom is skipped
+        mock_get.side_effect = [self.make_page((9, "Quizno's", 37.7872285, "2019-03-05T09:00:00.000Z"))]
+        totals = sync.sync_bathrooms()
+
+        self.assertEqual((totals["inserted"], totals["skipped"]), (0, 1))
+        self.assertEqual(Bathroom.query.count(), 1)
+
+    @patch('sync.refuge_client.get')
+    def test_sync_update_onto_taken_lat_long(self, mock_get):
+        """Test that an update moving a bathroom onto another's lat-long leaves it where it is."""
+
+        mock_get.side_effect = [self.make_page((7, "Quizno's", 37.7872185, "2019-03-04T18:21:41.409Z"),
+                                               (8, "Deli", 37.79, "2019-03-05T09:00:00.000Z"))]
+        sync.sync_bathrooms()
+
+        mock_get.side_effect = [self.make_page((8, "Deli & Bar", 37.7872185, "2019-04-01T12:00:00.000Z"))]
+        totals = sync.sync_bathrooms()
+
+        deli = Bathroom.query.filter_by(refuge_id=8).one()
+        self.assertEqual(totals["updated"], 1)
+        self.assertEqual((deli.name, float(deli.latitude)), ("Deli & Bar", 37.79))
+        self.assertEqual(SyncState.query.get(sync.SYNC_NAME).watermark, datetime(2019, 4, 1, 12))
+
+class TestDedupe(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_add_bathrooms_skips_near_duplicates(self):
+        """Test that a jittered copy of a bathroom is skipped but a different one next door isn't."""
+
+        add_bathrooms_to_db([Bathroom(name="Quizno's Restroom", city="San Francisco",
+                                      latitude=37.7872185, longitude=-122.4104286, approved=True)])
+
+        counts = add_bathrooms_to_db([
+            Bathroom(name="Quiznos", city="San Francisco", latitude=37.7872385,
+                     longitude=-122.4104186, approved=True),
+            Bathroom(name="Blue Bottle Coffee", city="San Francisco", latitude=37.7872585,
+                     longitude=-122.4104286, approved=True)])
+
+        self.assertEqual(counts, {"inserted": 1, "skipped": 1})
+        self.assertEqual(sorted(name for name, in db.session.query(Bathroom.name)),
+                         ["Blue Bottle Coffee", "Quizno's Restroom"])
+
+    def test_merge_duplicate_bathrooms(self):
+        """Test that the batch merge keeps the oldest bathroom and moves activity to it."""
+
+        user = User(full_name="Jane Doe", email="jane@example.com", password="pw")
+        keeper = Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286, approved=True)
+        duplicate = Bathroom(name="Quiznos", latitude=37.7872285, longitude=-122.4104286, approved=True)
+        far_away = Bathroom(name="Quizno's", latitude=37.8, longitude=-122.4104286, approved=True)
+        db.session.add_all([user, keeper, duplicate, far_away])
+        db.session.commit()
+        checkin = Checkin(user.user_id, duplicate.bathroom_id)
+        db.session.add(checkin)
+        db.session.flush()
+        db.session.add(Rating(user.user_id, duplicate.bathroom_id, checkin.checkin_id, score=5))
+        db.session.commit()
+        keeper_id = keeper.bathroom_id
+
+        self.assertEqual(merge_duplicate_bathrooms(), 1)
+
+        self.assertEqual(Bathroom.query.count(), 2)
+        self.assertEqual(Checkin.query.one().bathroom_id, keeper_id)
+        self.assertEqual(BathroomStats.query.get(keeper_id).rating_count, 1)
+        self.assertEqual(SyncState.query.get("bathroom_deletions").last_changed_count, 1)
+
+class TestBathroomSnapshot(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+        server.bathroom_snapshot = None
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        # Bathrooms about 0.13 miles, 0.18 miles and 5 miles from search point
+        db.session.add_all([Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286,
+                                     approved=True, unisex=True),
+                            Bathroom(name="Academy of Art", latitude=37.789732, longitude=-122.408567,
+                                     approved=True, unisex=True, accessible=True),
+                            Bathroom(name="Far Away", latitude=37.86, longitude=-122.41,
+                                     approved=True, unisex=True, accessible=True)])
+        db.session.commit()
+
+    def tearDown(self):
+        server.bathroom_snapshot = None
+        db.session.remove()
+        db.drop_all()
+
+    def test_filtered_nearby_search(self):
+        """Test that flag filters and radius apply, closest first."""
+
+        response = self.client.get('/get_near_me.json?lat=37.7887&lng=-122.4116&unisex=1')
+        self.assertEqual([b["name"] for b in response.get_json()], ["Quizno's", "Academy of Art"])
+
+        response = self.client.get('/get_near_me.json?lat=37.7887&lng=-122.4116&accessible=1')
+        self.assertEqual([b["name"] for b in response.get_json()], ["Academy of Art"])
+        self.assertIn("bearing", response.get_json()[0])
+
+        response = self.client.get('/get_near_me.json?lng=-122.4116&accessible=1')
+        self.assertEqual(response.status_code, 400)
+
+    def test_refresh_picks_up_new_bathrooms_and_ratings(self):
+        """Test that an incremental refresh adds new bathrooms and re-ranks by new ratings."""
+
+        snapshot = server.get_bathroom_snapshot()
+        snapshot.refresh()
+        self.assertEqual([bathroom_id for bathroom_id, distance in snapshot.find_nearest(37.7887, -122.4116)],
+                         [1, 2])
+
+        user = User(full_name="Jane Doe", email="jane@example.com", password="pw")
+        db.session.add_all([user, Bathroom(name="New Cafe", latitude=37.7888, longitude=-122.4117, approved=True)])
+        db.session.commit()
+        checkin = Checkin(user.user_id, 2)
+        db.session.add(checkin)
+        db.session.flush()
+        rating = Rating(user.user_id, 2, checkin.checkin_id, score=5)
+        db.session.add(rating)
+        record_rating(rating)
+        db.session.commit()
+
+        snapshot.refresh()
+
+        self.assertEqual(len(snapshot), 4)
+        self.assertEqual([bathroom_id for bathroom_id, distance in snapshot.find_nearest(37.7887, -122.4116)],
+                         [4, 1, 2])
+        self.assertEqual(snapshot.find_nearest(37.7887, -122.4116, sort="rating")[0][0], 2)
+        self.assertEqual(len(snapshot.find_nearest(37.7887, -122.4116, min_score=4)), 1)
+
+    def test_refresh_drops_deleted_bathrooms_without_counting(self):
+        """Test that a recorded deletion rebuilds the snapshot, without counting every bathroom."""
+
+        snapshot = server.get_bathroom_snapshot()
+        snapshot.refresh()
+
+        db.session.delete(Bathroom.query.get(1))
+        record_bathroom_deletions(1)
+        db.session.add(Bathroom(name="New Cafe", latitude=37.7888, longitude=-122.4117, approved=True))
+        db.session.commit()
+
+        statements = []
+        count_statement = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        snapshot.refresh()
+        snapshot.refresh()
+        event.remove(db.engine, "before_cursor_execute", count_statement)
+
+        self.assertEqual([bathroom_id for bathroom_id, distance in snapshot.find_nearest(37.7887, -122.4116)],
+                         [4, 2])
+        self.assertFalse([statement for statement in statements if "count(" in statement.lower()])
+
+
+class TestSearch(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+        server.search_index = SearchIndex(max_age=60)
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        # Two Starbucks, one near the search point and one about 5 miles away
+        db.session.add_all([Bathroom(name="Starbucks", latitude=37.86, longitude=-122.41, approved=True,
+                                     city="Berkeley", directions="Code is on the receipt"),
+                            Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286,
+                                     approved=True, city="San Francisco", notes="Single stall"),
+                            Bathroom(name="Starbucks Reserve", latitude=37.789732, longitude=-122.408567,
+                                     approved=True, city="San Francisco")])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def search(self, query_string):
+        """Returns names of bathrooms /search.json finds."""
+
+        response = self.client.get('/search.json?' + query_string)
+        return [b["name"] for b in response.get_json()["results"]]
+
+    def test_prefix_typo_and_distance_ranking(self):
+        """Test that partly typed and misspelled words match, and lat-long ranks closer first."""
+
+        self.assertEqual(self.search('q=starb'), ["Starbucks", "Starbucks Reserve"])
+        self.assertEqual(self.search('q=starbcks%20reserve'), ["Starbucks Reserve"])
+        self.assertEqual(self.search('q=quiznos%20single'), ["Quizno's"])
+        self.assertEqual(self.search('q=starbucks&lat=37.7887&lng=-122.4116'),
+                         ["Starbucks Reserve", "Starbucks"])
+        self.assertEqual(self.search('q=starbucks&lat=37.7887&lng=-122.4116&radius=1'),
+                         ["Starbucks Reserve"])
+        self.assertEqual(self.client.get('/search.json?q=%20').status_code, 400)
+
+    def test_refresh_picks_up_new_changed_and_deleted_bathrooms(self):
+        """Test that an incremental refresh indexes added and renamed bathrooms, and deletes rebuild."""
+
+        index = server.search_index
+        index.refresh()
+        db.session.add(Bathroom(name="Peet's Coffee", latitude=37.7, longitude=-122.4, approved=True))
+        quiznos = Bathroom.query.filter_by(name="Quizno's").one()
+        quiznos.name = "Subway"
+        quiznos.refuge_updated_at = datetime(2019, 6, 1)
+        db.session.commit()
+        index.refresh()
+
+        self.assertEqual([result[0] for result in index.search("peets")], [4])
+        self.assertEqual([result[0] for result in index.search("subway")], [quiznos.bathroom_id])
+        self.assertEqual(index.search("quiznos "), [])
+        self.assertEqual(index.rebuilds, 2)
+
+        db.session.delete(quiznos)
+        record_bathroom_deletions(1)
+        db.session.commit()
+        index.refresh()
+
+        self.assertEqual(index.rebuilds, 3)
+        self.assertEqual(index.search("subway"), [])
+
+        # Nothing deleted since, no rebuild
+        index.refresh()
+        self.assertEqual(index.rebuilds, 3)
+
+    def test_stale_index_refreshes_in_background(self):
+        """Test that searches keep using a stale index until a background refresh swaps in changes."""
+
+        self.assertEqual(self.search('q=peets'), [])
+        index = server.search_index
+        db.session.add(Bathroom(name="Peet's Coffee", latitude=37.7, longitude=-122.4, approved=True))
+        db.session.commit()
+
+        started = threading.Event()
+        finish = threading.Event()
+        refresh = index.refresh
+
+        def slow_refresh():
+            started.set()
+            finish.wait(5)
+            refresh()
+
+        index.refresh = slow_refresh
+        index.refreshed_at -= 61
+
+        # Answered from the old index while the refresh runs
+        self.assertEqual(self.search('q=peets'), [])
+        self.assertTrue(started.wait(5))
+
+        finish.set()
+        index.start_refresh(server.app).join(5)
+        self.assertEqual(self.search('q=peets'), ["Peet's Coffee"])
+
+
+def call_asgi(path, query_string=b""):
+    """Make one GET request to the ASGI app.
+
+    Returns tuple of (status, response body).
+    """
+
+    scope = {"type": "http", "method": "GET", "path": path, "root_path": "",
+             "query_string": query_string, "headers": [], "http_version": "1.1",
+             "scheme": "http", "server": ("localhost", 80), "client": ("127.0.0.1", 5000)}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.new_event_loop().run_until_complete(asgi.application(scope, receive, send))
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+
+    return messages[0]["status"], body
+
+
+class TestAsgi(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        server.app.config['TESTING'] = True
+        server.near_me_cache.backend.clear()
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        # Bathrooms about 0.13 miles and 0.18 miles from search point
+        db.session.add_all([Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286, approved=True),
+                            Bathroom(name="Academy of Art", latitude=37.789732, longitude=-122.408567, approved=True)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_near_me_calls_refuge_async_and_caches(self):
+        """Test that near me goes to the Refuge API once per tile."""
+
+        refuge_bathrooms = [{"name": "From Refuge", "latitude": 37.79, "longitude": -122.41}]
+        with patch.object(asgi.async_refuge_client, 'get_json', new_callable=AsyncMock,
+                          return_value=refuge_bathrooms) as mock_get:
+            status, body = call_asgi('/get_near_me.json', b"lat=37.7887&lng=-122.4116")
+            call_asgi('/get_near_me.json', b"lat=37.7887&lng=-122.4116")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), refuge_bathrooms)
+        self.assertEqual(mock_get.call_count, 1)
+
+    def test_near_me_falls_back_to_local_when_refuge_down(self):
+        """Test that local bathrooms are served when the async Refuge API call fails."""
+
+        with patch.object(asgi.async_refuge_client, 'get_json', new_callable=AsyncMock,
+                          side_effect=RefugeUnavailable("Refuge API down")):
+            status, body = call_asgi('/get_near_me.json', b"lat=37.7887&lng=-122.4116")
+
+        self.assertEqual([b["name"] for b in json.loads(body)], ["Quizno's", "Academy of Art"])
+
+    def test_other_routes_served_by_flask(self):
+        """Test that routes besides near me go through the Flask app."""
+
+        status, body = call_asgi('/about')
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"<html", body.lower())
+
+
+class TestCheckinQueue(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        user = User(full_name="Jane Doe", email="jane@example.com", password="pw")
+        bathroom = Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286, approved=True)
+        db.session.add_all([user, bathroom])
+        db.session.commit()
+        self.user_id = user.user_id
+        self.bathroom_id = bathroom.bathroom_id
+
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+
+        # Long max_delay so checkins stay queued until the test flushes them
+        self.log_dir = tempfile.mkdtemp()
+        self.queue = CheckinQueue(self.log_dir, batch_size=3, max_delay=60)
+        self.queue.init_app(server.app)
+
+    def tearDown(self):
+        self.queue.close()
+        db.session.remove()
+        db.drop_all()
+
+    def test_checkin_is_queued_and_rating_flushes_it(self):
+        """Test that a checkin gets its id before it's inserted and rating it inserts it."""
+
+        with patch.object(server, 'checkin_queue', self.queue):
+            response = self.client.get(f'/checkin/{self.bathroom_id}')
+            checkin_id = self.queue.pending[0]["checkin_id"]
+
+            self.assertIn(f'/rate/{self.bathroom_id}/{checkin_id}', response.get_data(as_text=True))
+            self.assertIsNone(Checkin.query.get(checkin_id))
+
+            self.client.post(f'/rate/{self.bathroom_id}/{checkin_id}', data={"rating": 4})
+
+        db.session.remove()
+        self.assertEqual(Checkin.query.get(checkin_id).user_id, self.user_id)
+        self.assertEqual(Rating.query.filter_by(checkin_id=checkin_id).one().score, 4)
+
+    def test_rating_waits_for_checkin_queued_by_other_process(self):
+        """Test that the rating form waits for a checkin another worker queued."""
+
+        other_queue = CheckinQueue(tempfile.mkdtemp(), batch_size=100, max_delay=0.2)
+        other_queue.init_app(server.app)
+        try:
+            with server.app.app_context():
+                checkin_id = other_queue.add(self.user_id, self.bathroom_id)
+
+            with patch.object(server, 'checkin_queue', self.queue):
+                response = self.client.get(f'/rate/{self.bathroom_id}/{checkin_id}')
+        finally:
+            other_queue.close()
+
+        self.assertEqual(response.status_code, 200)
+
+    @patch('checkin_queue.WAIT_MARGIN', 0.1)
+    def test_unknown_checkin_or_bathroom_404s(self):
+        """Test that checking in to a missing bathroom or rating a missing checkin is a 404."""
+
+        self.queue.max_delay = 0
+        with patch.object(server, 'checkin_queue', self.queue):
+            self.assertEqual(self.client.get('/checkin/99').status_code, 404)
+            self.assertEqual(self.client.get(f'/rate/{self.bathroom_id}/99').status_code, 404)
+            response = self.client.post(f'/rate/{self.bathroom_id}/99', data={"rating": 4})
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.queue.stats()["accepted"], 0)
+
+    def test_checkins_inserted_in_batches(self):
+        """Test that a full batch wakes the insert thread and checkins are logged until inserted."""
+
+        with server.app.app_context():
+            checkin_ids = [self.queue.add(self.user_id, self.bathroom_id) for i in range(2)]
+            with open(self.queue.log_path) as log_file:
+                self.assertEqual(len(log_file.readlines()), 2)
+            self.assertEqual(db.session.query(Checkin).count(), 0)
+
+            checkin_ids.append(self.queue.add(self.user_id, self.bathroom_id))
+
+            # Leaving the app context rolls back the in-memory db's one
+            # shared connection, so wait for the insert thread's commit first
+            for i in range(100):
+                if not self.queue.stats()["queued"]:
+                    break
+                time.sleep(0.01)
+
+        self.assertEqual(self.queue.stats(), {"accepted": 3, "inserted": 3, "batches": 1, "queued": 0})
+        self.assertEqual(sorted(checkin_id for checkin_id, in db.session.query(Checkin.checkin_id)),
+                         checkin_ids)
+        self.assertEqual(os.path.getsize(self.queue.log_path), 0)
+        # Counted in the insert's transaction
+        self.assertEqual(CheckinCounter.query.filter_by(bathroom_id=self.bathroom_id, kind="day")
+                                             .one().checkin_count, 3)
+
+    def test_logs_left_by_stopped_process_are_replayed(self):
+        """Test that logged checkins are inserted once when the queue starts."""
+
+        checkin = Checkin(self.user_id, self.bathroom_id)
+        db.session.add(checkin)
+        db.session.commit()
+
+        rows = [{"checkin_id": checkin.checkin_id, "user_id": self.user_id,
+                 "bathroom_id": self.bathroom_id, "checkin_datetime": datetime(2019, 5, 1), "rating_id": None},
+                {"checkin_id": 50, "user_id": self.user_id, "bathroom_id": self.bathroom_id,
+                 "checkin_datetime": datetime(2019, 5, 2), "rating_id": None}]
+        log_path = os.path.join(self.log_dir, "checkins-1234-abcd.log")
+        with open(log_path, "w") as log_file:
+            # Last line was cut short by the crash
+            log_file.write(get_log_line(rows[0]) + get_log_line(rows[1]) + '{"checkin_id": 5')
+
+        with server.app.app_context():
+            checkin_id = self.queue.add(self.user_id, self.bathroom_id)
+
+        self.assertFalse(os.path.exists(log_path))
+        self.assertEqual(db.session.query(Checkin).count(), 2)
+        self.assertEqual(Checkin.query.get(50).checkin_datetime, datetime(2019, 5, 2))
+        self.assertGreater(checkin_id, 50)
+
+
+class TestTrending(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+        server.trending_cache.clear()
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        db.session.add_all([User(full_name="Jane Doe", email="jane@example.com"),
+                            Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286, approved=True),
+                            Bathroom(name="Academy of Art", latitude=37.789732, longitude=-122.408567, approved=True)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def add_checkins(self, bathroom_id, checkin_datetimes):
+        """Insert checkins and count them like the checkin queue does."""
+
+        rows = [{"user_id": 1, "bathroom_id": bathroom_id, "checkin_datetime": checkin_datetime,
+                 "rating_id": None}
+                for checkin_datetime in checkin_datetimes]
+        db.session.execute(Checkin.__table__.insert(), rows)
+        db.session.commit()
+        record_checkins(rows)
+
+    def get_counters(self):
+        """Returns set of every counter's values."""
+
+        return {(c.bathroom_id, c.kind, c.slot, c.bucket_start, c.checkin_count)
+                for c in CheckinCounter.query}
+
+    def test_counters_match_rebuild_and_busyness(self):
+        """Test that counters kept per checkin match a rebuild, and busyness reads them."""
+
+        # A Monday, the checkin a week ago shares this hour's ring buffer slot
+        now = datetime(2019, 6, 3, 12, 30)
+        self.add_checkins(1, [now - timedelta(days=7)])
+        self.add_checkins(1, [now, now - timedelta(minutes=20), now - timedelta(minutes=75),
+                              now - timedelta(days=2)])
+        counters = self.get_counters()
+        rebuild_checkin_counters(now)
+
+        self.assertEqual(self.get_counters(), counters)
+
+        busyness = get_busyness(1, now)
+        self.assertEqual(busyness["hourly"][-1]["checkins"], 2)
+        # This hour's 2 plus the half of last hour that's in the last 60 minutes
+        self.assertEqual(busyness["checkins_last_60_minutes"], 2.5)
+        # 3 Monday noon checkins in about a week
+        self.assertEqual(busyness["usual_checkins_this_hour"], 2.99)
+        self.assertEqual(busyness["level"], "usual")
+        self.assertEqual(busyness["daily"][-1]["checkins"], 3)
+
+    def test_trending_route(self):
+        """Test that only bathrooms with more checkins than the week before trend."""
+
+        now = datetime.now()
+        self.add_checkins(1, [now - timedelta(days=day) for day in (1, 2, 3)])
+        self.add_checkins(2, [now - timedelta(days=day) for day in (1, 8, 9, 10, 11)])
+
+        response = self.client.get('/trending.json')
+
+        self.assertEqual([(b["name"], b["recent_checkins"], b["previous_checkins"])
+                          for b in response.get_json()["bathrooms"]], [("Quizno's", 3, 0)])
+        self.assertEqual(self.client.get('/busyness/1.json').status_code, 200)
+        self.assertEqual(self.client.get('/busyness/99.json').status_code, 404)
+
+
+class TestReplicas(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+
+        # Two separate in-memory databases, the replica never gets the primary's rows
+        connect_to_db(server.app, "sqlite://", replicas=["sqlite://"])
+        db.create_all()
+        db.Model.metadata.create_all(bind=db.get_engine(server.app, bind="replica_1"))
+
+        db.session.add_all([User(full_name="Jane Doe", email="jane@example.com"),
+                            Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286, approved=True)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.Model.metadata.drop_all(bind=db.get_engine(server.app, bind="replica_1"))
+
+    def test_reads_go_to_replica_until_user_writes(self):
+        """Test that reads use the replica, but a user's reads after they write use the primary."""
+
+        replica_reads = server.replica_router.routed.get("replica_1", 0)
+
+        # Only the primary has the bathroom
+        self.assertEqual(self.client.get('/busyness/1.json').status_code, 404)
+        self.assertEqual(server.replica_router.routed["replica_1"], replica_reads + 1)
+
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = 1
+        self.client.post('/add_list', data={"list_to_add": "Favorites"})
+
+        self.assertEqual(NamedList.query.count(), 1)
+        self.assertEqual(self.client.get('/busyness/1.json').status_code, 200)
+
+        # Other users still read from the replica
+        self.assertEqual(server.app.test_client().get('/busyness/1.json').status_code, 404)
+
+    def test_cached_pages_rendered_from_primary(self):
+        """Test that a page cache miss renders from the primary, even for a user who hasn't written."""
+
+        db.session.add(NamedList(list_name="Favorites", user_id=1))
+        db.session.commit()
+
+        server.page_cache.backend.clear()
+        response = self.client.get('/users/1')
+
+        # Only the primary has the list
+        self.assertIn(b"Favorites", response.data)
+
+    @patch('checkin_queue.WAIT_MARGIN', 0.1)
+    def test_checkin_ids_and_waits_use_primary(self):
+        """Test that reserving checkin ids and waiting for a checkin ask the primary, not the replica."""
+
+        db.session.add(Checkin(1, 1))
+        db.session.commit()
+        db.session.remove()
+
+        with server.app.test_request_context('/users/1'):
+            self.assertEqual(reserve_checkin_ids(1), [2])
+            self.assertEqual(server.replica_router.get_replica(), "replica_1")
+            self.assertTrue(CheckinQueue("unused", max_delay=0).wait_for(1))
+            db.session.remove()
+
+    def test_connect_options_and_pool_stats(self):
+        """Test that replicas and pool settings come from the environment and pools are reported."""
+
+        options = get_connect_options({"DATABASE_REPLICA_URLS": "postgresql://a/crapp, postgresql://b/crapp",
+                                       "DATABASE_POOL_SIZE": "20",
+                                       "DATABASE_POOL_RECYCLE": "1800"})
+
+        self.assertEqual(options, {"replicas": ["postgresql://a/crapp", "postgresql://b/crapp"],
+                                   "pool_size": 20,
+                                   "pool_recycle": 1800})
+
+        stats = self.client.get('/metrics.json').get_json()["database"]
+        self.assertEqual(sorted(stats["pools"]), ["primary", "replica_1"])
+        self.assertIn("crapp_db_routed_requests_total", self.client.get('/metrics').get_data(as_text=True))
+
+
+class TestSchema(TestCase):
+
+    def setUp(self):
+        """Setup for each test below."""
+
+        self.client = server.app.test_client()
+        server.app.config['TESTING'] = True
+
+        connect_to_db(server.app, "sqlite://")
+        db.create_all()
+
+        user = User(full_name="Jane Doe", email="jane@example.com", password="pw")
+        bathroom = Bathroom(name="Quizno's", latitude=37.7872185, longitude=-122.4104286, approved=True)
+        named_list = NamedList(list_name="Favorites")
+        db.session.add_all([user, bathroom, named_list])
+        db.session.commit()
+        self.user_id = user.user_id
+        self.bathroom_id = bathroom.bathroom_id
+        self.list_id = named_list.list_id
+
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.user_id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_migrations_make_every_model_index(self):
+        """Test that every index and unique key in the models is made by a migration."""
+
+        sql = "".join(open(path).read() for version, path in get_migrations())
+        names = {index.name for table in db.metadata.sorted_tables for index in table.indexes}
+        names.update(constraint.name or f"{table.name}_{list(constraint.columns)[0].name}_key"
+                     for table in db.metadata.sorted_tables for constraint in table.constraints
+                     if isinstance(constraint, db.UniqueConstraint))
+
+        self.assertIn("users_email_key", names)
+        self.assertEqual([name for name in sorted(names) if f" {name} ON " not in sql], [])
+
+    def test_split_statements(self):
+        """Test that migrations split on line-ending semicolons, without comments."""
+
+        sql = "-- Comment;\nCREATE TABLE t (\n    id INTEGER\n);\n\nCREATE INDEX ix ON t (id);\n"
+
+        self.assertEqual(split_statements(sql), ["CREATE TABLE t (\n    id INTEGER\n)",
+                                                 "CREATE INDEX ix ON t (id)"])
+
+    def test_list_item_and_rating_added_once(self):
+        """Test that adding a bathroom to a list or rating a checkin twice keeps one row."""
+
+        for i in range(2):
+            self.client.get(f'/add_list_item/{self.bathroom_id}/{self.list_id}')
+
+        checkin = Checkin(self.user_id, self.bathroom_id)
+        db.session.add(checkin)
+        db.session.commit()
+        checkin_id = checkin.checkin_id
+        for score in (5, 1):
+            self.client.post(f'/rate/{self.bathroom_id}/{checkin_id}', data={"rating": score})
+
+        self.assertEqual(ListItem.query.count(), 1)
+        self.assertEqual([rating.score for rating in Rating.query.all()], [5])
+
+    def test_only_own_checkins_rated(self):
+        """Test that a user can't rate someone else's checkin, or a checkin under another bathroom."""
+
+        other_user = User(full_name="John Doe", email="john@example.com", password="pw")
+        db.session.add(other_user)
+        db.session.commit()
+        other_user_id = other_user.user_id
+        checkin = Checkin(other_user_id, self.bathroom_id)
+        db.session.add(checkin)
+        db.session.commit()
+        checkin_id = checkin.checkin_id
+
+        response = self.client.post(f'/rate/{self.bathroom_id}/{checkin_id}', data={"rating": 1})
+        self.assertEqual(response.status_code, 404)
+
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = other_user_id
+        response = self.client.post(f'/rate/{self.bathroom_id + 1}/{checkin_id}', data={"rating": 1})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Rating.query.count(), 0)
+
+    def test_double_submit_flashes_already_rated(self):
+        """Test that losing the race to rate a checkin doesn't error."""
+
+        checkin = Checkin(self.user_id, self.bathroom_id)
+        db.session.add(checkin)
+        db.session.commit()
+        checkin_id = checkin.checkin_id
+
+        # The other submit's rating lands between the check and this insert
+        with patch('server.Rating.query') as mock_query:
+            mock_query.filter_by.return_value.first.return_value = None
+            db.session.add(Rating(self.user_id, self.bathroom_id, checkin_id, score=5))
+            db.session.commit()
+            response = self.client.post(f'/rate/{self.bathroom_id}/{checkin_id}', data={"rating": 1})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual([rating.score for rating in Rating.query.all()], [5])
+
+
 if __name__ == "__main__":
     import unittest
     unittest.main()
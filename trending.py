@@ -0,0 +1,108 @@
+"""Busyness and trending bathrooms, read from precomputed checkin counters.
+
+Checkin counts per bathroom per hour, per day and per hour of the week are
+kept up to date as checkins are inserted (see model.CheckinCounter and
+record_checkins), so nothing here reads the checkins table.
+"""
+
+from datetime import timedelta
+
+from model import DAY_SLOTS, CheckinCounter, db
+
+# Compared to the usual count for this hour of the week, below this share is
+# quiet and above BUSY_SHARE is busy
+QUIET_SHARE = 0.5
+BUSY_SHARE = 1.5
+
+# Checkins added to the previous period's count when scoring trends, so a
+# bathroom going from 0 to 1 checkin doesn't top the list
+TRENDING_PRIOR = 5
+
+# Longest period trending can compare (this period and the one before have to fit)
+MAX_TRENDING_DAYS = DAY_SLOTS // 2
+
+
+def get_busyness(bathroom_id, now):
+    """Describe how busy a bathroom is now and usually, from its counters.
+
+    Checkins in the last 60 minutes are estimated from this hour's count
+    plus the unexpired share of the previous hour's.
+
+    Returns dictionary that can be turned into JSON.
+    """
+
+    counters = CheckinCounter.query.filter(CheckinCounter.bathroom_id == bathroom_id).all()
+    counts = {(counter.kind, counter.bucket_start): counter.checkin_count
+              for counter in counters if counter.kind != "profile"}
+    profile = {counter.slot: counter for counter in counters if counter.kind == "profile"}
+
+    this_hour = now.replace(minute=0, second=0, microsecond=0)
+    hours = [this_hour - timedelta(hours=back) for back in range(23, -1, -1)]
+    days = [this_hour.replace(hour=0) - timedelta(days=back) for back in range(6, -1, -1)]
+    elapsed = (now - this_hour).total_seconds() / 3600
+    last_60_minutes = (counts.get(("hour", this_hour), 0)
+                       + counts.get(("hour", this_hour - timedelta(hours=1)), 0) * (1 - elapsed))
+
+    # Average checkins in each hour of the week since the bathroom's first checkin
+    weeks = 1
+    if profile:
+        first = min(counter.bucket_start for counter in profile.values())
+        weeks = max(1, (now - first).total_seconds() / (7 * 24 * 3600))
+    usual = [[round(profile[weekday * 24 + hour].checkin_count / weeks, 2)
+              if weekday * 24 + hour in profile else 0
+              for hour in range(24)]
+             for weekday in range(7)]
+    usual_now = usual[now.weekday()][now.hour]
+
+    if last_60_minutes > usual_now * BUSY_SHARE:
+        level = "busy"
+    elif last_60_minutes < usual_now * QUIET_SHARE or not last_60_minutes:
+        level = "quiet"
+    else:
+        level = "usual"
+
+    return {"bathroom_id": bathroom_id,
+            "level": level,
+            "checkins_last_60_minutes": round(last_60_minutes, 2),
+            "usual_checkins_this_hour": usual_now,
+            "hourly": [{"hour": hour.isoformat(), "checkins": counts.get(("hour", hour), 0)}
+                       for hour in hours],
+            "daily": [{"day": day.date().isoformat(), "checkins": counts.get(("day", day), 0)}
+                      for day in days],
+            # usual[weekday][hour], weekday 0 is Monday
+            "usual": usual}
+
+
+def get_trending(now, days=7, limit=20):
+    """Find bathrooms with more checkins in the last days days than the days before.
+
+    Only reads day counters from the last 2 * days days, found through their
+    (kind, bucket_start) index.
+
+    Returns list of (bathroom_id, recent checkins, previous checkins, score)
+    tuples, highest score first.
+    """
+
+    days = max(1, min(days, MAX_TRENDING_DAYS))
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    recent_start = today - timedelta(days=days - 1)
+    previous_start = recent_start - timedelta(days=days)
+
+    recent = db.func.sum(db.case([(CheckinCounter.bucket_start >= recent_start,
+                                   CheckinCounter.checkin_count)], else_=0))
+    previous = db.func.sum(db.case([(CheckinCounter.bucket_start < recent_start,
+                                     CheckinCounter.checkin_count)], else_=0))
+    totals = (db.session.query(CheckinCounter.bathroom_id, recent, previous)
+                        .filter(CheckinCounter.kind == "day",
+                                CheckinCounter.bucket_start >= previous_start,
+                                CheckinCounter.bucket_start <= today)
+                        .group_by(CheckinCounter.bathroom_id))
+
+    trending = [(bathroom_id, int(recent), int(previous), recent / (previous + TRENDING_PRIOR))
+                for bathroom_id, recent, previous in totals if recent > previous]
+
+    # Highest score first, more recent checkins then lower bathroom_id break ties
+    trending.sort(key=lambda bathroom: (-bathroom[3], -bathroom[1], bathroom[0]))
+
+    return trending[:limit]
+